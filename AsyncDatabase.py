@@ -0,0 +1,239 @@
+from datetime import datetime, timedelta
+from db_config import config, get_float, get_int
+from db_hashing import PasswordHasher
+from db_auth import (
+    CREDENTIAL_USERS_SQL, LOCK_CREDENTIALS_SQL, INSERT_USER_LINKS_SQL, LOGIN_PROFILE_EMAIL_SQL,
+    LOGIN_PROFILE_PHONE_SQL, REMOVE_UNCONFIRMED_SQL, CONFIRM_EMAIL_SQL, CONFIRM_PHONE_SQL,
+    check_registration_format, check_registration, registered, credential_kind, not_registered, incorrect_password,
+    throttled, logged_in
+)
+from db_throttle import Throttle
+
+
+# asyncio counterpart of Database, the schema must already be migrated and seeded by Database or 'flask db upgrade'
+class AsyncDatabase:
+    def __init__(self):
+        # Check if psycopg and psycopg_pool are installed
+        try:
+            from psycopg_pool import AsyncConnectionPool
+        except ImportError:
+            raise ImportError("Please install psycopg and psycopg_pool: 'pip install psycopg psycopg_pool'")
+
+        # Connections are opened by open(), each call borrows its own from the pool
+        self.pool = AsyncConnectionPool(
+            kwargs={
+                "host": config["DB_HOST"],
+                "port": config.get("DB_PORT") or None,
+                "dbname": config["DB_DATABASE"],
+                "user": config["DB_USER"],
+                "password": config["DB_PASSWORD"]
+            },
+            min_size=get_int("DB_POOL_MIN", 1),
+            max_size=get_int("DB_POOL_MAX", 10),
+            timeout=get_float("DB_POOL_TIMEOUT", 30.0),
+            max_idle=get_float("DB_POOL_MAX_IDLE", 600.0),
+            open=False
+        )
+
+        # Login attempts per credential and per caller supplied client key, kept in this process (LOGIN_THROTTLE=off
+        # disables them, postgres is only supported by Database)
+        self.throttle = None if (config.get("LOGIN_THROTTLE") or "memory").lower() == "off" else Throttle(
+            per_minute=get_float("LOGIN_THROTTLE_PER_MINUTE", 10.0),
+            burst=get_int("LOGIN_THROTTLE_BURST", 5),
+            client_per_minute=get_float("LOGIN_THROTTLE_CLIENT_PER_MINUTE", 300.0),
+            client_burst=get_int("LOGIN_THROTTLE_CLIENT_BURST", 60),
+            max_keys=get_int("LOGIN_THROTTLE_MAX_KEYS", 100000)
+        )
+
+        # Hash and check passwords off the event loop
+        self.hasher = PasswordHasher(
+            executor=config.get("HASH_EXECUTOR") or "process",
+            workers=get_int("HASH_WORKERS", 0) or None,
+            max_pending=get_int("HASH_MAX_PENDING", 0) or None,
+            rounds=get_int("HASH_ROUNDS", 12)
+        )
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    # Open the connection pool
+    async def open(self):
+        await self.pool.open()
+
+    # Close the connection pool and the hashing workers
+    async def close(self):
+        await self.pool.close()
+        self.hasher.shutdown()
+
+    # Pool size and saturation counters
+    def pool_stats(self) -> dict:
+        return self.pool.get_stats()
+
+    # Password hashing queue depth and timing counters
+    def hash_stats(self) -> dict:
+        return self.hasher.stats()
+
+    # Allowed, rejected and evicted login attempt counters, None with LOGIN_THROTTLE=off
+    def throttle_stats(self):
+        return self.throttle.stats() if self.throttle is not None else None
+
+    # Private methods
+    # Run a query on a pooled connection and return its first row, the transaction is committed on success
+    async def __fetchone(self, query, params):
+        async with self.pool.connection() as connection:
+            cursor = await connection.execute(query, params)
+            return await cursor.fetchone()
+
+    # Run a statement on a pooled connection and commit it
+    async def __execute(self, query, params=None):
+        async with self.pool.connection() as connection:
+            await connection.execute(query, params)
+
+    # Public methods
+    # Remove users registered before the grace period that confirmed neither their email address nor phone number,
+    # one transaction per batch
+    async def remove_unconfirmed(self, grace: timedelta = None, batch_size: int = None, progress=None) -> dict:
+        if grace is None:
+            grace = timedelta(hours=get_float("UNCONFIRMED_GRACE_HOURS", 24.0))
+        if batch_size is None:
+            batch_size = get_int("UNCONFIRMED_BATCH_SIZE", 1000)
+
+        cutoff = datetime.now() - grace
+        totals = {"removed": 0, "batches": 0, "last_id": 0}
+        while True:
+            removed, last_id = await self.__fetchone(
+                REMOVE_UNCONFIRMED_SQL, {"after": totals["last_id"], "cutoff": cutoff, "batch_size": batch_size}
+            )
+            if not removed:
+                return totals
+            totals["removed"] += removed
+            totals["batches"] += 1
+            totals["last_id"] = last_id
+            if progress is not None:
+                progress(dict(totals))
+
+    # Confirm user's email address
+    async def confirm_email(self, email_address):
+        await self.__execute(CONFIRM_EMAIL_SQL, (email_address, datetime.now()))
+
+    # Confirm user's phone number
+    async def confirm_phone(self, phone_number):
+        await self.__execute(CONFIRM_PHONE_SQL, (phone_number, datetime.now()))
+
+    # Create new user and associate it with an email, phone number and device
+    async def register(
+            self,
+            first_name: str,
+            last_name: str,
+            password: str,
+            email_address: str,
+            device_name: str = None,
+            device_sn: str = None,
+            phone_number: str = None,
+            birth_date: str = None
+    ) -> dict:
+        response = {"type": "", "data": {}}
+
+        # Reject malformed input before any query or hashing
+        if not check_registration_format(
+                response, first_name, last_name, password, email_address, device_name, device_sn, phone_number,
+                birth_date
+        ):
+            return response
+
+        # Find users already linked to the email address, phone number and device
+        credential_users = await self.__fetchone(
+            CREDENTIAL_USERS_SQL,
+            {
+                "email_address": email_address,
+                "phone_number": phone_number,
+                "device_sn": device_sn,
+                "now": datetime.now()
+            }
+        )
+
+        check_registration(response, credential_users)
+        if response["type"] == "error":
+            return response
+
+        hashed = await self.hasher.hash_async(password)
+
+        # Everything is written by two statements and committed once, so a failure leaves nothing behind
+        params = {
+            "first_name": first_name,
+            "last_name": last_name,
+            "password_hash": hashed,
+            "birth_date": birth_date,
+            "email_address": email_address,
+            "phone_number": phone_number,
+            "device_name": device_name,
+            "device_sn": device_sn,
+            "now": datetime.now()
+        }
+        async with self.pool.connection() as connection:
+            cursor = await connection.execute(LOCK_CREDENTIALS_SQL, params)
+            params["email_id"], params["phone_id"], params["device_id"] = await cursor.fetchone()
+            cursor = await connection.execute(INSERT_USER_LINKS_SQL, params)
+            ids = await cursor.fetchone()
+            if not ids:
+                await connection.rollback()
+
+        if not ids:
+            # A credential was linked by a concurrent registration after the availability check
+            check_registration(response, await self.__fetchone(
+                CREDENTIAL_USERS_SQL,
+                {
+                    "email_address": email_address,
+                    "phone_number": phone_number,
+                    "device_sn": device_sn,
+                    "now": datetime.now()
+                }
+            ))
+            if response["type"] == "error":
+                return response
+
+        registered(response, ids, first_name, last_name, email_address, device_name, device_sn, phone_number,
+                   birth_date)
+        return response
+
+    # Login user with an email address or phone number
+    async def login(self, credential: str, password: str, client_key=None) -> dict:
+        response = {"type": "", "data": {}}
+
+        kind = credential_kind(response, credential)
+        if kind is None:
+            return response
+
+        # Attempts over the limits of the credential or of client_key are rejected before any query or bcrypt check
+        retry_after = self.throttle.acquire(kind + ":" + credential, client_key) if self.throttle is not None else 0
+        if retry_after:
+            throttled(response, retry_after)
+            return response
+
+        # No stored hash matches an empty password, skip the query and the check
+        if not isinstance(password, str) or not password:
+            incorrect_password(response)
+            return response
+
+        # Get password hash and profile of the user in one query
+        user = await self.__fetchone(
+            LOGIN_PROFILE_EMAIL_SQL if kind == "email" else LOGIN_PROFILE_PHONE_SQL,
+            {"credential": credential, "now": datetime.now()}
+        )
+
+        # If no user is linked to the credential, send error for non-existent user
+        if not user:
+            not_registered(response, kind)
+            return response
+
+        # If password is incorrect, send error
+        if not await self.hasher.verify_async(password, user[3]):
+            incorrect_password(response)
+            return response
+
+        logged_in(response, user)
+        return response
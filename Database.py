@@ -1,19 +1,107 @@
-from datetime import datetime
-from db_model import app
-from dotenv import dotenv_values
-from bcrypt import gensalt, hashpw, checkpw
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, wraps
+from db_model import app, migrate
+from db_config import config, get_bool, get_float, get_int
+from db_pool import ConnectionPool
+from db_replicas import ReplicaError, ReplicaSet
+from db_hashing import PasswordHasher
+from db_cache import ChangeListener, LRUCache, ReferenceCache
+from db_metrics import Metrics, instrumented, instrumented_connection
+from db_jobs import PeriodicJob
+from db_subscriptions import (
+    ACTIVE_SUBSCRIPTIONS_SQL, EXPIRING_SUBSCRIPTIONS_SQL, LOCK_USER_SQL, SUBSCRIBE_SQL, UserSubscription
+)
+from db_throttle import LOCK_LOGIN_THROTTLE_SQL, PURGE_LOGIN_THROTTLE_SQL, TAKE_LOGIN_THROTTLE_SQL, Throttle
+from db_seed import SEED_VERSION, SUBSCRIPTION_MONTHS, SUBSCRIPTION_PRICES, USER_CATEGORIES
+from db_auth import (
+    CREDENTIAL_USERS_SQL, LOCK_CREDENTIALS_SQL, INSERT_USER_LINKS_SQL, LOGIN_PROFILE_EMAIL_SQL, LOGIN_PROFILE_PHONE_SQL,
+    LOGIN_PROFILE_EMAIL_ID_SQL, LOGIN_PROFILE_PHONE_ID_SQL, REMOVE_UNCONFIRMED_SQL,
+    CONFIRM_EMAIL_SQL, CONFIRM_PHONE_SQL, USER_PROFILES_SQL, LINKED_CREDENTIALS_SQL,
+    check_registration_format, check_registration, registered, credential_kind, not_registered,
+    incorrect_password, throttled, logged_in, profile
+)
+from db_export import EXPORT_USERS_SQL, write_csv, write_jsonl
+from db_import import (
+    COPY_STAGING_SQL, CREATE_STAGING_SQL, MERGE_SQL, REJECT_SQL, CopyStream, check_record, read_csv, read_jsonl
+)
+from db_listing import decode_cursor, encode_cursor, like_prefix, list_users_sql
+from db_links import (
+    ARCHIVE_LINKS_SQL, COUNT_ORPHANS_SQL, REMOVE_CATEGORY_SQL, REMOVE_DEVICE_SQL, REMOVE_EMAIL_SQL, REMOVE_PHONE_SQL,
+    REMOVE_SUBSCRIPTION_SQL, SWEEP_ORPHANS_SQL
+)
+import logging
+import threading
+import time
+import weakref
 import re
 
 
+logger = logging.getLogger(__name__)
+
+# Advisory lock held while one process migrates and seeds the database
+MIGRATION_LOCK_ID = 7245301
+# Seconds between attempts to take the migration lock
+MIGRATION_LOCK_POLL = 0.5
+
+
 class DatabaseMeta(type):
     _instances = {}
+    # Held while the instance is created, so concurrent first calls do not each build one with its own pool
+    _lock = threading.Lock()
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            cls._instances[cls] = super(DatabaseMeta, cls).__call__(*args, **kwargs)
+            with cls._lock:
+                if cls not in cls._instances:
+                    cls._instances[cls] = super(DatabaseMeta, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
 
+# Run a public method on a connection borrowed from the pool
+def pooled(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.connection():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# Run a read-only helper on a replica in sync with the primary, or on the primary when none is or the replica fails.
+# Inside an open connection the helper runs on that connection, so it sees the caller's own writes.
+def replica_read(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            with self.connection(read_only=True):
+                return method(self, *args, **kwargs)
+        except ReplicaError:
+            with self.connection():
+                return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# Text for PREPARE of a query written with %s or %(name)s placeholders, and the order of its named parameters
+@lru_cache(maxsize=None)
+def prepared_form(query: str):
+    names = []
+    positions = {}
+
+    def placeholder(match):
+        name = match.group(1)
+        if name is None:
+            names.append(None)
+            return "$" + str(len(names))
+        if name not in positions:
+            names.append(name)
+            positions[name] = len(names)
+        return "$" + str(positions[name])
+
+    return re.sub(r"%\((\w+)\)s|%s", placeholder, query), tuple(names)
+
+
 class Database(metaclass=DatabaseMeta):
     def __init__(self):
         # Check if psycopg2 is installed
@@ -28,224 +116,881 @@ class Database(metaclass=DatabaseMeta):
         except ImportError:
             raise ImportError("Please install flask_migrate: 'pip install flask_migrate'")
 
-        with app.app_context():
-            upgrade()
+        # Calls, latency, round trips and commits per operation, statements slower than DB_SLOW_QUERY_MS are logged
+        self.metrics = Metrics(slow_query_seconds=get_float("DB_SLOW_QUERY_MS", 200.0) / 1000)
+        connection_factory = instrumented_connection(self.metrics)
 
-        # Load environment variables
-        config = dotenv_values(".env")
-        self.db = psycopg2.connect(
-            host=config["DB_HOST"],
-            database=config["DB_DATABASE"],
-            user=config["DB_USER"],
-            password=config["DB_PASSWORD"]
-        )
-        self.cursor = self.db.cursor()
+        # Connect using the environment variables, each call borrows its own connection and cursor
+        def connect():
+            return psycopg2.connect(
+                host=config["DB_HOST"],
+                port=config.get("DB_PORT") or None,
+                database=config["DB_DATABASE"],
+                user=config["DB_USER"],
+                password=config["DB_PASSWORD"],
+                connection_factory=connection_factory
+            )
 
-        # TODO: Remove unconfirmed users
-        # self.remove_unconfirmed()
+        self.__connect = connect
 
-        # Populate database with initial data
-        self.__populate()
+        # Without DB_POOL a single connection is shared, but calls no longer interleave on it
+        if get_bool("DB_POOL", False):
+            self.pool = ConnectionPool(
+                connect,
+                min_size=get_int("DB_POOL_MIN", 1),
+                max_size=get_int("DB_POOL_MAX", 10),
+                timeout=get_float("DB_POOL_TIMEOUT", 30.0),
+                max_idle=get_float("DB_POOL_MAX_IDLE", 600.0),
+                check_idle=get_float("DB_POOL_CHECK_IDLE", 30.0)
+            )
+        else:
+            self.pool = ConnectionPool(connect, min_size=1, max_size=1)
+        self.__local = threading.local()
 
-    # Private methods
-    # Insert new user
-    def __insert_user(self, first_name, last_name, password_hash, birth_date=None):
-        self.cursor.execute(
-            "INSERT INTO app_user (first_name, last_name, password_hash, birth_date, created_at, confirmed, active) "
-            "VALUES (%s, %s, %s, %s, %s, FALSE, TRUE)",
-            (first_name, last_name, password_hash, birth_date, datetime.now())
+        # Login and availability lookups go to the comma separated DB_REPLICAS DSNs, round-robin, while their lag is
+        # below DB_REPLICA_MAX_LAG seconds, and to the primary otherwise
+        self.replicas = None
+        self.__replica_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+        dsns = [dsn.strip() for dsn in (config.get("DB_REPLICAS") or "").split(",") if dsn.strip()]
+        if dsns:
+            self.replicas = ReplicaSet(
+                [
+                    ConnectionPool(
+                        lambda dsn=dsn: psycopg2.connect(dsn, connection_factory=connection_factory),
+                        min_size=0,
+                        max_size=get_int("DB_POOL_MAX", 10) if get_bool("DB_POOL", False) else 1,
+                        timeout=get_float("DB_REPLICA_TIMEOUT", 1.0),
+                        max_idle=get_float("DB_POOL_MAX_IDLE", 600.0),
+                        check_idle=get_float("DB_POOL_CHECK_IDLE", 30.0)
+                    )
+                    for dsn in dsns
+                ],
+                max_lag=get_float("DB_REPLICA_MAX_LAG", 5.0),
+                check_interval=get_float("DB_REPLICA_CHECK_INTERVAL", 1.0),
+                retry_after=get_float("DB_REPLICA_RETRY", 30.0)
+            )
+
+        # Hot statements are prepared once per connection, turn off behind transaction pooling proxies
+        self.prepare_statements = get_bool("DB_PREPARE", True)
+        self.__prepared = weakref.WeakKeyDictionary()
+
+        # Hash and check passwords on a bounded worker pool instead of the request thread
+        self.hasher = PasswordHasher(
+            executor=config.get("HASH_EXECUTOR") or "process",
+            workers=get_int("HASH_WORKERS", 0) or None,
+            max_pending=get_int("HASH_MAX_PENDING", 0) or None,
+            rounds=get_int("HASH_ROUNDS", 12)
         )
-        self.db.commit()
 
-    def __get_user_id(self, first_name, last_name, password_hash):
-        self.cursor.execute(
-            "SELECT id FROM app_user WHERE first_name = %s AND last_name = %s AND password_hash = %s",
-            (first_name, last_name, password_hash)
+        # Login attempts per credential and per caller supplied client key, checked before any query or hashing.
+        # LOGIN_THROTTLE=memory keeps the buckets in this process, postgres shares them between workers, off disables.
+        mode = (config.get("LOGIN_THROTTLE") or "memory").lower()
+        self.throttle = None if mode == "off" else Throttle(
+            per_minute=get_float("LOGIN_THROTTLE_PER_MINUTE", 10.0),
+            burst=get_int("LOGIN_THROTTLE_BURST", 5),
+            client_per_minute=get_float("LOGIN_THROTTLE_CLIENT_PER_MINUTE", 300.0),
+            client_burst=get_int("LOGIN_THROTTLE_CLIENT_BURST", 60),
+            max_keys=get_int("LOGIN_THROTTLE_MAX_KEYS", 100000)
         )
-        return self.cursor.fetchone()
+        self.shared_throttle = mode == "postgres"
 
-    # Insert new email
-    def __insert_email(self, email_address):
-        self.cursor.execute(
-            "INSERT INTO email_address (email_address, created_at) "
-            "VALUES (%s, %s) ON CONFLICT DO NOTHING",
-            (email_address, datetime.now())
+        # Email addresses, phone numbers and devices mapped to (credential id, owning user id)
+        self.credentials = LRUCache(
+            max_size=get_int("CREDENTIAL_CACHE_SIZE", 10000),
+            ttl=get_float("CREDENTIAL_CACHE_TTL", 300.0)
         )
-        self.db.commit()
 
-    # Get email address id
-    def __get_email_id(self, email_address):
-        self.cursor.execute(
-            "SELECT id FROM email_address WHERE email_address = %s",
-            (email_address,)
+        # Reference tables are kept in memory and reloaded when PostgreSQL notifies a change
+        self.reference = ReferenceCache(self.__load_reference)
+
+        # Migrate and populate the database only when it is behind the code, DB_AUTO_MIGRATE=false skips both
+        if get_bool("DB_AUTO_MIGRATE", True):
+            self.__prepare()
+
+        self.listener = None
+        if get_bool("REFERENCE_LISTEN", True):
+            self.listener = ChangeListener(connect, "reference_data_changed", self.reference.invalidate)
+            self.listener.start()
+
+        # Maintenance jobs, each runs on its own thread every interval seconds, an interval of 0 disables it
+        self.jobs = {}
+        self.__schedule("remove_unconfirmed", get_float("UNCONFIRMED_CLEANUP_INTERVAL", 0.0), self.remove_unconfirmed)
+        self.__schedule("archive_removed_links", get_float("LINK_ARCHIVE_INTERVAL", 0.0), self.archive_removed_links)
+        self.__schedule("sweep_orphans", get_float("ORPHAN_SWEEP_INTERVAL", 0.0), self.sweep_orphans)
+        if self.shared_throttle:
+            self.__schedule(
+                "purge_login_throttle", get_float("LOGIN_THROTTLE_PURGE_INTERVAL", 300.0), self.purge_login_throttle
+            )
+
+    # Connection of the current call
+    @property
+    def db(self):
+        if getattr(self.__local, "db", None) is None:
+            raise RuntimeError("No connection borrowed, use 'with Database().connection():'")
+        return self.__local.db
+
+    # Cursor of the current call
+    @property
+    def cursor(self):
+        if getattr(self.__local, "cursor", None) is None:
+            raise RuntimeError("No connection borrowed, use 'with Database().connection():'")
+        return self.__local.cursor
+
+    # Borrow a connection and cursor for the current thread, nested calls reuse the outer one.
+    # With read_only a replica connection is borrowed when one is usable, its failures raise ReplicaError.
+    @contextmanager
+    def connection(self, read_only: bool = False):
+        if getattr(self.__local, "db", None) is not None:
+            yield self.__local.db
+            return
+
+        replica, db = self.replicas.getconn() if read_only and self.replicas is not None else (None, None)
+        if db is None:
+            db = self.pool.getconn()
+        self.__local.db = db
+        self.__local.cursor = None
+        broken = False
+        try:
+            self.__local.cursor = db.cursor()
+            yield db
+        except Exception as error:
+            if replica is not None and isinstance(error, self.__replica_errors):
+                # The replica connection is discarded, the caller may run the query again on the primary
+                broken = True
+                self.replicas.mark_down(replica)
+                raise ReplicaError("Query failed on replica %d" % replica) from error
+            broken = bool(db.closed)
+            if not broken:
+                db.rollback()
+            raise
+        finally:
+            if self.__local.cursor is not None:
+                self.__local.cursor.close()
+            self.__local.cursor = None
+            self.__local.db = None
+            if broken:
+                # Statements prepared on a discarded connection are gone with it, its replacement prepares them again
+                self.__prepared.pop(db, None)
+            if replica is None:
+                self.pool.putconn(db, discard=broken)
+            else:
+                self.replicas.putconn(replica, db, discard=broken)
+
+    # Pool size and saturation counters
+    def pool_stats(self) -> dict:
+        return self.pool.stats()
+
+    # Password hashing queue depth and timing counters
+    def hash_stats(self) -> dict:
+        return self.hasher.stats()
+
+    # Credential cache hit and miss counters
+    def credential_stats(self) -> dict:
+        return self.credentials.stats()
+
+    # Reference data cache hit and miss counters
+    def reference_stats(self) -> dict:
+        return self.reference.stats()
+
+    # Replica read, fallback and lag counters, None without DB_REPLICAS
+    def replica_stats(self):
+        return self.replicas.stats() if self.replicas is not None else None
+
+    # Allowed, rejected and evicted login attempt counters, None with LOGIN_THROTTLE=off
+    def throttle_stats(self):
+        return self.throttle.stats() if self.throttle is not None else None
+
+    # Run and failure counters of the maintenance jobs
+    def job_stats(self) -> dict:
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+    # Stop the maintenance jobs
+    def stop_jobs(self):
+        for job in self.jobs.values():
+            job.stop()
+
+    # Per operation counters, latency histograms and slow queries as a plain dict
+    def metrics_stats(self) -> dict:
+        return self.metrics.as_dict()
+
+    # Per operation metrics in the Prometheus text format
+    def metrics_prometheus(self) -> str:
+        return self.metrics.prometheus()
+
+    # Private methods
+    # Start a maintenance job unless its interval is 0
+    def __schedule(self, name: str, interval: float, function):
+        if interval > 0:
+            self.jobs[name] = PeriodicJob(name, interval, function)
+            self.jobs[name].start()
+
+    # Run a hot statement as a named server-side prepared statement, prepared on first use on each connection
+    def __execute(self, name: str, query: str, params):
+        if not self.prepare_statements:
+            self.cursor.execute(query, params)
+            return
+
+        text, names = prepared_form(query)
+        prepared = self.__prepared.setdefault(self.db, set())
+        if name not in prepared:
+            self.cursor.execute("PREPARE " + name + " AS " + text)
+            prepared.add(name)
+
+        values = [params[key] for key in names] if isinstance(params, dict) else list(params)
+        if values:
+            self.cursor.execute("EXECUTE " + name + " (" + ", ".join(["%s"] * len(values)) + ")", values)
+        else:
+            self.cursor.execute("EXECUTE " + name)
+
+    # Upgrade the schema and seed reference data only when the stored versions are behind the code
+    @instrumented
+    def __prepare(self):
+        from alembic.script import ScriptDirectory
+        from flask_migrate import upgrade
+
+        head = ScriptDirectory.from_config(migrate.get_config()).get_current_head()
+
+        with self.connection():
+            version, seeded = self.__get_versions()
+            self.db.commit()
+            if version == head and seeded is not None and seeded >= SEED_VERSION:
+                return
+
+            # Another process may be migrating, wait for it and check again. A session blocked in pg_advisory_lock
+            # holds a snapshot that CREATE INDEX CONCURRENTLY in the holder's upgrade waits for, a wait PostgreSQL
+            # cannot see as a deadlock, so the lock is polled with no transaction open in between.
+            while True:
+                self.cursor.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+                locked = self.cursor.fetchone()[0]
+                self.db.commit()
+                if locked:
+                    break
+                time.sleep(MIGRATION_LOCK_POLL)
+            try:
+                version, seeded = self.__get_versions()
+                self.db.commit()
+                if version != head:
+                    with app.app_context():
+                        upgrade()
+                # A newer release may have seeded already, its data is kept
+                if seeded is None or seeded < SEED_VERSION:
+                    # Reference data and its version are committed together
+                    self.__populate()
+                    self.cursor.execute(
+                        "INSERT INTO seed_state (name, version, updated_at) VALUES ('reference', %s, %s) "
+                        "ON CONFLICT (name) DO UPDATE SET version = EXCLUDED.version, updated_at = EXCLUDED.updated_at",
+                        (SEED_VERSION, datetime.now())
+                    )
+                    self.db.commit()
+            finally:
+                self.db.rollback()
+                self.cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                self.db.commit()
+
+    # Read the subscription_type and category tables for the reference cache
+    @instrumented
+    def __load_reference(self):
+        with self.connection():
+            self.cursor.execute(
+                "SELECT id, subscription_type_name, months, cost FROM subscription_type ORDER BY id"
+            )
+            subscription_types = self.cursor.fetchall()
+            self.cursor.execute("SELECT id, category_name FROM category ORDER BY id")
+            categories = self.cursor.fetchall()
+            self.db.commit()
+        return subscription_types, categories
+
+    # Return the applied migration and the version of the seeded reference data in one query
+    @instrumented
+    def __get_versions(self):
+        from psycopg2 import errors
+
+        try:
+            self.cursor.execute(
+                "SELECT (SELECT version_num FROM alembic_version), "
+                "(SELECT version FROM seed_state WHERE name = 'reference')"
+            )
+            return self.cursor.fetchone()
+        except (errors.UndefinedTable, errors.UndefinedColumn):
+            # Fresh database or one migrated before seed_state or its version existed
+            self.db.rollback()
+            return None, None
+
+    # Get password hash and profile (active email, phone number and device) of the user linked to a credential
+    @instrumented
+    @replica_read
+    def __get_login_profile(self, credential, kind: str):
+        self.__execute(
+            "login_profile_" + kind,
+            LOGIN_PROFILE_EMAIL_SQL if kind == "email" else LOGIN_PROFILE_PHONE_SQL,
+            {"credential": credential, "now": datetime.now()}
         )
         return self.cursor.fetchone()
 
-    # Get phone number id
-    def __get_phone_id(self, phone_number):
-        self.cursor.execute(
-            "SELECT id FROM phone_number WHERE phone_number = %s",
-            (phone_number,)
+    # Same profile for a cached credential, only its link to the cached user is checked
+    @instrumented
+    @replica_read
+    def __get_login_profile_by_id(self, kind: str, credential_id, user_id):
+        self.__execute(
+            "login_profile_" + kind + "_id",
+            LOGIN_PROFILE_EMAIL_ID_SQL if kind == "email" else LOGIN_PROFILE_PHONE_ID_SQL,
+            {"credential_id": credential_id, "user_id": user_id, "now": datetime.now()}
         )
         return self.cursor.fetchone()
 
-    # Get device id
-    def __get_device_id(self, serial_number):
-        self.cursor.execute(
-            "SELECT id FROM device WHERE device_sn = %s",
-            (serial_number,)
+    # Rows of USER_PROFILES_SQL for a list of user ids
+    @instrumented
+    @replica_read
+    def __get_user_profiles(self, user_ids: list):
+        self.__execute("user_profiles", USER_PROFILES_SQL, {"user_ids": user_ids, "now": datetime.now()})
+        return self.cursor.fetchall()
+
+    # One page of list_users rows for the filters in params
+    @instrumented
+    @replica_read
+    def __list_users_page(self, params: dict):
+        filters = [name for name in ("active", "confirmed", "category_id", "email_prefix", "phone_prefix")
+                   if params[name] is not None]
+        if params["after_id"] is not None:
+            filters.append("after")
+        self.cursor.execute(list_users_sql(filters), params)
+        return self.cursor.fetchall()
+
+    # Return the users actively linked to an email address, phone number and device in one round trip
+    @instrumented
+    @replica_read
+    def __get_credential_users(self, email_address, phone_number, serial_number):
+        self.__execute(
+            "credential_users",
+            CREDENTIAL_USERS_SQL,
+            {
+                "email_address": email_address,
+                "phone_number": phone_number,
+                "device_sn": serial_number,
+                "now": datetime.now()
+            }
         )
         return self.cursor.fetchone()
 
-    # Insert new phone number
-    def __insert_phone(self, phone_number):
-        self.cursor.execute(
-            "INSERT INTO phone_number (phone_number, created_at) "
-            "VALUES (%s, %s) ON CONFLICT DO NOTHING",
-            (phone_number, datetime.now())
-        )
-        self.db.commit()
+    # Get or create and lock the email, phone number and device, then insert the user and link them
+    @instrumented
+    def __insert_user_links(
+            self,
+            first_name,
+            last_name,
+            password_hash,
+            birth_date,
+            email_address,
+            phone_number,
+            device_name,
+            serial_number
+    ):
+        params = {
+            "first_name": first_name,
+            "last_name": last_name,
+            "password_hash": password_hash,
+            "birth_date": birth_date,
+            "email_address": email_address,
+            "phone_number": phone_number,
+            "device_name": device_name,
+            "device_sn": serial_number,
+            "now": datetime.now()
+        }
+        self.__execute("lock_credentials", LOCK_CREDENTIALS_SQL, params)
+        params["email_id"], params["phone_id"], params["device_id"] = self.cursor.fetchone()
+        self.__execute("insert_user_links", INSERT_USER_LINKS_SQL, params)
+        return self.cursor.fetchone()
 
-    # Insert new device
-    def __insert_device(self, serial_number, device_name):
+    # Return which email addresses, phone numbers and device serials of a batch are already linked to a user
+    @instrumented
+    @replica_read
+    def __get_taken_credentials(self, email_addresses, phone_numbers, serial_numbers):
         self.cursor.execute(
-            "INSERT INTO device (device_name, device_sn, created_at) "
-            "VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
-            (device_name, serial_number, datetime.now())
+            "SELECT 'email', email_address.email_address FROM user_email "
+            "JOIN email_address ON email_address.id = user_email.email_id "
+            "WHERE email_address.email_address = ANY(%(email_addresses)s) AND user_email.removed_at > %(now)s "
+            "UNION ALL "
+            "SELECT 'phone', phone_number.phone_number FROM user_phone "
+            "JOIN phone_number ON phone_number.id = user_phone.phone_id "
+            "WHERE phone_number.phone_number = ANY(%(phone_numbers)s) AND user_phone.removed_at > %(now)s "
+            "UNION ALL "
+            "SELECT 'device', device.device_sn FROM user_device "
+            "JOIN device ON device.id = user_device.device_id "
+            "WHERE device.device_sn = ANY(%(device_sns)s) AND user_device.removed_at > %(now)s",
+            {
+                "email_addresses": list(email_addresses),
+                "phone_numbers": list(phone_numbers),
+                "device_sns": list(serial_numbers),
+                "now": datetime.now()
+            }
         )
-        self.db.commit()
+        taken = {"email": set(), "phone": set(), "device": set()}
+        for kind, value in self.cursor.fetchall():
+            taken[kind].add(value)
+        return taken
 
-    # Return user's for a given active email address
-    def __get_user_id_email(self, email_address):
-        self.cursor.execute(
-            "SELECT user_id FROM user_email "
-            "WHERE email_id = %s AND removed_at > %s",
-            (self.__get_email_id(email_address), datetime.now())
-        )
-        return self.cursor.fetchall()
+    # Insert a batch of users with multi-row statements, returning (user, email, phone, device) ids per row, None for
+    # rows not inserted, and the (email, phone, device) in use flags of each row
+    @instrumented
+    def __insert_users_batch(self, rows, password_hashes, page_size):
+        from psycopg2.extras import execute_values
 
-    # Return user's for a given active phone number
-    def __get_user_id_phone(self, phone_number):
-        self.cursor.execute(
-            "SELECT user_id FROM user_phone "
-            "WHERE phone_id = %s AND removed_at > %s",
-            (self.__get_phone_id(phone_number), datetime.now())
-        )
-        return self.cursor.fetchall()
+        now = datetime.now()
+        # Sorted so concurrent batches lock the unique index entries in the same order
+        email_addresses = sorted({row["email_address"] for row in rows})
+        phone_numbers = sorted({row["phone_number"] for row in rows})
+        devices = sorted((row["device_sn"], row["device_name"]) for row in rows)
 
-    # Return devices associated with a user device
-    def __get_user_id_device(self, serial_number):
-        self.cursor.execute(
-            "SELECT user_id FROM user_device "
-            "WHERE device_id = %s AND removed_at > %s",
-            (self.__get_device_id(serial_number), datetime.now())
-        )
-        return self.cursor.fetchall()
+        # Get or create the credentials, the no-op updates lock existing rows until commit like LOCK_CREDENTIALS_SQL
+        email_ids = dict(execute_values(
+            self.cursor,
+            "INSERT INTO email_address (email_address, created_at) VALUES %s "
+            "ON CONFLICT (email_address) DO UPDATE SET email_address = EXCLUDED.email_address "
+            "RETURNING email_address, id",
+            [(email_address, now) for email_address in email_addresses],
+            page_size=page_size,
+            fetch=True
+        ))
+        phone_ids = dict(execute_values(
+            self.cursor,
+            "INSERT INTO phone_number (phone_number, created_at) VALUES %s "
+            "ON CONFLICT (phone_number) DO UPDATE SET phone_number = EXCLUDED.phone_number "
+            "RETURNING phone_number, id",
+            [(phone_number, now) for phone_number in phone_numbers],
+            page_size=page_size,
+            fetch=True
+        ))
+        device_ids = dict(execute_values(
+            self.cursor,
+            "INSERT INTO device (device_name, device_sn, created_at) VALUES %s "
+            "ON CONFLICT (device_sn) DO UPDATE SET device_sn = EXCLUDED.device_sn "
+            "RETURNING device_sn, id",
+            [(device_name, device_sn, now) for device_sn, device_name in devices],
+            page_size=page_size,
+            fetch=True
+        ))
 
-    # Connect user to email address
-    def __insert_user_email(self, user_id, email_id):
-        self.cursor.execute(
-            "INSERT INTO user_email (user_id, email_id, created_at, confirmed, removed_at) "
-            "VALUES (%s, %s, %s, FALSE, '2100-01-01') ON CONFLICT DO NOTHING",
-            (user_id, email_id, datetime.now())
-        )
-        self.db.commit()
+        # Credentials linked since the availability check, which may have read a lagging replica, are reported as
+        # in use and their rows skipped
+        self.cursor.execute(LINKED_CREDENTIALS_SQL, {
+            "email_ids": list(email_ids.values()),
+            "phone_ids": list(phone_ids.values()),
+            "device_ids": list(device_ids.values()),
+            "now": now
+        })
+        linked = {"email": set(), "phone": set(), "device": set()}
+        for kind, credential_id in self.cursor.fetchall():
+            linked[kind].add(credential_id)
+        in_use = [
+            (
+                email_ids[row["email_address"]] in linked["email"],
+                phone_ids[row["phone_number"]] in linked["phone"],
+                device_ids[row["device_sn"]] in linked["device"]
+            )
+            for row in rows
+        ]
+        free = [index for index, flags in enumerate(in_use) if not any(flags)]
+        ids = [None] * len(rows)
+        if not free:
+            return ids, in_use
 
-    # Connect user to phone number
-    def __insert_user_phone(self, user_id, phone_id):
+        # Reserve the user ids up front so the link rows can be built without reading them back
         self.cursor.execute(
-            "INSERT INTO user_phone (user_id, phone_id, created_at, confirmed, removed_at) "
-            "VALUES (%s, %s, %s, FALSE, '2100-01-01') ON CONFLICT DO NOTHING",
-            (user_id, phone_id, datetime.now())
+            "SELECT nextval(pg_get_serial_sequence('app_user', 'id')) FROM generate_series(1, %s)",
+            (len(free),)
         )
-        self.db.commit()
+        user_ids = [user_id for user_id, in self.cursor.fetchall()]
 
-    # Connect user to device
-    def __insert_user_device(self, user_id, device_id):
-        self.cursor.execute(
-            "INSERT INTO user_device (user_id, device_id, created_at, removed_at) "
-            "VALUES (%s, %s, %s, '2100-01-01') ON CONFLICT DO NOTHING",
-            (user_id, device_id, datetime.now())
+        execute_values(
+            self.cursor,
+            "INSERT INTO app_user (id, first_name, last_name, password_hash, birth_date, created_at, confirmed, active) "
+            "VALUES %s",
+            [
+                (user_id, rows[index]["first_name"], rows[index]["last_name"], password_hashes[index],
+                 rows[index]["birth_date"], now, False, True)
+                for user_id, index in zip(user_ids, free)
+            ],
+            page_size=page_size
         )
-        self.db.commit()
 
-    # Add subscription types with months and prices
-    def __add_categories(self, name: str, prices: list):
-        self.cursor.execute(
-            "INSERT INTO subscription_type (subscription_type_name, months, cost, created_at) "
-            "VALUES (%s, %s, %s, %s) "
-            "ON CONFLICT DO NOTHING",
-            (name + "-1", 1, prices[0], datetime.now())
+        for user_id, index in zip(user_ids, free):
+            row = rows[index]
+            ids[index] = (
+                user_id, email_ids[row["email_address"]], phone_ids[row["phone_number"]], device_ids[row["device_sn"]]
+            )
+        links = [ids[index] for index in free]
+        execute_values(
+            self.cursor,
+            "INSERT INTO user_email (user_id, email_id, created_at, confirmed, removed_at) VALUES %s",
+            [(user_id, email_id, now, False, "2100-01-01") for user_id, email_id, _, _ in links],
+            page_size=page_size
         )
-        self.cursor.execute(
-            "INSERT INTO subscription_type (subscription_type_name, months, cost, created_at) "
-            "VALUES (%s, %s, %s, %s) "
-            "ON CONFLICT DO NOTHING",
-            (name + "-3", 3, prices[1], datetime.now())
+        execute_values(
+            self.cursor,
+            "INSERT INTO user_phone (user_id, phone_id, created_at, confirmed, removed_at) VALUES %s",
+            [(user_id, phone_id, now, False, "2100-01-01") for user_id, _, phone_id, _ in links],
+            page_size=page_size
         )
-        self.cursor.execute(
-            "INSERT INTO subscription_type (subscription_type_name, months, cost, created_at) "
-            "VALUES (%s, %s, %s, %s) O"
-            "N CONFLICT DO NOTHING",
-            (name + "-6", 6, prices[2], datetime.now())
+        execute_values(
+            self.cursor,
+            "INSERT INTO user_device (user_id, device_id, created_at, removed_at) VALUES %s",
+            [(user_id, device_id, now, "2100-01-01") for user_id, _, _, device_id in links],
+            page_size=page_size
         )
-        self.db.commit()
+        return ids, in_use
 
-    def __add_user_categories(self, name: str):
-        self.cursor.execute(
-            "INSERT INTO category (category_name, created_at) "
-            "VALUES (%s, %s) "
-            "ON CONFLICT DO NOTHING",
-            (name, datetime.now())
+    # Delete one batch of unconfirmed users after an id, returning how many were deleted and the last id
+    @instrumented
+    def __remove_unconfirmed_batch(self, after: int, cutoff: datetime, batch_size: int):
+        with self.connection():
+            self.cursor.execute(
+                REMOVE_UNCONFIRMED_SQL, {"after": after, "cutoff": cutoff, "batch_size": batch_size}
+            )
+            removed, last_id = self.cursor.fetchone()
+            self.db.commit()
+        return removed, last_id
+
+    # Move the active link of a user to its history table, returning whether a link was moved
+    @instrumented
+    def __move_link(self, name: str, query: str, user_id: int, value) -> bool:
+        with self.connection():
+            self.__execute(name, query, {"user_id": user_id, "value": value, "now": datetime.now()})
+            moved = self.cursor.fetchone()
+            self.db.commit()
+        return moved is not None
+
+    # Move one batch of links of a table whose removal time has passed, returning how many were moved
+    @instrumented
+    def __archive_links_batch(self, table: str, now: datetime, batch_size: int) -> int:
+        with self.connection():
+            self.cursor.execute(ARCHIVE_LINKS_SQL[table], {"now": now, "batch_size": batch_size})
+            moved = self.cursor.rowcount
+            self.db.commit()
+        return moved
+
+    # Delete one batch of orphaned rows of a credential table after an id, returning how many and the last id
+    @instrumented
+    def __sweep_orphans_batch(self, table: str, after: int, cutoff: datetime, batch_size: int):
+        with self.connection():
+            self.cursor.execute(
+                SWEEP_ORPHANS_SQL[table], {"after": after, "cutoff": cutoff, "batch_size": batch_size}
+            )
+            removed, last_id = self.cursor.fetchone()
+            self.db.commit()
+        return removed, last_id
+
+    # Take a login attempt token for a credential and client key, returning 0 when allowed or the seconds to wait
+    @instrumented
+    def __throttle(self, credential_key: str, client_key) -> float:
+        if self.throttle is None:
+            return 0.0
+        if not self.shared_throttle:
+            return self.throttle.acquire(credential_key, client_key)
+
+        # Both buckets are locked and checked before either loses a token, so a throttled client key cannot drain
+        # the buckets of the credentials it tries
+        checks = self.throttle.shared_checks(credential_key, client_key)
+        keys = [key for key, _, _ in checks]
+        with self.connection():
+            self.__execute("login_throttle_lock", LOCK_LOGIN_THROTTLE_SQL, {"keys": keys})
+            wait = self.throttle.shared_wait(checks, dict(self.cursor.fetchall()))
+            if wait > 0:
+                self.db.rollback()
+            else:
+                self.__execute("login_throttle_take", TAKE_LOGIN_THROTTLE_SQL, {
+                    "keys": keys, "intervals": [interval for _, interval, _ in checks]
+                })
+                self.db.commit()
+        self.throttle.count(wait <= 0)
+        return wait
+
+    # Rows of ACTIVE_SUBSCRIPTIONS_SQL for a list of user ids
+    @instrumented
+    def __get_active_subscriptions(self, user_ids: list):
+        with self.connection():
+            self.__execute(
+                "active_subscriptions", ACTIVE_SUBSCRIPTIONS_SQL, {"user_ids": user_ids, "now": datetime.now()}
+            )
+            rows = self.cursor.fetchall()
+            self.db.commit()
+        return rows
+
+    # Names of category ids, from the reference cache
+    def __category_names(self, category_ids) -> list:
+        categories = (self.get_category_by_id(category_id) for category_id in category_ids)
+        return [category.name for category in categories if category is not None]
+
+    # UserSubscription of a (user id, subscription id, subscription type id, valid from, valid until) row
+    def __user_subscription(self, row) -> UserSubscription:
+        user_id, subscription_id, subscription_type_id, valid_from, valid_until = row
+        return UserSubscription(
+            user_id, subscription_id, self.get_subscription_type_by_id(subscription_type_id), valid_from, valid_until
         )
-        self.db.commit()
 
-    # Populate database with initial data
+    # Populate database with initial data, one multi-row upsert per table
+    @instrumented
     def __populate(self):
-        self.__add_categories("G", [234, 594, 972])
-        self.__add_categories("ST", [164, 416, 680])
-        self.__add_categories("E", [117, 297, 486])
-        self.__add_categories("AE", [234, 594, 972])
-        self.__add_categories("FM", [140, 356, 583])
-        self.__add_categories("FC", [117, 297, 483])
-        self.__add_categories("DI", [164, 416, 680])
-        self.__add_categories("DM", [164, 416, 680])
-        self.__add_user_categories("general")
-        self.__add_user_categories("student")
-        self.__add_user_categories("elev")
-        self.__add_user_categories("agent economic")
-        self.__add_user_categories("familie monoparentala")
-        self.__add_user_categories("familie cu multi copii")
-        self.__add_user_categories("personal didactic")
-        self.__add_user_categories("personal medical")
+        from psycopg2.extras import execute_values
 
-    # Public methods
-    # Remove unconfirmed users
-    def remove_unconfirmed(self):
-        self.cursor.execute(
-            "DELETE FROM app_user WHERE confirmed = FALSE"
+        now = datetime.now()
+        # Changed months or prices are updated, unchanged rows are left untouched
+        execute_values(
+            self.cursor,
+            "INSERT INTO subscription_type (subscription_type_name, months, cost, created_at) VALUES %s "
+            "ON CONFLICT (subscription_type_name) DO UPDATE SET months = EXCLUDED.months, cost = EXCLUDED.cost "
+            "WHERE (subscription_type.months, subscription_type.cost) IS DISTINCT FROM (EXCLUDED.months, EXCLUDED.cost)",
+            [
+                (name + "-" + str(months), months, cost, now)
+                for name, prices in SUBSCRIPTION_PRICES.items()
+                for months, cost in zip(SUBSCRIPTION_MONTHS, prices)
+            ],
+            page_size=len(SUBSCRIPTION_PRICES) * len(SUBSCRIPTION_MONTHS)
+        )
+        execute_values(
+            self.cursor,
+            "INSERT INTO category (category_name, created_at) VALUES %s ON CONFLICT (category_name) DO NOTHING",
+            [(name, now) for name in USER_CATEGORIES],
+            page_size=len(USER_CATEGORIES)
         )
-        self.db.commit()
+
+    # Public methods
+    # Remove users registered before the grace period that confirmed neither their email address nor phone number.
+    # Each batch is its own short transaction, progress is called with the running totals after every batch.
+    @instrumented
+    def remove_unconfirmed(
+            self,
+            grace: timedelta = None,
+            batch_size: int = None,
+            pause: float = None,
+            progress=None
+    ) -> dict:
+        if grace is None:
+            grace = timedelta(hours=get_float("UNCONFIRMED_GRACE_HOURS", 24.0))
+        if batch_size is None:
+            batch_size = get_int("UNCONFIRMED_BATCH_SIZE", 1000)
+        if pause is None:
+            pause = get_float("UNCONFIRMED_BATCH_PAUSE", 0.0)
+
+        cutoff = datetime.now() - grace
+        totals = {"removed": 0, "batches": 0, "last_id": 0}
+        try:
+            while True:
+                removed, last_id = self.__remove_unconfirmed_batch(totals["last_id"], cutoff, batch_size)
+                if not removed:
+                    break
+                totals["removed"] += removed
+                totals["batches"] += 1
+                totals["last_id"] = last_id
+                if progress is not None:
+                    progress(dict(totals))
+                if pause:
+                    # Leave room for other writers and for replicas to catch up
+                    time.sleep(pause)
+        finally:
+            # Cached credentials may point at deleted users
+            if totals["removed"]:
+                self.credentials.clear()
+
+        logger.info("Removed %d unconfirmed users in %d batches", totals["removed"], totals["batches"])
+        return totals
 
     # Confirm user's email address
+    @instrumented
+    @pooled
     def confirm_email(self, email_address):
-        self.cursor.execute(
-            "UPDATE user_email SET confirmed = TRUE "
-            "WHERE email_id = (SELECT id FROM email_address WHERE email_address = %s) AND removed_at > %s",
-            (email_address, datetime.now())
-        )
+        self.__execute("confirm_email", CONFIRM_EMAIL_SQL, (email_address, datetime.now()))
         self.db.commit()
+        self.credentials.delete(("email", email_address))
 
     # Confirm user's phone number
+    @instrumented
+    @pooled
     def confirm_phone(self, phone_number):
-        self.cursor.execute(
-            "UPDATE user_phone SET confirmed = TRUE "
-            "WHERE phone_id = (SELECT id FROM phone_number WHERE phone_number = %s) AND removed_at > %s",
-            (phone_number, datetime.now())
-        )
+        self.__execute("confirm_phone", CONFIRM_PHONE_SQL, (phone_number, datetime.now()))
         self.db.commit()
+        self.credentials.delete(("phone", phone_number))
+
+    # Remove an email address from a user, the link is moved to user_email_history
+    @instrumented
+    def remove_email(self, user_id: int, email_address: str) -> bool:
+        removed = self.__move_link("remove_email", REMOVE_EMAIL_SQL, user_id, email_address)
+        self.credentials.delete(("email", email_address))
+        return removed
+
+    # Remove a phone number from a user, the link is moved to user_phone_history
+    @instrumented
+    def remove_phone(self, user_id: int, phone_number: str) -> bool:
+        removed = self.__move_link("remove_phone", REMOVE_PHONE_SQL, user_id, phone_number)
+        self.credentials.delete(("phone", phone_number))
+        return removed
+
+    # Remove a device from a user, the link is moved to user_device_history
+    @instrumented
+    def remove_device(self, user_id: int, device_sn: str) -> bool:
+        return self.__move_link("remove_device", REMOVE_DEVICE_SQL, user_id, device_sn)
+
+    # Remove a category (by name) from a user, the link is moved to user_category_history
+    @instrumented
+    def remove_category(self, user_id: int, category: str) -> bool:
+        category = self.get_category(category)
+        if category is None:
+            return False
+        return self.__move_link("remove_category", REMOVE_CATEGORY_SQL, user_id, category.id)
+
+    # Remove a subscription from a user, the link is moved to user_subscription_history
+    @instrumented
+    def remove_subscription(self, user_id: int, subscription_id: int) -> bool:
+        return self.__move_link("remove_subscription", REMOVE_SUBSCRIPTION_SQL, user_id, subscription_id)
+
+    # Move links whose scheduled removal time has passed to the history tables, returning the count per table
+    @instrumented
+    def archive_removed_links(self, batch_size: int = None) -> dict:
+        if batch_size is None:
+            batch_size = get_int("LINK_ARCHIVE_BATCH_SIZE", 1000)
+
+        now = datetime.now()
+        archived = {}
+        for table in ARCHIVE_LINKS_SQL:
+            archived[table] = 0
+            while True:
+                moved = self.__archive_links_batch(table, now, batch_size)
+                archived[table] += moved
+                if moved < batch_size:
+                    break
+
+        # Cached registrations may count an archived credential as taken
+        if archived["user_email"] or archived["user_phone"] or archived["user_device"]:
+            self.credentials.clear()
+        return archived
+
+    # Delete email addresses, phone numbers and devices created before the grace period that no active or removed
+    # link references, in batches of one short transaction each. With dry_run they are only counted.
+    # Returns the count per table.
+    @instrumented
+    def sweep_orphans(
+            self,
+            grace: timedelta = None,
+            batch_size: int = None,
+            dry_run: bool = False,
+            pause: float = None
+    ) -> dict:
+        if grace is None:
+            grace = timedelta(hours=get_float("ORPHAN_GRACE_HOURS", 24.0))
+        if batch_size is None:
+            batch_size = get_int("ORPHAN_BATCH_SIZE", 1000)
+        if pause is None:
+            pause = get_float("ORPHAN_BATCH_PAUSE", 0.0)
+
+        cutoff = datetime.now() - grace
+        counts = {}
+        if dry_run:
+            with self.connection():
+                for table, query in COUNT_ORPHANS_SQL.items():
+                    self.cursor.execute(query, {"cutoff": cutoff})
+                    counts[table] = self.cursor.fetchone()[0]
+                self.db.rollback()
+            return counts
+
+        for table in SWEEP_ORPHANS_SQL:
+            counts[table] = 0
+            last_id = 0
+            while True:
+                removed, last_id = self.__sweep_orphans_batch(table, last_id, cutoff, batch_size)
+                if not removed:
+                    break
+                counts[table] += removed
+                if pause:
+                    time.sleep(pause)
+
+        logger.info("Removed orphaned credentials: %s", counts)
+        return counts
+
+    # Delete the shared login throttle buckets that are full again, returning how many were deleted
+    @instrumented
+    def purge_login_throttle(self) -> int:
+        with self.connection():
+            self.cursor.execute(PURGE_LOGIN_THROTTLE_SQL)
+            purged = self.cursor.rowcount
+            self.db.commit()
+        return purged
+
+    # Yield every user with its latest email address, phone number, device and subscription (see
+    # db_export.EXPORT_COLUMNS) from a server-side cursor, holding itersize rows in memory at a time
+    def export_users(self, itersize: int = None):
+        if itersize is None:
+            itersize = get_int("EXPORT_ITERSIZE", 2000)
+
+        # A dedicated connection outside the pool, so a long export never holds a pooled one and the caller can use
+        # the database while iterating
+        db = self.__connect()
+        try:
+            # Every batch is recorded as one call of the operation, the time the caller spends between batches is not
+            with self.metrics.timer("export_users"):
+                # One snapshot for the whole export
+                db.cursor().execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                cursor = db.cursor(name="export_users")
+                cursor.execute(EXPORT_USERS_SQL, {"now": datetime.now()})
+                rows = cursor.fetchmany(itersize)
+            while rows:
+                yield from rows
+                with self.metrics.timer("export_users"):
+                    rows = cursor.fetchmany(itersize)
+            cursor.close()
+        finally:
+            db.close()
+
+    # Export every user as CSV to a text file, returning the number of users written
+    @instrumented
+    def export_users_csv(self, file, itersize: int = None) -> int:
+        return write_csv(self.export_users(itersize), file)
+
+    # Export every user as JSON Lines to a text file, returning the number of users written
+    @instrumented
+    def export_users_jsonl(self, file, itersize: int = None) -> int:
+        return write_jsonl(self.export_users(itersize), file)
+
+    # Import users whose passwords are already bcrypt hashes from a CSV (with a header line) or JSON Lines file, with
+    # the fields of db_import.IMPORT_FIELDS. Rows are checked while streamed into a staging table with COPY, then
+    # merged with one statement per table, all in one transaction. Returns the counts and the rejected
+    # (line, reason) pairs in line order.
+    @instrumented
+    def import_users(self, file, file_format: str = "csv", confirmed: bool = True) -> dict:
+        if file_format not in ("csv", "jsonl"):
+            raise ValueError("file_format must be 'csv' or 'jsonl'")
+        records = read_csv(file) if file_format == "csv" else read_jsonl(file)
+        now = datetime.now()
+        report = {"read": 0, "imported": 0, "rejected": []}
+
+        def staged():
+            for line, record in records:
+                report["read"] += 1
+                row, reason = check_record(record, confirmed, now)
+                if row is None:
+                    report["rejected"].append((line, reason))
+                else:
+                    yield (line,) + row
+
+        with self.connection():
+            self.cursor.execute(CREATE_STAGING_SQL)
+            self.cursor.copy_expert(COPY_STAGING_SQL, CopyStream(staged()), size=65536)
+            self.cursor.execute("ANALYZE import_user")
+
+            # Duplicates within the input keep their first line, rows whose credentials are taken are dropped
+            for reason, query in REJECT_SQL:
+                self.cursor.execute(query, {"now": now})
+                report["rejected"].extend((line, reason) for line, in self.cursor.fetchall())
+
+            for query in MERGE_SQL:
+                self.cursor.execute(query)
+            self.db.commit()
+
+        report["imported"] = report["read"] - len(report["rejected"])
+        report["rejected"].sort()
+        logger.info("Imported %d of %d users", report["imported"], report["read"])
+        return report
 
     # Create new user and associate it with an email, phone number and device
+    @instrumented
     def register(
             self,
             first_name: str,
@@ -259,248 +1004,309 @@ class Database(metaclass=DatabaseMeta):
     ) -> dict:
         response = {"type": "", "data": {}}
 
-        # Check email address is valid format
-        email_address_ids = self.__get_user_id_email(email_address)
-        if not re.match(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b", email_address):
-            response["type"] = "error"
-            response["data"]["email_error"] = 2
-            response["data"]["email_message"] = "Invalid email address"
-        else:
-            self.__insert_email(email_address)
+        # Reject malformed input before any query or hashing
+        if not check_registration_format(
+                response, first_name, last_name, password, email_address, device_name, device_sn, phone_number,
+                birth_date
+        ):
+            return response
 
-            if email_address_ids:
-                response["type"] = "error"
-                response["data"]["email_error"] = 1
-                response["data"]["email_message"] = "Email already in use"
-            else:
-                response["data"]["email_error"] = 0
-                response["data"]["email_message"] = "Email available"
-
-        # Check phone number is valid format
-        phone_number_ids = self.__get_user_id_phone(phone_number)
-        if not ((len(phone_number) == 8 and (phone_number[0] == "6" or phone_number[0] == "7")) or (
-                len(phone_number) == 9 and (phone_number[0:2] == "06" or phone_number[0:2] == "07")) or (
-                        len(phone_number) == 12 and (phone_number[0:5] == "+3736" or phone_number[0:5] == "+3737"))):
-            response["type"] = "error"
-            response["data"]["phone_error"] = 2
-            response["data"]["phone_message"] = "Invalid phone number"
-        else:
-            self.__insert_phone(phone_number)
+        # Find users already linked to the email address, phone number and device. Cached entries may be stale, so
+        # availability is always read from the database.
+        check_registration(response, self.__get_credential_users(email_address, phone_number, device_sn))
+        if response["type"] == "error":
+            return response
 
-            if phone_number_ids:
-                response["type"] = "error"
-                response["data"]["phone_error"] = 1
-                response["data"]["phone_message"] = "Phone number already in use"
-            else:
-                response["data"]["phone_error"] = 0
-                response["data"]["phone_message"] = "Phone number available"
-
-        # Insert device name and serial number
-        device_ids = self.__get_user_id_device(device_sn)
-        if len(device_sn) != 11:
-            response["type"] = "error"
-            response["data"]["device_error"] = 2
-            response["data"]["device_message"] = "Invalid device serial number"
-        else:
-            self.__insert_device(device_sn, device_name)
+        # Hash on the worker pool while no connection is held
+        with self.metrics.timer("bcrypt_hash"):
+            hashed = self.hasher.hash(password)
 
-            if device_ids:
-                response["type"] = "error"
-                response["data"]["device_error"] = 1
-                response["data"]["device_message"] = "Device already in use"
+        # Everything is written by two statements and committed once, so a failure leaves nothing behind
+        with self.connection():
+            ids = self.__insert_user_links(
+                first_name, last_name, hashed, birth_date, email_address, phone_number, device_name, device_sn
+            )
+            if ids:
+                self.db.commit()
             else:
-                response["data"]["device_error"] = 0
-                response["data"]["device_message"] = "Device available"
-
-        # Check first name is valid format
-        if first_name == "" or not first_name.isalpha:
-            response["type"] = "error"
-            response["data"]["first_name_error"] = 2
-            response["data"]["first_name_message"] = "Invalid first name"
-
-        # Check last name is valid format
-        if last_name == "" or not last_name.isalpha:
-            response["type"] = "error"
-            response["data"]["last_name_error"] = 2
-            response["data"]["last_name_message"] = "Invalid last name"
-
-        # Check password is valid format
-        if len(password) < 8:
-            response["type"] = "error"
-            response["data"]["password_error"] = 2
-            response["data"]["password_message"] = "Invalid password, must be at least 8 characters long"
-        else:
-            hashed = hashpw(password.encode('utf-8'), gensalt()).decode('utf-8')
-
-            if response["type"] != "error":
-                self.__insert_user(first_name, last_name, hashed, birth_date)
-                user_id = self.__get_user_id(first_name, last_name, hashed)[0]
-                email_address_id = self.__get_email_id(email_address)[0]
-                phone_number_id = self.__get_phone_id(phone_number)[0]
-                device_id = self.__get_device_id(device_sn)[0]
-                self.__insert_user_email(user_id, email_address_id)
-                self.__insert_user_phone(user_id, phone_number_id)
-                self.__insert_user_device(user_id, device_id)
-
-                response["type"] = "success"
-                response["data"]["message"] = "User registered successfully"
-                response["data"]["user_id"] = user_id
-                response["data"]["first_name"] = first_name
-                response["data"]["last_name"] = last_name
-                response["data"]["email_address"] = email_address
-                response["data"]["email_id"] = email_address_id
-                response["data"]["phone_number"] = phone_number
-                response["data"]["phone_id"] = phone_number_id
-                response["data"]["device_name"] = device_name
-                response["data"]["device_sn"] = device_sn
-                response["data"]["device_id"] = device_id
-                response["data"]["birth_date"] = birth_date
+                self.db.rollback()
+                # A credential was linked after the availability check, which may have read a lagging replica
+                check_registration(response, self.__get_credential_users(email_address, phone_number, device_sn))
+                if response["type"] == "error":
+                    return response
+
+        if ids:
+            user_id, email_address_id, phone_number_id, _ = ids
+            self.credentials.set(("email", email_address), (email_address_id, user_id))
+            self.credentials.set(("phone", phone_number), (phone_number_id, user_id))
 
+        registered(response, ids, first_name, last_name, email_address, device_name, device_sn, phone_number,
+                   birth_date)
         return response
 
-    # Login user
-    # TODO: Add phone login option
-    def login(self, credential: str, password: str) -> dict:
-        response = {"type": "", "data": {}}
-        password_hash = None
-        email_auth = False
-        phone_auth = False
-
-        # Check if credential is email
-        if re.match(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b", credential):
-            email_auth = True
-        # Check if credential is phone number
-        elif ((len(credential) == 8 and (credential[0] == "6" or credential[0] == "7")) or (
-               len(credential) == 9 and (credential[0:2] == "06" or credential[0:2] == "07")) or (
-               len(credential) == 12 and (credential[0:5] == "+3736" or credential[0:5] == "+3737"))) and (
-               credential[-7:].isdigit()):
-            phone_auth = True
-        # Send error if credential is not email or phone number
-        else:
-            response["type"] = "error"
-            response["data"]["email_error"] = 2
-            response["data"]["email_message"] = "Invalid email address"
-            response["data"]["phone_error"] = 2
-            response["data"]["phone_message"] = "Invalid phone number"
-
-        # If credential is email, check if email is registered
-        if email_auth:
-            email_address_id = self.__get_email_id(credential)
-
-            # If email is not registered, send error
-            if not email_address_id:
-                response["type"] = "error"
-                response["data"]["email_error"] = 1
-                response["data"]["email_message"] = "Email not registered"
-                return response
-            # If email is registered, get password hash
-            else:
-                email_address_id = email_address_id[0]
+    # Register many users at once, returning one response per record in the same order
+    @instrumented
+    def register_many(self, records: list, page_size: int = 1000) -> list:
+        fields = (
+            "first_name", "last_name", "password", "email_address",
+            "device_name", "device_sn", "phone_number", "birth_date"
+        )
+        rows = [{field: record.get(field) for field in fields} for record in records]
+        responses = [{"type": "", "data": {}} for _ in rows]
 
-                self.cursor.execute(
-                    "SELECT password_hash FROM app_user "
-                    "WHERE id = (SELECT user_id FROM user_email WHERE email_id = %s)",
-                    (email_address_id,)
-                )
-                password_hash = self.cursor.fetchone()
-        # If credential is phone number, check if phone number is registered
-        elif phone_auth:
-            phone_number_id = self.__get_phone_id(credential)
-            # If phone number is not registered, send error
-            if not phone_number_id:
-                response["type"] = "error"
-                response["data"]["phone_error"] = 1
-                response["data"]["phone_message"] = "Phone number not registered"
-
-                return response
-            # If phone number is registered, get password hash
-            else:
-                phone_number_id = phone_number_id[0]
+        # Reject malformed rows before any query or hashing
+        valid = [
+            index for index, row in enumerate(rows)
+            if check_registration_format(
+                responses[index], row["first_name"], row["last_name"], row["password"], row["email_address"],
+                row["device_name"], row["device_sn"], row["phone_number"], row["birth_date"]
+            )
+        ]
+        if not valid:
+            return responses
 
-                self.cursor.execute(
-                    "SELECT password_hash FROM app_user "
-                    "WHERE id = (SELECT user_id FROM user_phone WHERE phone_id = %s)",
-                    (phone_number_id,)
+        # Find credentials of the valid rows already linked to a user in one query
+        taken = self.__get_taken_credentials(
+            {rows[index]["email_address"] for index in valid},
+            {rows[index]["phone_number"] for index in valid},
+            {rows[index]["device_sn"] for index in valid}
+        )
+
+        # Check availability before any write, a credential repeated in the batch belongs to its first valid row
+        accepted = []
+        for index in valid:
+            row = rows[index]
+            check_registration(
+                responses[index],
+                (
+                    row["email_address"] in taken["email"],
+                    row["phone_number"] in taken["phone"],
+                    row["device_sn"] in taken["device"]
                 )
-                password_hash = self.cursor.fetchone()
-
-        # If password hash is empty, send error for non-existent user
-        if not password_hash:
-            response["type"] = "error"
-            # If credential is email, send email error
-            if email_auth:
-                response["data"]["email_error"] = 1
-                response["data"]["email_message"] = "Email not registered"
-            # If credential is phone number, send phone number error
-            elif phone_auth:
-                response["data"]["phone_error"] = 1
-                response["data"]["phone_message"] = "Phone number not registered"
+            )
+            if responses[index]["type"] != "error":
+                taken["email"].add(row["email_address"])
+                taken["phone"].add(row["phone_number"])
+                taken["device"].add(row["device_sn"])
+                accepted.append(index)
+
+        if not accepted:
+            return responses
+
+        # Hash the accepted passwords in parallel while no connection is held
+        with self.metrics.timer("bcrypt_hash_many"):
+            password_hashes = self.hasher.hash_many([rows[index]["password"] for index in accepted])
 
+        # Write the whole batch in one transaction
+        with self.connection():
+            ids, in_use = self.__insert_users_batch([rows[index] for index in accepted], password_hashes, page_size)
+            self.db.commit()
+
+        for index, row_ids, flags in zip(accepted, ids, in_use):
+            row = rows[index]
+            if row_ids is None:
+                check_registration(responses[index], flags)
+                continue
+            user_id, email_address_id, phone_number_id, _ = row_ids
+            self.credentials.set(("email", row["email_address"]), (email_address_id, user_id))
+            self.credentials.set(("phone", row["phone_number"]), (phone_number_id, user_id))
+            registered(responses[index], row_ids, row["first_name"], row["last_name"], row["email_address"],
+                       row["device_name"], row["device_sn"], row["phone_number"], row["birth_date"])
+        return responses
+
+    # Login user with an email address or phone number
+    @instrumented
+    def login(self, credential: str, password: str, client_key=None) -> dict:
+        response = {"type": "", "data": {}}
+
+        kind = credential_kind(response, credential)
+        if kind is None:
             return response
 
-        # If password is incorrect, send error
-        if not checkpw(password.encode('utf-8'), password_hash[0].encode('utf-8')):
-            response["type"] = "error"
-            response["data"]["password_error"] = 2
-            response["data"]["password_message"] = "Incorrect password"
+        # Attempts over the limits of the credential or of client_key (e.g. the caller's IP address) are rejected
+        # before they cost a query or a bcrypt check
+        retry_after = self.__throttle(kind + ":" + credential, client_key)
+        if retry_after:
+            throttled(response, retry_after)
             return response
-        # If password is correct, get user data
-        else:
-            # Get user data based on email
-            if email_auth:
-                # Get user data
-                self.cursor.execute(
-                    "SELECT * FROM app_user "
-                    "WHERE id = %s",
-                    (email_address_id,)
-                )
-                user = self.cursor.fetchone()
-            # Get user data based on phone number
-            elif phone_auth:
-                self.cursor.execute(
-                    "SELECT * FROM app_user "
-                    "WHERE id = %s",
-                    (phone_number_id,)
-                )
-                user = self.cursor.fetchone()
 
-            # Get user's email address based on user's id
-            self.cursor.execute(
-                "SELECT email_address, id FROM email_address "
-                "WHERE id = (SELECT email_id FROM user_email WHERE user_id = %s)",
-                (user[0],)
-            )
-            email_address, email_address_id = self.cursor.fetchone()[0]
+        # No stored hash matches an empty password, skip the query and the check
+        if not isinstance(password, str) or not password:
+            incorrect_password(response)
+            return response
 
-            # Get user's phone number based on user's id
-            self.cursor.execute(
-                "SELECT phone_number, id FROM phone_number "
-                "WHERE id = (SELECT phone_id FROM user_phone WHERE user_id = %s)",
-                (user[0],)
-            )
-            phone_number, phone_number_id = self.cursor.fetchone()
+        # Get password hash and profile of the user in one query, a cached credential skips its lookup
+        cached = self.credentials.get((kind, credential))
+        user = None
+        if cached:
+            user = self.__get_login_profile_by_id(kind, *cached)
+            if not user:
+                # The credential was unlinked by another process
+                self.credentials.delete((kind, credential))
+        if not user:
+            user = self.__get_login_profile(credential, kind)
+        if not user and self.replicas is not None:
+            # A user registered moments ago may not have reached the replica yet
+            with self.connection():
+                user = self.__get_login_profile(credential, kind)
 
-            # Get user's device data based on user's id
-            self.cursor.execute(
-                "SELECT device_name, device_sn, id FROM device "
-                "WHERE id = (SELECT device_id FROM user_device WHERE user_id = %s)",
-                (user[0],)
-            )
-            device_name, device_sn, device_id = self.cursor.fetchone()
-
-            response["type"] = "success"
-            response["data"]["message"] = "User logged in successfully"
-            response["data"]["user_id"] = user[0]
-            response["data"]["first_name"] = user[1]
-            response["data"]["last_name"] = user[2]
-            response["data"]["email_address"] = email_address
-            response["data"]["email_id"] = email_address_id
-            response["data"]["phone_number"] = phone_number
-            response["data"]["phone_id"] = phone_number_id
-            response["data"]["device_name"] = device_name
-            response["data"]["device_sn"] = device_sn
-            response["data"]["device_id"] = device_id
-            response["data"]["birth_date"] = user[4].strftime("%Y-%m-%d")
+        if user:
+            self.credentials.set((kind, credential), (user[12], user[0]))
+
+        # If no user is linked to the credential, send error for non-existent user
+        if not user:
+            not_registered(response, kind)
+            return response
 
+        # If password is incorrect, send error, the check runs on the worker pool after the connection is returned
+        with self.metrics.timer("bcrypt_verify"):
+            verified = self.hasher.verify(password, user[3])
+        if not verified:
+            incorrect_password(response)
             return response
 
+        logged_in(response, user)
+        return response
+
+    # Profiles of many users in one query, by user id in the order given, unknown ids are left out. Each has the
+    # fields of a login response and the names of the user's active categories.
+    @instrumented
+    def get_users(self, user_ids) -> dict:
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+
+        rows = {row[0]: row for row in self.__get_user_profiles(user_ids)}
+        users = {}
+        for user_id in user_ids:
+            row = rows.get(user_id)
+            if row is None:
+                continue
+            users[user_id] = profile({}, row)
+            users[user_id]["categories"] = self.__category_names(row[13])
+        return users
+
+    # Page through users newest first with keyset pagination on (created_at, id), optionally filtered by active,
+    # confirmed (an active confirmed email address or phone number), category name and email address or phone number
+    # prefix. Returns the profiles of get_users with created_at and active, and the cursor of the next page or None.
+    # Raises ValueError for a cursor not returned by this method.
+    @instrumented
+    def list_users(
+            self,
+            limit: int = 50,
+            cursor: str = None,
+            active: bool = None,
+            confirmed: bool = None,
+            category: str = None,
+            email_prefix: str = None,
+            phone_prefix: str = None
+    ) -> dict:
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        page = {"users": [], "cursor": None}
+        category_id = None
+        if category is not None:
+            found = self.get_category(category)
+            if found is None:
+                return page
+            category_id = found.id
+
+        after_created_at, after_id = decode_cursor(cursor) if cursor else (None, None)
+        rows = self.__list_users_page({
+            "active": active,
+            "confirmed": confirmed,
+            "category_id": category_id,
+            "email_prefix": like_prefix(email_prefix) if email_prefix else None,
+            "phone_prefix": like_prefix(phone_prefix) if phone_prefix else None,
+            "after_created_at": after_created_at,
+            "after_id": after_id,
+            # One more row tells whether there is a next page
+            "limit": limit + 1,
+            "now": datetime.now()
+        })
+
+        for row in rows[:limit]:
+            user = profile({}, row)
+            user["categories"] = self.__category_names(row[13])
+            user["created_at"] = row[14]
+            user["active"] = row[15]
+            page["users"].append(user)
+        if len(rows) > limit:
+            page["cursor"] = encode_cursor(rows[limit - 1][14], rows[limit - 1][0])
+        return page
+
+    # Subscription types (id, name, months, cost), served from memory
+    def get_subscription_types(self) -> tuple:
+        return self.reference.get().subscription_types
+
+    # Subscription type by name, e.g. "ST-3", or None
+    def get_subscription_type(self, name: str):
+        return self.reference.get().subscription_types_by_name.get(name)
+
+    # Subscription type by id, or None
+    def get_subscription_type_by_id(self, subscription_type_id: int):
+        return self.reference.get().subscription_types_by_id.get(subscription_type_id)
+
+    # User categories (id, name), served from memory
+    def get_categories(self) -> tuple:
+        return self.reference.get().categories
+
+    # User category by name, or None
+    def get_category(self, name: str):
+        return self.reference.get().categories_by_name.get(name)
+
+    # User category by id, or None
+    def get_category_by_id(self, category_id: int):
+        return self.reference.get().categories_by_id.get(category_id)
+
+    # Price of a subscription category (e.g. "ST") for a number of months, or None if it is not sold
+    def get_price(self, category: str, months: int):
+        subscription_type = self.get_subscription_type(category + "-" + str(months))
+        return subscription_type.cost if subscription_type else None
+
+    # Subscribe a user to a subscription type by name (e.g. "ST-3"), starting at valid_from or, without it, when the
+    # active subscriptions of the user end. Returns the UserSubscription, or None for an unknown user or type.
+    @instrumented
+    def subscribe(self, user_id: int, subscription_type_name: str, valid_from: datetime = None):
+        subscription_type = self.get_subscription_type(subscription_type_name)
+        if subscription_type is None:
+            return None
+
+        with self.connection():
+            self.cursor.execute(LOCK_USER_SQL, {"user_id": user_id})
+            if self.cursor.fetchone() is None:
+                self.db.rollback()
+                return None
+            self.cursor.execute(SUBSCRIBE_SQL, {
+                "user_id": user_id,
+                "subscription_type_id": subscription_type.id,
+                "months": subscription_type.months,
+                "valid_from": valid_from,
+                "now": datetime.now()
+            })
+            subscription_id, valid_from, valid_until = self.cursor.fetchone()
+            self.db.commit()
+        return UserSubscription(user_id, subscription_id, subscription_type, valid_from, valid_until)
+
+    # Subscription of a user in force now, or None
+    @instrumented
+    def get_active_subscription(self, user_id: int):
+        return self.get_active_subscriptions([user_id]).get(user_id)
+
+    # Subscriptions in force now of many users in one query, by user id, users without one are left out
+    @instrumented
+    def get_active_subscriptions(self, user_ids) -> dict:
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return {}
+        return {row[0]: self.__user_subscription(row) for row in self.__get_active_subscriptions(user_ids)}
+
+    # Subscriptions ending between start (included) and end (excluded) that no later subscription of their user
+    # extends, in order of their end, e.g. the subscriptions to renew tonight
+    @instrumented
+    def expiring_between(self, start: datetime, end: datetime) -> list:
+        with self.connection():
+            self.cursor.execute(EXPIRING_SUBSCRIPTIONS_SQL, {"start": start, "end": end, "now": datetime.now()})
+            rows = self.cursor.fetchall()
+            self.db.commit()
+        return [self.__user_subscription(row) for row in rows]
@@ -0,0 +1,119 @@
+import argparse
+import json
+import statistics
+import time
+from datetime import datetime
+
+import psycopg2
+
+from db_config import config
+from db_auth import (
+    CREDENTIAL_USERS_SQL, INSERT_USER_LINKS_SQL, LOCK_CREDENTIALS_SQL, LOGIN_PROFILE_EMAIL_SQL, LOGIN_PROFILE_PHONE_SQL
+)
+from Database import prepared_form
+
+# Compare planning time and latency of the hot statements sent as plain SQL and as prepared statements.
+# Everything runs in one transaction that is rolled back, so the database is left unchanged.
+#
+#   python -m benchmarks.prepared_statements --email user@example.com --phone 069123456
+
+
+# Planning and execution time in milliseconds reported by EXPLAIN ANALYZE
+def explain(cursor, statement, params):
+    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + statement, params)
+    plan = cursor.fetchone()[0][0]
+    return plan["Planning Time"], plan["Execution Time"]
+
+
+# Wall clock time of one round trip in milliseconds
+def round_trip(cursor, statement, params):
+    started = time.perf_counter()
+    cursor.execute(statement, params)
+    if cursor.description:
+        cursor.fetchall()
+    return (time.perf_counter() - started) * 1000
+
+
+# Median planning, execution and round trip times of a statement with and without PREPARE
+def measure(cursor, name, query, params, iterations):
+    text, names = prepared_form(query)
+    values = [params[key] for key in names]
+    cursor.execute("PREPARE " + name + " AS " + text)
+    execute = "EXECUTE " + name + " (" + ", ".join(["%s"] * len(values)) + ")"
+
+    results = {}
+    for mode, statement, arguments in (("plain", query, params), ("prepared", execute, values)):
+        plans = [explain(cursor, statement, arguments) for _ in range(iterations)]
+        latencies = [round_trip(cursor, statement, arguments) for _ in range(iterations)]
+        results[mode] = {
+            "planning_ms": statistics.median(planning for planning, _ in plans),
+            "execution_ms": statistics.median(execution for _, execution in plans),
+            "round_trip_ms": statistics.median(latencies),
+        }
+
+    cursor.execute("DEALLOCATE " + name)
+    results["planning_saved_ms"] = results["plain"]["planning_ms"] - results["prepared"]["planning_ms"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Planning time saved by prepared statements")
+    parser.add_argument("--email", default="benchmark@example.com", help="email address to log in with")
+    parser.add_argument("--phone", default="069000000", help="phone number to log in with")
+    parser.add_argument("--iterations", type=int, default=200)
+    arguments = parser.parse_args()
+
+    connection = psycopg2.connect(
+        host=config["DB_HOST"],
+        port=config.get("DB_PORT") or None,
+        database=config["DB_DATABASE"],
+        user=config["DB_USER"],
+        password=config["DB_PASSWORD"]
+    )
+    cursor = connection.cursor()
+    now = datetime.now()
+    credentials = {"email_address": "bench-insert@example.com", "phone_number": "069999999", "device_name": "bench",
+                   "device_sn": "BENCH999999", "now": now}
+    try:
+        # Ids of the credentials linked by the insert benchmark, rolled back with everything else
+        cursor.execute(LOCK_CREDENTIALS_SQL, credentials)
+        email_id, phone_id, device_id = cursor.fetchone()
+        results = {
+            "login_email": measure(
+                cursor, "bench_login_email", LOGIN_PROFILE_EMAIL_SQL,
+                {"credential": arguments.email, "now": now}, arguments.iterations
+            ),
+            "login_phone": measure(
+                cursor, "bench_login_phone", LOGIN_PROFILE_PHONE_SQL,
+                {"credential": arguments.phone, "now": now}, arguments.iterations
+            ),
+            "credential_users": measure(
+                cursor, "bench_credential_users", CREDENTIAL_USERS_SQL,
+                {"email_address": arguments.email, "phone_number": arguments.phone, "device_sn": "BENCH000000",
+                 "now": now},
+                arguments.iterations
+            ),
+            "lock_credentials": measure(
+                cursor, "bench_lock_credentials", LOCK_CREDENTIALS_SQL, credentials, arguments.iterations
+            ),
+            "insert_user_links": measure(
+                cursor, "bench_insert_user_links", INSERT_USER_LINKS_SQL,
+                {"first_name": "Bench", "last_name": "Mark", "password_hash": "x", "birth_date": "2000-01-01",
+                 "email_id": email_id, "phone_id": phone_id, "device_id": device_id, "now": now},
+                arguments.iterations
+            ),
+        }
+    finally:
+        connection.rollback()
+        connection.close()
+
+    results["planning_saved_per_login_ms"] = results["login_email"]["planning_saved_ms"]
+    results["planning_saved_per_register_ms"] = (
+        results["credential_users"]["planning_saved_ms"] + results["lock_credentials"]["planning_saved_ms"]
+        + results["insert_user_links"]["planning_saved_ms"]
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+import math
+from db_validation import (
+    is_birth_date, is_device_name, is_device_sn, is_email, is_name, is_phone, password_error,
+    credential_kind as kind_of
+)
+
+# SQL and response building shared by Database and AsyncDatabase, both drivers use the same parameter style
+
+# Users actively linked to an email address, phone number and device
+CREDENTIAL_USERS_SQL = (
+    "SELECT "
+    "ARRAY(SELECT user_email.user_id FROM user_email "
+    "JOIN email_address ON email_address.id = user_email.email_id "
+    "WHERE email_address.email_address = %(email_address)s AND user_email.removed_at > %(now)s), "
+    "ARRAY(SELECT user_phone.user_id FROM user_phone "
+    "JOIN phone_number ON phone_number.id = user_phone.phone_id "
+    "WHERE phone_number.phone_number = %(phone_number)s AND user_phone.removed_at > %(now)s), "
+    "ARRAY(SELECT user_device.user_id FROM user_device "
+    "JOIN device ON device.id = user_device.device_id "
+    "WHERE device.device_sn = %(device_sn)s AND user_device.removed_at > %(now)s)"
+)
+
+# Get or create the email, phone number and device of a registration, returning their ids. The no-op updates lock
+# existing rows until commit, so sweep_orphans skips them and registrations of the same credentials run one after the
+# other. Emails, then phone numbers, then devices are locked, the same order as register_many and import_users.
+LOCK_CREDENTIALS_SQL = (
+    "WITH email AS ("
+    "INSERT INTO email_address (email_address, created_at) VALUES (%(email_address)s, %(now)s) "
+    "ON CONFLICT (email_address) DO UPDATE SET email_address = EXCLUDED.email_address RETURNING id"
+    "), phone AS ("
+    "INSERT INTO phone_number (phone_number, created_at) VALUES (%(phone_number)s, %(now)s) "
+    "ON CONFLICT (phone_number) DO UPDATE SET phone_number = EXCLUDED.phone_number RETURNING id"
+    "), device AS ("
+    "INSERT INTO device (device_name, device_sn, created_at) VALUES (%(device_name)s, %(device_sn)s, %(now)s) "
+    "ON CONFLICT (device_sn) DO UPDATE SET device_sn = EXCLUDED.device_sn RETURNING id"
+    ") "
+    "SELECT email.id, phone.id, device.id FROM email, phone, device"
+)
+
+# Insert the user and link the credentials locked by LOCK_CREDENTIALS_SQL in one statement. Nothing is inserted and
+# no row returned when one of them is actively linked, the availability check may have read a replica. Running after
+# the locks are taken, the statement sees the links of any registration it waited for.
+INSERT_USER_LINKS_SQL = (
+    "WITH new_user AS ("
+    "INSERT INTO app_user (first_name, last_name, password_hash, birth_date, created_at, confirmed, active) "
+    "SELECT %(first_name)s::varchar, %(last_name)s::varchar, %(password_hash)s::varchar, %(birth_date)s::date, "
+    "%(now)s::timestamp, FALSE, TRUE "
+    "WHERE NOT EXISTS (SELECT 1 FROM user_email WHERE user_email.email_id = %(email_id)s::integer "
+    "AND user_email.removed_at > %(now)s) "
+    "AND NOT EXISTS (SELECT 1 FROM user_phone WHERE user_phone.phone_id = %(phone_id)s::integer "
+    "AND user_phone.removed_at > %(now)s) "
+    "AND NOT EXISTS (SELECT 1 FROM user_device WHERE user_device.device_id = %(device_id)s::integer "
+    "AND user_device.removed_at > %(now)s) "
+    "RETURNING id"
+    "), new_user_email AS ("
+    "INSERT INTO user_email (user_id, email_id, created_at, confirmed, removed_at) "
+    "SELECT new_user.id, %(email_id)s::integer, %(now)s, FALSE, '2100-01-01' FROM new_user"
+    "), new_user_phone AS ("
+    "INSERT INTO user_phone (user_id, phone_id, created_at, confirmed, removed_at) "
+    "SELECT new_user.id, %(phone_id)s::integer, %(now)s, FALSE, '2100-01-01' FROM new_user"
+    "), new_user_device AS ("
+    "INSERT INTO user_device (user_id, device_id, created_at, removed_at) "
+    "SELECT new_user.id, %(device_id)s::integer, %(now)s, '2100-01-01' FROM new_user"
+    ") "
+    "SELECT new_user.id, %(email_id)s::integer, %(phone_id)s::integer, %(device_id)s::integer FROM new_user"
+)
+
+# Latest active email address, phone number and device of each app_user row
+PROFILE_JOINS_SQL = (
+    "LEFT JOIN LATERAL ("
+    "SELECT email_address.email_address, email_address.id FROM user_email "
+    "JOIN email_address ON email_address.id = user_email.email_id "
+    "WHERE user_email.user_id = app_user.id AND user_email.removed_at > %(now)s "
+    "ORDER BY user_email.created_at DESC LIMIT 1"
+    ") AS email ON TRUE "
+    "LEFT JOIN LATERAL ("
+    "SELECT phone_number.phone_number, phone_number.id FROM user_phone "
+    "JOIN phone_number ON phone_number.id = user_phone.phone_id "
+    "WHERE user_phone.user_id = app_user.id AND user_phone.removed_at > %(now)s "
+    "ORDER BY user_phone.created_at DESC LIMIT 1"
+    ") AS phone ON TRUE "
+    "LEFT JOIN LATERAL ("
+    "SELECT device.device_name, device.device_sn, device.id FROM user_device "
+    "JOIN device ON device.id = user_device.device_id "
+    "WHERE user_device.user_id = app_user.id AND user_device.removed_at > %(now)s "
+    "ORDER BY user_device.created_at DESC LIMIT 1"
+    ") AS device ON TRUE"
+)
+
+# Which of the email address, phone number and device ids of a batch are actively linked, as (kind, id) rows
+LINKED_CREDENTIALS_SQL = (
+    "SELECT DISTINCT 'email', email_id FROM user_email "
+    "WHERE email_id = ANY(%(email_ids)s) AND removed_at > %(now)s "
+    "UNION ALL "
+    "SELECT DISTINCT 'phone', phone_id FROM user_phone "
+    "WHERE phone_id = ANY(%(phone_ids)s) AND removed_at > %(now)s "
+    "UNION ALL "
+    "SELECT DISTINCT 'device', device_id FROM user_device "
+    "WHERE device_id = ANY(%(device_ids)s) AND removed_at > %(now)s"
+)
+
+# Password hash and profile (active email, phone number and device) of the user linked to a credential
+LOGIN_PROFILE_SQL = (
+    "WITH credential_user AS ("
+    "SELECT credential_link.user_id, credential_link.{credential_column} AS credential_id {credential_join} "
+    "ORDER BY credential_link.created_at DESC LIMIT 1"
+    ") "
+    "SELECT app_user.id, app_user.first_name, app_user.last_name, app_user.password_hash, "
+    "app_user.birth_date, email.email_address, email.id, phone.phone_number, phone.id, "
+    "device.device_name, device.device_sn, device.id, credential_user.credential_id "
+    "FROM credential_user JOIN app_user ON app_user.id = credential_user.user_id " + PROFILE_JOINS_SQL
+)
+LOGIN_PROFILE_EMAIL_SQL = LOGIN_PROFILE_SQL.format(credential_column="email_id", credential_join=(
+    "FROM email_address AS credential "
+    "JOIN user_email AS credential_link ON credential_link.email_id = credential.id "
+    "WHERE credential.email_address = %(credential)s AND credential_link.removed_at > %(now)s"
+))
+LOGIN_PROFILE_PHONE_SQL = LOGIN_PROFILE_SQL.format(credential_column="phone_id", credential_join=(
+    "FROM phone_number AS credential "
+    "JOIN user_phone AS credential_link ON credential_link.phone_id = credential.id "
+    "WHERE credential.phone_number = %(credential)s AND credential_link.removed_at > %(now)s"
+))
+
+# Same profile for a credential whose id and owner are already known, only the link is checked
+LOGIN_PROFILE_EMAIL_ID_SQL = LOGIN_PROFILE_SQL.format(credential_column="email_id", credential_join=(
+    "FROM user_email AS credential_link "
+    "WHERE credential_link.email_id = %(credential_id)s AND credential_link.user_id = %(user_id)s "
+    "AND credential_link.removed_at > %(now)s"
+))
+LOGIN_PROFILE_PHONE_ID_SQL = LOGIN_PROFILE_SQL.format(credential_column="phone_id", credential_join=(
+    "FROM user_phone AS credential_link "
+    "WHERE credential_link.phone_id = %(credential_id)s AND credential_link.user_id = %(user_id)s "
+    "AND credential_link.removed_at > %(now)s"
+))
+
+# Profiles of many users in one statement, rows shaped like the login profile (without password hash and credential
+# id) followed by the ids of their active categories
+USER_PROFILES_SQL = (
+    "SELECT app_user.id, app_user.first_name, app_user.last_name, NULL, "
+    "app_user.birth_date, email.email_address, email.id, phone.phone_number, phone.id, "
+    "device.device_name, device.device_sn, device.id, NULL, "
+    "ARRAY(SELECT user_category.category_id FROM user_category "
+    "WHERE user_category.user_id = app_user.id AND user_category.removed_at > %(now)s "
+    "ORDER BY user_category.created_at) "
+    "FROM app_user " + PROFILE_JOINS_SQL + " "
+    "WHERE app_user.id = ANY(%(user_ids)s)"
+)
+
+# Delete one batch of users that confirmed nothing before the cutoff, with their active and removed links and
+# subscriptions.
+# Rows locked by another transaction are skipped, returns the number of users deleted and the last id deleted.
+REMOVE_UNCONFIRMED_SQL = (
+    "WITH batch AS ("
+    "SELECT id FROM app_user "
+    "WHERE id > %(after)s AND confirmed = FALSE AND created_at < %(cutoff)s "
+    "AND NOT EXISTS (SELECT 1 FROM user_email WHERE user_email.user_id = app_user.id AND user_email.confirmed) "
+    "AND NOT EXISTS (SELECT 1 FROM user_phone WHERE user_phone.user_id = app_user.id AND user_phone.confirmed) "
+    "ORDER BY id LIMIT %(batch_size)s FOR UPDATE SKIP LOCKED"
+    "), emails AS ("
+    "DELETE FROM user_email WHERE user_id IN (SELECT id FROM batch)"
+    "), phones AS ("
+    "DELETE FROM user_phone WHERE user_id IN (SELECT id FROM batch)"
+    "), devices AS ("
+    "DELETE FROM user_device WHERE user_id IN (SELECT id FROM batch)"
+    "), categories AS ("
+    "DELETE FROM user_category WHERE user_id IN (SELECT id FROM batch)"
+    "), user_subscriptions AS ("
+    "DELETE FROM user_subscription WHERE user_id IN (SELECT id FROM batch) RETURNING subscription_id"
+    "), emails_history AS ("
+    "DELETE FROM user_email_history WHERE user_id IN (SELECT id FROM batch)"
+    "), phones_history AS ("
+    "DELETE FROM user_phone_history WHERE user_id IN (SELECT id FROM batch)"
+    "), devices_history AS ("
+    "DELETE FROM user_device_history WHERE user_id IN (SELECT id FROM batch)"
+    "), categories_history AS ("
+    "DELETE FROM user_category_history WHERE user_id IN (SELECT id FROM batch)"
+    "), user_subscriptions_history AS ("
+    "DELETE FROM user_subscription_history WHERE user_id IN (SELECT id FROM batch) RETURNING subscription_id"
+    "), subscriptions AS ("
+    "DELETE FROM subscription WHERE id IN ("
+    "SELECT subscription_id FROM user_subscriptions UNION SELECT subscription_id FROM user_subscriptions_history"
+    ") "
+    "AND NOT EXISTS (SELECT 1 FROM user_subscription WHERE user_subscription.subscription_id = subscription.id "
+    "AND user_subscription.user_id NOT IN (SELECT id FROM batch)) "
+    "AND NOT EXISTS (SELECT 1 FROM user_subscription_history "
+    "WHERE user_subscription_history.subscription_id = subscription.id "
+    "AND user_subscription_history.user_id NOT IN (SELECT id FROM batch))"
+    "), users AS ("
+    "DELETE FROM app_user WHERE id IN (SELECT id FROM batch) RETURNING id"
+    ") "
+    "SELECT count(*), max(id) FROM users"
+)
+
+CONFIRM_EMAIL_SQL = (
+    "UPDATE user_email SET confirmed = TRUE "
+    "WHERE email_id = (SELECT id FROM email_address WHERE email_address = %s) AND removed_at > %s"
+)
+
+CONFIRM_PHONE_SQL = (
+    "UPDATE user_phone SET confirmed = TRUE "
+    "WHERE phone_id = (SELECT id FROM phone_number WHERE phone_number = %s) AND removed_at > %s"
+)
+
+
+# Add the format errors of the device name and birth date of a registration, returning whether both are valid
+def check_profile_format(response: dict, device_name: str, birth_date) -> bool:
+    # Check device name is given and fits its column
+    if not is_device_name(device_name):
+        response["type"] = "error"
+        response["data"]["device_name_error"] = 2
+        response["data"]["device_name_message"] = "Invalid device name"
+
+    # Check birth date is a date in the past
+    if not is_birth_date(birth_date):
+        response["type"] = "error"
+        response["data"]["birth_date_error"] = 2
+        response["data"]["birth_date_message"] = "Invalid birth date, expected YYYY-MM-DD"
+
+    return response["type"] != "error"
+
+
+# Add the format errors of a registration to the response, returning whether every field is valid.
+# Runs before any query or hashing, so an invalid request costs no round trip.
+def check_registration_format(
+        response: dict,
+        first_name: str,
+        last_name: str,
+        password: str,
+        email_address: str,
+        device_name: str,
+        device_sn: str,
+        phone_number: str,
+        birth_date
+) -> bool:
+    # Check email address is valid format
+    if not is_email(email_address):
+        response["type"] = "error"
+        response["data"]["email_error"] = 2
+        response["data"]["email_message"] = "Invalid email address"
+
+    # Check phone number is valid format
+    if not is_phone(phone_number):
+        response["type"] = "error"
+        response["data"]["phone_error"] = 2
+        response["data"]["phone_message"] = "Invalid phone number"
+
+    # Check device serial number is valid format
+    if not is_device_sn(device_sn):
+        response["type"] = "error"
+        response["data"]["device_error"] = 2
+        response["data"]["device_message"] = "Invalid device serial number"
+
+    # Check device name and birth date, both NOT NULL columns
+    check_profile_format(response, device_name, birth_date)
+
+    # Check first name is valid format
+    if not is_name(first_name):
+        response["type"] = "error"
+        response["data"]["first_name_error"] = 2
+        response["data"]["first_name_message"] = "Invalid first name"
+
+    # Check last name is valid format
+    if not is_name(last_name):
+        response["type"] = "error"
+        response["data"]["last_name_error"] = 2
+        response["data"]["last_name_message"] = "Invalid last name"
+
+    # Check password is valid format
+    message = password_error(password)
+    if message:
+        response["type"] = "error"
+        response["data"]["password_error"] = 2
+        response["data"]["password_message"] = message
+
+    return response["type"] != "error"
+
+
+# Add availability errors of a registration whose fields are valid to the response
+def check_registration(response: dict, credential_users):
+    email_address_ids, phone_number_ids, device_ids = credential_users
+
+    if email_address_ids:
+        response["type"] = "error"
+        response["data"]["email_error"] = 1
+        response["data"]["email_message"] = "Email already in use"
+    else:
+        response["data"]["email_error"] = 0
+        response["data"]["email_message"] = "Email available"
+
+    if phone_number_ids:
+        response["type"] = "error"
+        response["data"]["phone_error"] = 1
+        response["data"]["phone_message"] = "Phone number already in use"
+    else:
+        response["data"]["phone_error"] = 0
+        response["data"]["phone_message"] = "Phone number available"
+
+    if device_ids:
+        response["type"] = "error"
+        response["data"]["device_error"] = 1
+        response["data"]["device_message"] = "Device already in use"
+    else:
+        response["data"]["device_error"] = 0
+        response["data"]["device_message"] = "Device available"
+
+
+# Fill the response of a registration from the ids returned by INSERT_USER_LINKS_SQL
+def registered(
+        response: dict,
+        ids,
+        first_name: str,
+        last_name: str,
+        email_address: str,
+        device_name: str,
+        device_sn: str,
+        phone_number: str,
+        birth_date: str
+):
+    if not ids:
+        # A credential was linked to another user, nothing was linked
+        response["type"] = "error"
+        response["data"]["message"] = "Registration failed, please try again"
+        return
+
+    user_id, email_address_id, phone_number_id, device_id = ids
+
+    response["type"] = "success"
+    response["data"]["message"] = "User registered successfully"
+    response["data"]["user_id"] = user_id
+    response["data"]["first_name"] = first_name
+    response["data"]["last_name"] = last_name
+    response["data"]["email_address"] = email_address
+    response["data"]["email_id"] = email_address_id
+    response["data"]["phone_number"] = phone_number
+    response["data"]["phone_id"] = phone_number_id
+    response["data"]["device_name"] = device_name
+    response["data"]["device_sn"] = device_sn
+    response["data"]["device_id"] = device_id
+    response["data"]["birth_date"] = birth_date
+
+
+# Return "email" or "phone" for a login credential, or None after adding the format errors to the response
+def credential_kind(response: dict, credential: str):
+    kind = kind_of(credential)
+    if kind is not None:
+        return kind
+
+    # Send error if credential is not email or phone number
+    response["type"] = "error"
+    response["data"]["email_error"] = 2
+    response["data"]["email_message"] = "Invalid email address"
+    response["data"]["phone_error"] = 2
+    response["data"]["phone_message"] = "Invalid phone number"
+    return None
+
+
+# Add the error for a credential no user is linked to
+def not_registered(response: dict, kind: str):
+    response["type"] = "error"
+    # If credential is email, send email error
+    if kind == "email":
+        response["data"]["email_error"] = 1
+        response["data"]["email_message"] = "Email not registered"
+    # If credential is phone number, send phone number error
+    else:
+        response["data"]["phone_error"] = 1
+        response["data"]["phone_message"] = "Phone number not registered"
+
+
+# Add the error for an incorrect password
+def incorrect_password(response: dict):
+    response["type"] = "error"
+    response["data"]["password_error"] = 2
+    response["data"]["password_message"] = "Incorrect password"
+
+
+# Add the error for a login attempt over the throttle limits, with the whole seconds to wait before the next one
+def throttled(response: dict, retry_after: float):
+    response["type"] = "error"
+    response["data"]["login_error"] = 3
+    response["data"]["login_message"] = "Too many login attempts, try again later"
+    response["data"]["retry_after"] = max(1, math.ceil(retry_after))
+
+
+# Fill the response of a login from a row returned by the login profile queries
+def logged_in(response: dict, user):
+    response["type"] = "success"
+    response["data"]["message"] = "User logged in successfully"
+    profile(response["data"], user)
+
+
+# Fill a profile dict from the first 13 columns of a row returned by the login or user profile queries
+def profile(data: dict, user) -> dict:
+    (user_id, first_name, last_name, _, birth_date, email_address, email_address_id,
+     phone_number, phone_number_id, device_name, device_sn, device_id, _) = user[:13]
+
+    data["user_id"] = user_id
+    data["first_name"] = first_name
+    data["last_name"] = last_name
+    data["email_address"] = email_address
+    data["email_id"] = email_address_id
+    data["phone_number"] = phone_number
+    data["phone_id"] = phone_number_id
+    data["device_name"] = device_name
+    data["device_sn"] = device_sn
+    data["device_id"] = device_id
+    data["birth_date"] = birth_date.strftime("%Y-%m-%d") if birth_date else None
+    return data
@@ -0,0 +1,169 @@
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
+import logging
+import select
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SubscriptionType = namedtuple("SubscriptionType", ["id", "name", "months", "cost"])
+Category = namedtuple("Category", ["id", "name"])
+
+
+# Immutable snapshot of the subscription_type and category tables
+class ReferenceData:
+    def __init__(self, subscription_types, categories):
+        self.subscription_types = tuple(SubscriptionType(*row) for row in subscription_types)
+        self.categories = tuple(Category(*row) for row in categories)
+        self.subscription_types_by_name = MappingProxyType({row.name: row for row in self.subscription_types})
+        self.subscription_types_by_id = MappingProxyType({row.id: row for row in self.subscription_types})
+        self.categories_by_name = MappingProxyType({row.name: row for row in self.categories})
+        self.categories_by_id = MappingProxyType({row.id: row for row in self.categories})
+
+
+# Reference data loaded on first use and kept until invalidated
+class ReferenceCache:
+    def __init__(self, load):
+        # Callable returning (subscription type rows, category rows)
+        self.load = load
+        self.__data = None
+        self.__generation = 0
+        self.__lock = threading.Lock()
+        self.__stats = {"hits": 0, "misses": 0, "loads": 0, "invalidations": 0}
+
+    # Return the current snapshot, loading it if needed
+    def get(self) -> ReferenceData:
+        data = self.__data
+        if data is not None:
+            with self.__lock:
+                self.__stats["hits"] += 1
+            return data
+
+        with self.__lock:
+            self.__stats["misses"] += 1
+            generation = self.__generation
+
+        data = ReferenceData(*self.load())
+
+        with self.__lock:
+            self.__stats["loads"] += 1
+            # Keep the snapshot only if no invalidation arrived while it was loading
+            if generation == self.__generation:
+                self.__data = data
+        return data
+
+    # Drop the snapshot, the next read loads it again
+    def invalidate(self, *_):
+        with self.__lock:
+            self.__data = None
+            self.__generation += 1
+            self.__stats["invalidations"] += 1
+
+    # Hit, miss, load and invalidation counters
+    def stats(self) -> dict:
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats["loaded"] = self.__data is not None
+        return stats
+
+
+# Thread-safe least recently used cache whose entries expire after ttl seconds
+class LRUCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        # A max_size of 0 disables the cache
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    # Return the cached value or None
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__stats["misses"] += 1
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.__entries[key]
+                self.__stats["expirations"] += 1
+                self.__stats["misses"] += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.__stats["hits"] += 1
+            return value
+
+    # Store a value, evicting the least recently used entries above max_size
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = (value, time.monotonic() + self.ttl)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.__stats["evictions"] += 1
+
+    # Remove entries
+    def delete(self, *keys):
+        with self.__lock:
+            for key in keys:
+                if self.__entries.pop(key, None) is not None:
+                    self.__stats["invalidations"] += 1
+
+    # Remove every entry
+    def clear(self):
+        with self.__lock:
+            self.__stats["invalidations"] += len(self.__entries)
+            self.__entries.clear()
+
+    # Size, hit, miss, eviction and expiration counters
+    def stats(self) -> dict:
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["size"] = len(self.__entries)
+        stats["max_size"] = self.max_size
+        stats["ttl"] = self.ttl
+        return stats
+
+
+# Background thread calling a callback for every NOTIFY on a channel
+class ChangeListener(threading.Thread):
+    def __init__(self, connect, channel: str, callback, reconnect_delay: float = 5.0):
+        super().__init__(name="listen-" + channel, daemon=True)
+        self.connect = connect
+        self.channel = channel
+        self.callback = callback
+        self.reconnect_delay = reconnect_delay
+        self.__stopped = threading.Event()
+
+    def run(self):
+        while not self.__stopped.is_set():
+            connection = None
+            try:
+                connection = self.connect()
+                connection.autocommit = True
+                connection.cursor().execute("LISTEN " + self.channel)
+                # Notifications sent while disconnected are lost, so start again from fresh data
+                self.callback(None)
+
+                while not self.__stopped.is_set():
+                    if select.select([connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.callback(connection.notifies.pop(0).payload)
+            except Exception:
+                logger.warning("Listening on '%s' failed, reconnecting", self.channel, exc_info=True)
+                self.__stopped.wait(self.reconnect_delay)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    # Stop listening, the thread exits within a second
+    def stop(self):
+        self.__stopped.set()
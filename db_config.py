@@ -0,0 +1,24 @@
+from dotenv import dotenv_values
+
+# Load environment variables once, shared by the model and the Database class
+config = dotenv_values(".env")
+
+
+# Read an integer setting, falling back to a default when it is missing
+def get_int(key: str, default: int) -> int:
+    value = config.get(key)
+    return default if value in (None, "") else int(value)
+
+
+# Read a float setting, falling back to a default when it is missing
+def get_float(key: str, default: float) -> float:
+    value = config.get(key)
+    return default if value in (None, "") else float(value)
+
+
+# Read a boolean setting ("true", "1", "yes", "on"), falling back to a default when it is missing
+def get_bool(key: str, default: bool) -> bool:
+    value = config.get(key)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,72 @@
+from datetime import date, datetime
+import csv
+import json
+
+# Columns of an exported user, in order
+EXPORT_COLUMNS = (
+    "id", "first_name", "last_name", "birth_date", "active", "confirmed", "created_at",
+    "email_address", "email_confirmed", "phone_number", "phone_confirmed", "device_name", "device_sn",
+    "subscription_type", "subscription_valid_from",
+)
+
+# Every user with its latest active email address, phone number, device and subscription, in id order.
+# Each link table is read once and joined by hash, so the plan stays linear in the number of users.
+EXPORT_USERS_SQL = (
+    "SELECT app_user.id, app_user.first_name, app_user.last_name, app_user.birth_date, app_user.active, "
+    "app_user.confirmed, app_user.created_at, "
+    "email.email_address, email.confirmed, phone.phone_number, phone.confirmed, "
+    "device.device_name, device.device_sn, subscription.subscription_type_name, subscription.valid_from "
+    "FROM app_user "
+    "LEFT JOIN ("
+    "SELECT DISTINCT ON (user_email.user_id) user_email.user_id, email_address.email_address, user_email.confirmed "
+    "FROM user_email JOIN email_address ON email_address.id = user_email.email_id "
+    "WHERE user_email.removed_at > %(now)s ORDER BY user_email.user_id, user_email.created_at DESC"
+    ") AS email ON email.user_id = app_user.id "
+    "LEFT JOIN ("
+    "SELECT DISTINCT ON (user_phone.user_id) user_phone.user_id, phone_number.phone_number, user_phone.confirmed "
+    "FROM user_phone JOIN phone_number ON phone_number.id = user_phone.phone_id "
+    "WHERE user_phone.removed_at > %(now)s ORDER BY user_phone.user_id, user_phone.created_at DESC"
+    ") AS phone ON phone.user_id = app_user.id "
+    "LEFT JOIN ("
+    "SELECT DISTINCT ON (user_device.user_id) user_device.user_id, device.device_name, device.device_sn "
+    "FROM user_device JOIN device ON device.id = user_device.device_id "
+    "WHERE user_device.removed_at > %(now)s ORDER BY user_device.user_id, user_device.created_at DESC"
+    ") AS device ON device.user_id = app_user.id "
+    "LEFT JOIN ("
+    "SELECT DISTINCT ON (user_subscription.user_id) user_subscription.user_id, "
+    "subscription_type.subscription_type_name, subscription.valid_from "
+    "FROM user_subscription JOIN subscription ON subscription.id = user_subscription.subscription_id "
+    "JOIN subscription_type ON subscription_type.id = subscription.subscription_type_id "
+    "WHERE user_subscription.removed_at > %(now)s "
+    "ORDER BY user_subscription.user_id, subscription.valid_from DESC"
+    ") AS subscription ON subscription.user_id = app_user.id "
+    "ORDER BY app_user.id"
+)
+
+
+# Dates as ISO 8601 strings, for JSON
+def json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+# Write rows as CSV with a header line, returning the number of rows written
+def write_csv(rows, file, columns=EXPORT_COLUMNS) -> int:
+    writer = csv.writer(file)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+# Write rows as one JSON object per line, returning the number of rows written
+def write_jsonl(rows, file, columns=EXPORT_COLUMNS) -> int:
+    count = 0
+    for row in rows:
+        file.write(json.dumps(dict(zip(columns, row)), default=json_default, ensure_ascii=False))
+        file.write("\n")
+        count += 1
+    return count
@@ -0,0 +1,154 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from bcrypt import gensalt, hashpw, checkpw
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+
+
+# Hash a password inside a worker, module level so it can be sent to worker processes
+def _hash(password: bytes, rounds: int) -> bytes:
+    return hashpw(password, gensalt(rounds))
+
+
+# Check a password inside a worker
+def _check(password: bytes, password_hash: bytes) -> bool:
+    return checkpw(password, password_hash)
+
+
+class PasswordHasher:
+    def __init__(self, executor: str = "process", workers: int = None, max_pending: int = None, rounds: int = 12):
+        if executor not in ("process", "thread", "inline"):
+            raise ValueError("Unknown hash executor '%s', use 'process', 'thread' or 'inline'" % executor)
+
+        self.workers = workers or os.cpu_count() or 1
+        # Hashes queued or running at once, further callers wait for a free slot
+        self.max_pending = max_pending or self.workers * 4
+        self.rounds = rounds
+
+        if executor == "process":
+            # Workers start lazily, once threads and database sockets exist, so they are not forked from this process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        elif executor == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        else:
+            self.executor = None
+
+        self.__slots = threading.BoundedSemaphore(self.max_pending)
+        self.__lock = threading.Lock()
+        self.__stats = {
+            "pending": 0,
+            "peak_pending": 0,
+            "hashed": 0,
+            "verified": 0,
+            "failed": 0,
+            "wait_time": 0.0,
+            "hash_time": 0.0,
+        }
+
+    # Private methods
+    # Queue a bcrypt function on the executor once a slot is free, the slot is released when it completes.
+    # With waited the caller already holds a slot, taken since that time.
+    def __submit(self, function, *args, waited: float = None) -> Future:
+        if waited is None:
+            waited = time.monotonic()
+            self.__slots.acquire()
+        started = time.monotonic()
+        with self.__lock:
+            self.__stats["pending"] += 1
+            self.__stats["peak_pending"] = max(self.__stats["peak_pending"], self.__stats["pending"])
+            self.__stats["wait_time"] += started - waited
+
+        def done(future):
+            self.__slots.release()
+            with self.__lock:
+                self.__stats["pending"] -= 1
+                self.__stats["hash_time"] += time.monotonic() - started
+                if future.exception() is not None:
+                    self.__stats["failed"] += 1
+
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(function(*args))
+            except Exception as error:
+                future.set_exception(error)
+        else:
+            try:
+                future = self.executor.submit(function, *args)
+            except Exception:
+                # The executor is shut down or broken, give the slot back
+                future = Future()
+                future.set_exception(RuntimeError("Password hashing executor is not available"))
+                done(future)
+                raise
+        future.add_done_callback(done)
+        return future
+
+    # Public methods
+    # Hash a password with a new salt
+    def hash(self, password: str) -> str:
+        return self.hash_many([password])[0]
+
+    # Hash several passwords in parallel, keeping their order
+    def hash_many(self, passwords: list) -> list:
+        futures = [self.__submit(_hash, password.encode('utf-8'), self.rounds) for password in passwords]
+        hashed = [future.result().decode('utf-8') for future in futures]
+        with self.__lock:
+            self.__stats["hashed"] += len(hashed)
+        return hashed
+
+    # Check a password against a stored hash
+    def verify(self, password: str, password_hash: str) -> bool:
+        matches = self.__submit(_check, password.encode('utf-8'), password_hash.encode('utf-8')).result()
+        with self.__lock:
+            self.__stats["verified"] += 1
+        return matches
+
+    # Await a bcrypt function queued on the executor. Only waiting for a free slot takes a thread of the default
+    # executor, and only when none is free.
+    async def __submit_async(self, function, *args):
+        waited = time.monotonic()
+        if not self.__slots.acquire(blocking=False):
+            acquiring = asyncio.get_running_loop().run_in_executor(None, self.__slots.acquire)
+            try:
+                await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # The slot is still taken once the wait ends, give it back
+                acquiring.add_done_callback(lambda _: self.__slots.release())
+                raise
+        return await asyncio.wrap_future(self.__submit(function, *args, waited=waited))
+
+    # Hash a password without blocking the event loop
+    async def hash_async(self, password: str) -> str:
+        if self.executor is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.hash, password)
+        hashed = (await self.__submit_async(_hash, password.encode('utf-8'), self.rounds)).decode('utf-8')
+        with self.__lock:
+            self.__stats["hashed"] += 1
+        return hashed
+
+    # Check a password without blocking the event loop
+    async def verify_async(self, password: str, password_hash: str) -> bool:
+        if self.executor is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.verify, password, password_hash)
+        matches = await self.__submit_async(_check, password.encode('utf-8'), password_hash.encode('utf-8'))
+        with self.__lock:
+            self.__stats["verified"] += 1
+        return matches
+
+    # Queue depth and timing counters
+    def stats(self) -> dict:
+        with self.__lock:
+            stats = dict(self.__stats)
+        stats["workers"] = self.workers
+        stats["max_pending"] = self.max_pending
+        return stats
+
+    # Stop the worker pool
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
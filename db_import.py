@@ -0,0 +1,212 @@
+from datetime import date, datetime
+import csv
+import io
+import json
+import re
+
+from db_validation import is_birth_date, is_device_name, is_device_sn, is_email, is_name, is_phone
+
+# Fields read from each input record, the first five are required
+IMPORT_FIELDS = (
+    "first_name", "last_name", "password_hash", "birth_date", "email_address",
+    "phone_number", "device_name", "device_sn", "confirmed", "created_at",
+)
+REQUIRED_FIELDS = IMPORT_FIELDS[:5]
+
+# bcrypt hash in modular crypt format, e.g. $2b$12$ followed by 53 characters
+BCRYPT_HASH = re.compile(r"^\$2[abxy]?\$\d{2}\$[./A-Za-z0-9]{53}$")
+
+# Staging table holding the accepted input rows of one import, dropped on commit
+CREATE_STAGING_SQL = (
+    "CREATE TEMP TABLE import_user ("
+    "line integer PRIMARY KEY, first_name text NOT NULL, last_name text NOT NULL, password_hash text NOT NULL, "
+    "birth_date date NOT NULL, email_address text NOT NULL, phone_number text, device_name text, device_sn text, "
+    "confirmed boolean NOT NULL, created_at timestamp NOT NULL, user_id integer"
+    ") ON COMMIT DROP"
+)
+COPY_STAGING_SQL = (
+    "COPY import_user (line, " + ", ".join(IMPORT_FIELDS) + ") FROM STDIN WITH (FORMAT csv)"
+)
+
+# Statements removing staged rows that cannot be imported, each returns the lines removed, in order
+REJECT_SQL = (
+    (
+        "email_address repeated in input",
+        "DELETE FROM import_user WHERE line IN ("
+        "SELECT line FROM (SELECT line, row_number() OVER (PARTITION BY email_address ORDER BY line) AS n "
+        "FROM import_user) AS numbered WHERE n > 1"
+        ") RETURNING line"
+    ),
+    (
+        "phone_number repeated in input",
+        "DELETE FROM import_user WHERE line IN ("
+        "SELECT line FROM (SELECT line, row_number() OVER (PARTITION BY phone_number ORDER BY line) AS n "
+        "FROM import_user WHERE phone_number IS NOT NULL) AS numbered WHERE n > 1"
+        ") RETURNING line"
+    ),
+    (
+        "device_sn repeated in input",
+        "DELETE FROM import_user WHERE line IN ("
+        "SELECT line FROM (SELECT line, row_number() OVER (PARTITION BY device_sn ORDER BY line) AS n "
+        "FROM import_user WHERE device_sn IS NOT NULL) AS numbered WHERE n > 1"
+        ") RETURNING line"
+    ),
+    (
+        "email_address in use",
+        "DELETE FROM import_user WHERE EXISTS ("
+        "SELECT 1 FROM email_address JOIN user_email ON user_email.email_id = email_address.id "
+        "WHERE email_address.email_address = import_user.email_address AND user_email.removed_at > %(now)s"
+        ") RETURNING line"
+    ),
+    (
+        "phone_number in use",
+        "DELETE FROM import_user WHERE EXISTS ("
+        "SELECT 1 FROM phone_number JOIN user_phone ON user_phone.phone_id = phone_number.id "
+        "WHERE phone_number.phone_number = import_user.phone_number AND user_phone.removed_at > %(now)s"
+        ") RETURNING line"
+    ),
+    (
+        "device_sn in use",
+        "DELETE FROM import_user WHERE EXISTS ("
+        "SELECT 1 FROM device JOIN user_device ON user_device.device_id = device.id "
+        "WHERE device.device_sn = import_user.device_sn AND user_device.removed_at > %(now)s"
+        ") RETURNING line"
+    ),
+)
+
+# Statements merging the remaining staged rows. Credentials are inserted in sorted order to lock them consistently,
+# existing ones are locked by a no-op update until commit so sweep_orphans cannot delete them before they are linked.
+MERGE_SQL = (
+    "UPDATE import_user SET user_id = nextval(pg_get_serial_sequence('app_user', 'id'))",
+    "INSERT INTO email_address (email_address, created_at) "
+    "SELECT email_address, created_at FROM import_user ORDER BY email_address "
+    "ON CONFLICT (email_address) DO UPDATE SET email_address = EXCLUDED.email_address",
+    "INSERT INTO phone_number (phone_number, created_at) "
+    "SELECT phone_number, created_at FROM import_user WHERE phone_number IS NOT NULL "
+    "ORDER BY phone_number ON CONFLICT (phone_number) DO UPDATE SET phone_number = EXCLUDED.phone_number",
+    "INSERT INTO device (device_name, device_sn, created_at) "
+    "SELECT device_name, device_sn, created_at FROM import_user WHERE device_sn IS NOT NULL "
+    "ORDER BY device_sn ON CONFLICT (device_sn) DO UPDATE SET device_sn = EXCLUDED.device_sn",
+    "INSERT INTO app_user (id, first_name, last_name, password_hash, birth_date, created_at, confirmed, active) "
+    "SELECT user_id, first_name, last_name, password_hash, birth_date, created_at, confirmed, TRUE "
+    "FROM import_user ORDER BY user_id",
+    "INSERT INTO user_email (user_id, email_id, confirmed, created_at, removed_at) "
+    "SELECT import_user.user_id, email_address.id, import_user.confirmed, import_user.created_at, '2100-01-01' "
+    "FROM import_user JOIN email_address ON email_address.email_address = import_user.email_address",
+    "INSERT INTO user_phone (user_id, phone_id, confirmed, created_at, removed_at) "
+    "SELECT import_user.user_id, phone_number.id, import_user.confirmed, import_user.created_at, '2100-01-01' "
+    "FROM import_user JOIN phone_number ON phone_number.phone_number = import_user.phone_number",
+    "INSERT INTO user_device (user_id, device_id, created_at, removed_at) "
+    "SELECT import_user.user_id, device.id, import_user.created_at, '2100-01-01' "
+    "FROM import_user JOIN device ON device.device_sn = import_user.device_sn",
+)
+
+
+# Records of a CSV file with a header line, as (line number, dict)
+def read_csv(file):
+    reader = csv.DictReader(file)
+    for record in reader:
+        yield reader.line_num, record
+
+
+# Records of a JSON Lines file, as (line number, dict), a line that is not a JSON object gives None
+def read_jsonl(file):
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else None
+
+
+# Parse a boolean written as true/false, 1/0, yes/no or a JSON boolean
+def parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("1", "true", "t", "yes", "y"):
+        return True
+    if text in ("0", "false", "f", "no", "n"):
+        return False
+    raise ValueError(value)
+
+
+# Staging row of a record, or None and the reason it is rejected
+def check_record(record, confirmed: bool, now: datetime):
+    if record is None:
+        return None, "invalid record"
+
+    values = {}
+    for field in IMPORT_FIELDS:
+        value = record.get(field)
+        if isinstance(value, str):
+            value = value.strip()
+        values[field] = None if value in (None, "") else value
+
+    for field in REQUIRED_FIELDS:
+        if values[field] is None:
+            return None, "missing " + field
+
+    # The same format checks as register, so imported credentials can be found by login
+    for field, check in (
+            ("first_name", is_name),
+            ("last_name", is_name),
+            ("email_address", is_email),
+            ("phone_number", is_phone),
+            ("device_name", is_device_name),
+            ("device_sn", is_device_sn),
+    ):
+        if values[field] is not None and not check(values[field]):
+            return None, "invalid " + field
+
+    if not BCRYPT_HASH.match(str(values["password_hash"])):
+        return None, "invalid password_hash"
+    if values["device_name"] is not None and values["device_sn"] is None:
+        return None, "device_name without device_sn"
+    if values["device_sn"] is not None and values["device_name"] is None:
+        return None, "device_sn without device_name"
+
+    if not is_birth_date(values["birth_date"]):
+        return None, "invalid birth_date"
+    if not isinstance(values["birth_date"], date):
+        values["birth_date"] = date.fromisoformat(values["birth_date"])
+    try:
+        if values["created_at"] is None:
+            values["created_at"] = now
+        elif not isinstance(values["created_at"], datetime):
+            values["created_at"] = datetime.fromisoformat(str(values["created_at"]))
+    except ValueError:
+        return None, "invalid created_at"
+    try:
+        values["confirmed"] = confirmed if values["confirmed"] is None else parse_bool(values["confirmed"])
+    except ValueError:
+        return None, "invalid confirmed"
+
+    return tuple(values[field] for field in IMPORT_FIELDS), None
+
+
+# File-like object feeding rows to COPY ... FROM STDIN as CSV, read by psycopg2 in chunks
+class CopyStream:
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.__buffer = io.StringIO()
+        self.__writer = csv.writer(self.__buffer, lineterminator="\n")
+        self.__pending = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.__pending) + self.__buffer.tell() < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.__writer.writerow(row)
+
+        self.__pending += self.__buffer.getvalue()
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+        if size < 0:
+            chunk, self.__pending = self.__pending, ""
+        else:
+            chunk, self.__pending = self.__pending[:size], self.__pending[size:]
+        return chunk
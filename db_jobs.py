@@ -0,0 +1,41 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# Background thread calling a function every interval seconds until stopped
+class PeriodicJob(threading.Thread):
+    def __init__(self, name: str, interval: float, function, delay: float = None):
+        super().__init__(name="job-" + name, daemon=True)
+        self.interval = interval
+        self.function = function
+        # Seconds before the first run, one interval by default so startup is not slowed down
+        self.delay = interval if delay is None else delay
+        self.__stopped = threading.Event()
+        self.__lock = threading.Lock()
+        self.__stats = {"runs": 0, "failures": 0, "last_result": None}
+
+    def run(self):
+        wait = self.delay
+        while not self.__stopped.wait(wait):
+            wait = self.interval
+            try:
+                result = self.function()
+            except Exception:
+                logger.warning("Job '%s' failed", self.name, exc_info=True)
+                with self.__lock:
+                    self.__stats["failures"] += 1
+                continue
+            with self.__lock:
+                self.__stats["runs"] += 1
+                self.__stats["last_result"] = result
+
+    # Stop the job, a run in progress is finished first
+    def stop(self):
+        self.__stopped.set()
+
+    # Run and failure counters and the result of the last run
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(self.__stats)
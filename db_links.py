@@ -0,0 +1,93 @@
+# SQL moving links between the active link tables and their history tables. An active table only holds links that
+# are current or scheduled for removal (removed_at in the future), removed links live in <table>_history.
+
+# Columns copied from each link table to its history table, removed_at excluded
+LINK_COLUMNS = {
+    "user_email": ("id", "user_id", "email_id", "confirmed", "created_at"),
+    "user_phone": ("id", "user_id", "phone_id", "confirmed", "created_at"),
+    "user_device": ("id", "user_id", "device_id", "created_at"),
+    "user_category": ("id", "user_id", "category_id", "created_at"),
+    "user_subscription": ("id", "user_id", "subscription_id", "created_at"),
+}
+
+# removed_at of links that were never removed, scheduled removals are found below it by a partial index
+REMOVED_AT_SENTINEL = "2100-01-01"
+
+
+# Move the active link of user_id matching a condition to the history table in one statement, returning its id
+def move_link_sql(table: str, condition: str) -> str:
+    columns = ", ".join(LINK_COLUMNS[table])
+    return (
+        "WITH moved AS ("
+        "DELETE FROM " + table + " WHERE user_id = %(user_id)s AND " + condition + " AND removed_at > %(now)s "
+        "RETURNING " + columns +
+        ") "
+        "INSERT INTO " + table + "_history (" + columns + ", removed_at) "
+        "SELECT " + columns + ", %(now)s FROM moved RETURNING id"
+    )
+
+
+# Move one batch of links whose scheduled removal has passed to the history table, keeping their removed_at
+def archive_links_sql(table: str) -> str:
+    columns = ", ".join(LINK_COLUMNS[table])
+    return (
+        "WITH moved AS ("
+        "DELETE FROM " + table + " WHERE id IN ("
+        "SELECT id FROM " + table + " WHERE removed_at <= %(now)s AND removed_at < '" + REMOVED_AT_SENTINEL + "' "
+        "ORDER BY id LIMIT %(batch_size)s FOR UPDATE SKIP LOCKED"
+        ") RETURNING " + columns + ", removed_at"
+        ") "
+        "INSERT INTO " + table + "_history (" + columns + ", removed_at) "
+        "SELECT " + columns + ", removed_at FROM moved"
+    )
+
+
+REMOVE_EMAIL_SQL = move_link_sql(
+    "user_email", "email_id = (SELECT id FROM email_address WHERE email_address = %(value)s)"
+)
+REMOVE_PHONE_SQL = move_link_sql(
+    "user_phone", "phone_id = (SELECT id FROM phone_number WHERE phone_number = %(value)s)"
+)
+REMOVE_DEVICE_SQL = move_link_sql(
+    "user_device", "device_id = (SELECT id FROM device WHERE device_sn = %(value)s)"
+)
+REMOVE_CATEGORY_SQL = move_link_sql("user_category", "category_id = %(value)s")
+REMOVE_SUBSCRIPTION_SQL = move_link_sql("user_subscription", "subscription_id = %(value)s")
+
+ARCHIVE_LINKS_SQL = {table: archive_links_sql(table) for table in LINK_COLUMNS}
+
+# Credential tables and the link column referencing them from <link table> and <link table>_history
+CREDENTIAL_TABLES = {
+    "email_address": ("user_email", "email_id"),
+    "phone_number": ("user_phone", "phone_id"),
+    "device": ("user_device", "device_id"),
+}
+
+
+# Rows of a credential table created before the cutoff that no active or removed link references
+def orphans_sql(table: str) -> str:
+    link_table, column = CREDENTIAL_TABLES[table]
+    return (
+        "FROM " + table + " WHERE " + table + ".created_at < %(cutoff)s "
+        "AND NOT EXISTS (SELECT 1 FROM " + link_table + " WHERE " + link_table + "." + column + " = " + table + ".id) "
+        "AND NOT EXISTS (SELECT 1 FROM " + link_table + "_history "
+        "WHERE " + link_table + "_history." + column + " = " + table + ".id)"
+    )
+
+
+# Delete one batch of orphans after an id, returning how many were deleted and the last id deleted. Rows a
+# registration or import is about to link are locked by its upsert (LOCK_CREDENTIALS_SQL) and skipped.
+def sweep_orphans_sql(table: str) -> str:
+    return (
+        "WITH batch AS ("
+        "SELECT id " + orphans_sql(table) + " AND " + table + ".id > %(after)s "
+        "ORDER BY id LIMIT %(batch_size)s FOR UPDATE SKIP LOCKED"
+        "), deleted AS ("
+        "DELETE FROM " + table + " WHERE id IN (SELECT id FROM batch) RETURNING id"
+        ") "
+        "SELECT count(*), max(id) FROM deleted"
+    )
+
+
+SWEEP_ORPHANS_SQL = {table: sweep_orphans_sql(table) for table in CREDENTIAL_TABLES}
+COUNT_ORPHANS_SQL = {table: "SELECT count(*) " + orphans_sql(table) for table in CREDENTIAL_TABLES}
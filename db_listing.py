@@ -0,0 +1,75 @@
+from datetime import datetime
+import base64
+import json
+from db_auth import PROFILE_JOINS_SQL
+
+# Filters of a user listing, each adds one condition on the app_user row
+LIST_FILTERS = {
+    "active": "app_user.active = %(active)s",
+    # Confirmed like remove_unconfirmed counts it: an active confirmed email address or phone number
+    "confirmed": (
+        "(EXISTS (SELECT 1 FROM user_email WHERE user_email.user_id = app_user.id AND user_email.confirmed "
+        "AND user_email.removed_at > %(now)s) "
+        "OR EXISTS (SELECT 1 FROM user_phone WHERE user_phone.user_id = app_user.id AND user_phone.confirmed "
+        "AND user_phone.removed_at > %(now)s)) = %(confirmed)s"
+    ),
+    "category_id": (
+        "EXISTS (SELECT 1 FROM user_category WHERE user_category.user_id = app_user.id "
+        "AND user_category.category_id = %(category_id)s AND user_category.removed_at > %(now)s)"
+    ),
+    # Prefixes are matched with LIKE 'prefix%', served by the text_pattern_ops indexes
+    "email_prefix": (
+        "EXISTS (SELECT 1 FROM user_email JOIN email_address ON email_address.id = user_email.email_id "
+        "WHERE user_email.user_id = app_user.id AND user_email.removed_at > %(now)s "
+        "AND email_address.email_address LIKE %(email_prefix)s)"
+    ),
+    "phone_prefix": (
+        "EXISTS (SELECT 1 FROM user_phone JOIN phone_number ON phone_number.id = user_phone.phone_id "
+        "WHERE user_phone.user_id = app_user.id AND user_phone.removed_at > %(now)s "
+        "AND phone_number.phone_number LIKE %(phone_prefix)s)"
+    ),
+    # Keyset condition, the page starts after the last row of the previous one
+    "after": "(app_user.created_at, app_user.id) < (%(after_created_at)s, %(after_id)s)",
+}
+
+
+# One page of users, newest first, walking the (created_at, id) index. Rows are shaped like USER_PROFILES_SQL
+# followed by created_at and active.
+def list_users_sql(filters) -> str:
+    conditions = " AND ".join(LIST_FILTERS[name] for name in filters) or "TRUE"
+    return (
+        "SELECT app_user.id, app_user.first_name, app_user.last_name, NULL, "
+        "app_user.birth_date, email.email_address, email.id, phone.phone_number, phone.id, "
+        "device.device_name, device.device_sn, device.id, NULL, "
+        "ARRAY(SELECT user_category.category_id FROM user_category "
+        "WHERE user_category.user_id = app_user.id AND user_category.removed_at > %(now)s "
+        "ORDER BY user_category.created_at), "
+        "app_user.created_at, app_user.active "
+        "FROM ("
+        "SELECT app_user.id FROM app_user WHERE " + conditions + " "
+        "ORDER BY app_user.created_at DESC, app_user.id DESC LIMIT %(limit)s"
+        ") AS page JOIN app_user ON app_user.id = page.id " + PROFILE_JOINS_SQL + " "
+        "ORDER BY app_user.created_at DESC, app_user.id DESC"
+    )
+
+
+# LIKE pattern matching the values starting with a prefix
+def like_prefix(prefix: str) -> str:
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+# Opaque cursor of the position after a row
+def encode_cursor(created_at: datetime, user_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), user_id]).encode()).decode()
+
+
+# (created_at, user id) of a cursor, raises ValueError if it was not made by encode_cursor
+def decode_cursor(cursor: str):
+    try:
+        created_at, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        created_at = datetime.fromisoformat(created_at)
+    except (TypeError, ValueError, AttributeError) as error:
+        raise ValueError("Invalid cursor") from error
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise ValueError("Invalid cursor")
+    return created_at, user_id
@@ -0,0 +1,269 @@
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Longest statement text kept in the slow query log
+MAX_STATEMENT_LENGTH = 1000
+
+# String literals and numbers inlined in a statement, e.g. by execute_values
+LITERAL = re.compile(r"[Ee]?'(?:[^']|'')*'|(?<![\w$])\d+(?:\.\d+)?\b")
+
+
+# Per operation counters, latency histograms, round trips and commits, and a slow query log
+class Metrics:
+    def __init__(self, slow_query_seconds: float = 0.2, slow_query_log_size: int = 100):
+        self.slow_query_seconds = slow_query_seconds
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__operations = {}
+        self.__queries = 0
+        self.__commits = 0
+        self.__slow_queries = deque(maxlen=slow_query_log_size)
+        self.__slow_query_count = 0
+
+    # Private methods
+    # Counters of an operation, created on first use (lock must be held)
+    def __operation(self, name: str) -> dict:
+        operation = self.__operations.get(name)
+        if operation is None:
+            operation = {
+                "calls": 0,
+                "errors": 0,
+                "round_trips": 0,
+                "commits": 0,
+                "seconds_sum": 0.0,
+                "buckets": [0] * len(BUCKETS),
+            }
+            self.__operations[name] = operation
+        return operation
+
+    # Operations running on the current thread, outermost first
+    def __running(self) -> list:
+        running = getattr(self.__local, "running", None)
+        if running is None:
+            running = self.__local.running = []
+        return running
+
+    # Public methods
+    # Measure a block as one call of an operation, statements run inside it are counted for it
+    @contextmanager
+    def timer(self, name: str):
+        running = self.__running()
+        running.append(name)
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            running.pop()
+            with self.__lock:
+                operation = self.__operation(name)
+                operation["calls"] += 1
+                operation["errors"] += failed
+                operation["seconds_sum"] += elapsed
+                for index, bound in enumerate(BUCKETS):
+                    if elapsed <= bound:
+                        operation["buckets"][index] += 1
+                        break
+
+    # Count a statement sent to the server and log it when slow, parameter values are never logged
+    def query(self, statement: str, params, seconds: float):
+        names = set(self.__running())
+        with self.__lock:
+            self.__queries += 1
+            for name in names:
+                self.__operation(name)["round_trips"] += 1
+
+            if seconds < self.slow_query_seconds:
+                return
+            self.__slow_query_count += 1
+            entry = {
+                "statement": redact_statement(statement),
+                "params": redact(params),
+                "seconds": seconds,
+                "operations": list(self.__running()),
+                "at": time.time(),
+            }
+            self.__slow_queries.append(entry)
+        logger.warning("Slow query (%.3fs) in %s: %s %s", seconds, entry["operations"], entry["statement"],
+                       entry["params"])
+
+    # Count a commit
+    def commit(self):
+        names = set(self.__running())
+        with self.__lock:
+            self.__commits += 1
+            for name in names:
+                self.__operation(name)["commits"] += 1
+
+    # Plain dict of every metric, for tests and JSON endpoints
+    def as_dict(self) -> dict:
+        with self.__lock:
+            operations = {}
+            for name, operation in self.__operations.items():
+                operations[name] = dict(operation)
+                cumulative = 0
+                operations[name]["buckets"] = {}
+                for bound, count in zip(BUCKETS, operation["buckets"]):
+                    cumulative += count
+                    operations[name]["buckets"][bound] = cumulative
+                operations[name]["buckets"]["+Inf"] = operation["calls"]
+            return {
+                "operations": operations,
+                "queries": self.__queries,
+                "commits": self.__commits,
+                "slow_query_count": self.__slow_query_count,
+                "slow_queries": list(self.__slow_queries),
+            }
+
+    # Metrics in the Prometheus text exposition format
+    def prometheus(self, prefix: str = "database") -> str:
+        data = self.as_dict()
+        operations = sorted(data["operations"].items())
+        lines = []
+
+        def family(name, kind, description):
+            lines.append("# HELP %s_%s %s" % (prefix, name, description))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+        for key, name, description in (
+                ("calls", "calls_total", "Calls per operation"),
+                ("errors", "errors_total", "Calls per operation that raised an exception"),
+                ("round_trips", "round_trips_total", "Statements sent to the server per operation"),
+                ("commits", "commits_total", "Commits per operation"),
+        ):
+            family(name, "counter", description)
+            for operation, values in operations:
+                lines.append('%s_%s{operation="%s"} %s' % (prefix, name, operation, values[key]))
+
+        family("operation_seconds", "histogram", "Latency per operation")
+        for operation, values in operations:
+            for bound, count in values["buckets"].items():
+                lines.append('%s_operation_seconds_bucket{operation="%s",le="%s"} %s' % (prefix, operation, bound, count))
+            lines.append('%s_operation_seconds_sum{operation="%s"} %s' % (prefix, operation, values["seconds_sum"]))
+            lines.append('%s_operation_seconds_count{operation="%s"} %s' % (prefix, operation, values["calls"]))
+
+        for key, name, description in (
+                ("queries", "queries_total", "Statements sent to the server"),
+                ("commits", "transactions_committed_total", "Commits"),
+                ("slow_query_count", "slow_queries_total", "Statements slower than the slow query threshold"),
+        ):
+            family(name, "counter", description)
+            lines.append("%s_%s %s" % (prefix, name, data[key]))
+
+        return "\n".join(lines) + "\n"
+
+
+# Statement text with inlined literals replaced by ?, cut to MAX_STATEMENT_LENGTH
+def redact_statement(statement) -> str:
+    if isinstance(statement, bytes):
+        statement = statement.decode(errors="replace")
+    elif not isinstance(statement, str):
+        statement = str(statement)
+    statement = LITERAL.sub("?", statement)
+    if len(statement) > MAX_STATEMENT_LENGTH:
+        statement = statement[:MAX_STATEMENT_LENGTH] + "..."
+    return statement
+
+
+# Parameter names and types of a statement, without their values
+def redact(params):
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: type(value).__name__ for key, value in params.items()}
+    return [type(value).__name__ for value in params]
+
+
+# Record a method of an object with a metrics attribute as one operation, named after the method
+def instrumented(method):
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.timer(name):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# psycopg2 connection class counting statements, COPYs, server-side cursor fetches, rollbacks and commits, created
+# lazily so psycopg2 stays optional here
+def instrumented_connection(metrics):
+    from psycopg2.extensions import STATUS_BEGIN, connection, cursor
+
+    # Run a call that sends one statement to the server and count it
+    def timed(statement, vars, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            metrics.query(statement, vars, time.perf_counter() - started)
+
+    class InstrumentedCursor(cursor):
+        def execute(self, query, vars=None):
+            return timed(query, vars, super().execute, query, vars)
+
+        def copy_expert(self, sql, file, size=8192):
+            return timed(sql, None, super().copy_expert, sql, file, size)
+
+        # Rows of a named (server-side) cursor are fetched with one FETCH each call, client-side cursors hold them all
+        def fetchone(self):
+            if self.name is None:
+                return super().fetchone()
+            return timed("FETCH FORWARD 1 FROM " + self.name, None, super().fetchone)
+
+        def fetchmany(self, size=None):
+            if size is None:
+                size = self.arraysize
+            if self.name is None:
+                return super().fetchmany(size)
+            return timed("FETCH FORWARD %d FROM %s" % (size, self.name), None, super().fetchmany, size)
+
+        def fetchall(self):
+            if self.name is None:
+                return super().fetchall()
+            return timed("FETCH FORWARD ALL FROM " + self.name, None, super().fetchall)
+
+        # Iterating a named cursor fetches itersize rows at a time
+        def __iter__(self):
+            if self.name is None:
+                return super().__iter__()
+            return self.__batches()
+
+        def __batches(self):
+            while True:
+                rows = self.fetchmany(self.itersize)
+                if not rows:
+                    return
+                yield from rows
+
+    class InstrumentedConnection(connection):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.cursor_factory = InstrumentedCursor
+
+        def commit(self):
+            super().commit()
+            metrics.commit()
+
+        # Only a rollback of an open transaction is sent to the server
+        def rollback(self):
+            if self.status != STATUS_BEGIN:
+                return super().rollback()
+            return timed("ROLLBACK", None, super().rollback)
+
+    return InstrumentedConnection
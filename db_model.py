@@ -2,10 +2,10 @@ import sqlalchemy.dialects.postgresql
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from dotenv import dotenv_values
+from db_config import config
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = dotenv_values(".env")["DB_URI"]
+app.config['SQLALCHEMY_DATABASE_URI'] = config["DB_URI"]
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
@@ -22,6 +22,10 @@ class AppUser(db.Model):
     birth_date = db.Column(db.Date, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_app_user_created_at_id', 'created_at', 'id'),
+    )
+
 
 class EmailAddress(db.Model):
     __tablename__ = 'email_address'
@@ -29,6 +33,13 @@ class EmailAddress(db.Model):
     email_address = db.Column(db.String(50), nullable=False, unique=True)
     created_at = db.Column(db.DateTime, nullable=False)
 
+    __table_args__ = (
+        db.Index(
+            'ix_email_address_email_address_pattern', 'email_address',
+            postgresql_ops={'email_address': 'text_pattern_ops'}
+        ),
+    )
+
 
 class UserEmail(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -38,6 +49,14 @@ class UserEmail(db.Model):
     created_at = db.Column(db.DateTime, nullable=False)
     removed_at = db.Column(db.DateTime, nullable=True, default='2100-01-01 00:00:00')
 
+    __table_args__ = (
+        db.Index('ix_user_email_email_id_removed_at', 'email_id', 'removed_at'),
+        db.Index('ix_user_email_user_id_removed_at', 'user_id', 'removed_at'),
+        db.Index(
+            'ix_user_email_removed_at_scheduled', 'removed_at', postgresql_where=db.text("removed_at < '2100-01-01'")
+        ),
+    )
+
 
 class PhoneNumber(db.Model):
     __tablename__ = 'phone_number'
@@ -45,6 +64,12 @@ class PhoneNumber(db.Model):
     phone_number = db.Column(db.String(50), nullable=False, unique=True)
     created_at = db.Column(db.DateTime, nullable=False)
 
+    __table_args__ = (
+        db.Index(
+            'ix_phone_number_phone_number_pattern', 'phone_number', postgresql_ops={'phone_number': 'text_pattern_ops'}
+        ),
+    )
+
 
 class UserPhone(db.Model):
     __tablename__ = 'user_phone'
@@ -55,6 +80,14 @@ class UserPhone(db.Model):
     created_at = db.Column(db.DateTime, nullable=False)
     removed_at = db.Column(db.DateTime, nullable=True, default='2100-01-01 00:00:00')
 
+    __table_args__ = (
+        db.Index('ix_user_phone_phone_id_removed_at', 'phone_id', 'removed_at'),
+        db.Index('ix_user_phone_user_id_removed_at', 'user_id', 'removed_at'),
+        db.Index(
+            'ix_user_phone_removed_at_scheduled', 'removed_at', postgresql_where=db.text("removed_at < '2100-01-01'")
+        ),
+    )
+
 
 class Device(db.Model):
     __tablename__ = 'device'
@@ -72,6 +105,14 @@ class UserDevice(db.Model):
     created_at = db.Column(db.DateTime, nullable=False)
     removed_at = db.Column(db.DateTime, nullable=True, default='2100-01-01 00:00:00')
 
+    __table_args__ = (
+        db.Index('ix_user_device_device_id_removed_at', 'device_id', 'removed_at'),
+        db.Index('ix_user_device_user_id_removed_at', 'user_id', 'removed_at'),
+        db.Index(
+            'ix_user_device_removed_at_scheduled', 'removed_at', postgresql_where=db.text("removed_at < '2100-01-01'")
+        ),
+    )
+
 
 class Category(db.Model):
     __tablename__ = 'category'
@@ -88,6 +129,14 @@ class UserCategory(db.Model):
     created_at = db.Column(db.DateTime, nullable=False)
     removed_at = db.Column(db.DateTime, nullable=True, default='2100-01-01 00:00:00')
 
+    __table_args__ = (
+        db.Index('ix_user_category_user_id_removed_at', 'user_id', 'removed_at'),
+        db.Index('ix_user_category_category_id_removed_at', 'category_id', 'removed_at'),
+        db.Index(
+            'ix_user_category_removed_at_scheduled', 'removed_at', postgresql_where=db.text("removed_at < '2100-01-01'")
+        ),
+    )
+
 
 class SubscriptionType(db.Model):
     __tablename__ = 'subscription_type'
@@ -103,8 +152,14 @@ class Subscription(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subscription_type_id = db.Column(db.Integer, db.ForeignKey('subscription_type.id'), nullable=False)
     valid_from = db.Column(db.DateTime, nullable=False)
+    # valid_from plus the months of the type when it was bought, stored as the type may change later
+    valid_until = db.Column(db.DateTime, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_subscription_valid_until', 'valid_until'),
+    )
+
 
 class UserSubscription(db.Model):
     __tablename__ = 'user_subscription'
@@ -113,3 +168,99 @@ class UserSubscription(db.Model):
     subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
     removed_at = db.Column(db.DateTime, nullable=True, default='2100-01-01 00:00:00')
+
+    __table_args__ = (
+        db.Index('ix_user_subscription_user_id_removed_at', 'user_id', 'removed_at'),
+        db.Index('ix_user_subscription_subscription_id_removed_at', 'subscription_id', 'removed_at'),
+        db.Index(
+            'ix_user_subscription_removed_at_scheduled', 'removed_at',
+            postgresql_where=db.text("removed_at < '2100-01-01'")
+        ),
+    )
+
+
+class UserEmailHistory(db.Model):
+    __tablename__ = 'user_email_history'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('app_user.id'), nullable=False)
+    email_id = db.Column(db.Integer, db.ForeignKey('email_address.id'), nullable=False)
+    confirmed = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    removed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_user_email_history_user_id', 'user_id'),
+        db.Index('ix_user_email_history_email_id', 'email_id'),
+    )
+
+
+class UserPhoneHistory(db.Model):
+    __tablename__ = 'user_phone_history'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('app_user.id'), nullable=False)
+    phone_id = db.Column(db.Integer, db.ForeignKey('phone_number.id'), nullable=False)
+    confirmed = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    removed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_user_phone_history_user_id', 'user_id'),
+        db.Index('ix_user_phone_history_phone_id', 'phone_id'),
+    )
+
+
+class UserDeviceHistory(db.Model):
+    __tablename__ = 'user_device_history'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('app_user.id'), nullable=False)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    removed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_user_device_history_user_id', 'user_id'),
+        db.Index('ix_user_device_history_device_id', 'device_id'),
+    )
+
+
+class UserCategoryHistory(db.Model):
+    __tablename__ = 'user_category_history'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('app_user.id'), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    removed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_user_category_history_user_id', 'user_id'),
+    )
+
+
+class UserSubscriptionHistory(db.Model):
+    __tablename__ = 'user_subscription_history'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('app_user.id'), nullable=False)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    removed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_user_subscription_history_user_id', 'user_id'),
+        db.Index('ix_user_subscription_history_subscription_id', 'subscription_id'),
+    )
+
+
+class SeedState(db.Model):
+    __tablename__ = 'seed_state'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+
+# Login throttle buckets shared by every worker, unlogged as losing them on a crash only resets the limits
+class LoginThrottle(db.Model):
+    __tablename__ = 'login_throttle'
+    key = db.Column(db.String(64), primary_key=True)
+    refilled_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    __table_args__ = {'prefixes': ['UNLOGGED']}
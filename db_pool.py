@@ -0,0 +1,198 @@
+import threading
+import time
+
+
+class PoolError(Exception):
+    pass
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(
+            self,
+            connect,
+            min_size: int = 1,
+            max_size: int = 10,
+            timeout: float = None,
+            max_idle: float = 600.0,
+            check_idle: float = 30.0
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: min_size=%s, max_size=%s" % (min_size, max_size))
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        # Seconds to wait for a free connection, None waits forever
+        self.timeout = timeout
+        # Seconds after which idle connections above min_size are closed
+        self.max_idle = max_idle
+        # Seconds of idleness after which a connection is pinged before being handed out
+        self.check_idle = check_idle
+
+        self.__lock = threading.Condition()
+        self.__idle = []
+        self.__size = 0
+        self.__in_use = 0
+        self.__waiting = 0
+        self.__closed = False
+        self.__stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "opened": 0,
+            "closed": 0,
+            "recycled": 0,
+            "failed_checks": 0,
+            "peak_in_use": 0,
+            "peak_waiting": 0,
+            "wait_time": 0.0,
+        }
+
+        for _ in range(min_size):
+            self.__size += 1
+            self.__idle.append((self.__open(), time.monotonic()))
+
+    # Private methods
+    # Open a new connection and count it
+    def __open(self):
+        connection = self.connect()
+        self.__stats["opened"] += 1
+        return connection
+
+    # Close a connection, ignoring errors from already broken connections
+    def __close(self, connection):
+        self.__stats["closed"] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    # Check that an idle connection is still usable before handing it out
+    def __healthy(self, connection, idle_for: float) -> bool:
+        if connection.closed:
+            return False
+        if idle_for < self.check_idle:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    # Close connections above min_size that stayed idle for longer than max_idle (lock must be held)
+    def __recycle_idle(self, now: float):
+        expired = []
+        while self.__size - len(expired) > self.min_size and self.__idle and now - self.__idle[0][1] > self.max_idle:
+            expired.append(self.__idle.pop(0)[0])
+        self.__size -= len(expired)
+        self.__stats["recycled"] += len(expired)
+        return expired
+
+    # Public methods
+    # Borrow a connection, waiting at most timeout seconds for one to become free
+    def getconn(self):
+        started = time.monotonic()
+        deadline = None if self.timeout is None else started + self.timeout
+        connection = None
+        returned_at = None
+
+        with self.__lock:
+            self.__waiting += 1
+            self.__stats["peak_waiting"] = max(self.__stats["peak_waiting"], self.__waiting)
+            try:
+                while True:
+                    if self.__closed:
+                        raise PoolError("Connection pool is closed")
+
+                    expired = self.__recycle_idle(time.monotonic())
+                    for stale in expired:
+                        self.__close(stale)
+
+                    # Reuse the most recently returned connection first, so the rest can age out
+                    if self.__idle:
+                        connection, returned_at = self.__idle.pop()
+                        break
+
+                    # Reserve a slot and open the connection outside the lock
+                    if self.__size < self.max_size:
+                        self.__size += 1
+                        break
+
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.__stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            "No database connection available after %.1f seconds (max_size=%s)"
+                            % (self.timeout, self.max_size)
+                        )
+                    self.__lock.wait(remaining)
+            finally:
+                self.__waiting -= 1
+
+        try:
+            if connection is None:
+                connection = self.__open()
+            elif not self.__healthy(connection, time.monotonic() - returned_at):
+                self.__stats["failed_checks"] += 1
+                self.__close(connection)
+                connection = self.__open()
+        except Exception:
+            with self.__lock:
+                self.__size -= 1
+                self.__lock.notify()
+            raise
+
+        with self.__lock:
+            self.__in_use += 1
+            self.__stats["checkouts"] += 1
+            self.__stats["wait_time"] += time.monotonic() - started
+            self.__stats["peak_in_use"] = max(self.__stats["peak_in_use"], self.__in_use)
+        return connection
+
+    # Return a borrowed connection, rolling back any transaction left open
+    def putconn(self, connection, discard: bool = False):
+        if not discard and not connection.closed:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+
+        with self.__lock:
+            self.__in_use -= 1
+            if discard or connection.closed or self.__closed:
+                self.__size -= 1
+                self.__close(connection)
+            else:
+                self.__idle.append((connection, time.monotonic()))
+            self.__lock.notify()
+
+    # Close every idle connection and refuse further checkouts
+    def closeall(self):
+        with self.__lock:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+            self.__size -= len(idle)
+            self.__lock.notify_all()
+        for connection, _ in idle:
+            self.__close(connection)
+
+    # Snapshot of the pool size and saturation counters
+    def stats(self) -> dict:
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats.update({
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self.__size,
+                "idle": len(self.__idle),
+                "in_use": self.__in_use,
+                "waiting": self.__waiting,
+                "saturation": self.__in_use / self.max_size,
+            })
+        return stats
@@ -0,0 +1,127 @@
+from db_pool import PoolTimeout
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds the replica is behind the primary, 0 when it has replayed everything it received, NULL if unknown
+REPLICA_LAG_SQL = (
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+# Raised when a query on a replica connection fails, the caller may run it again on the primary
+class ReplicaError(Exception):
+    pass
+
+
+# Connection pools of read replicas, handed out round-robin while their replication lag is below max_lag
+class ReplicaSet:
+    def __init__(self, pools, max_lag: float = 5.0, check_interval: float = 1.0, retry_after: float = 30.0):
+        if not pools:
+            raise ValueError("At least one replica pool is required")
+        self.pools = list(pools)
+        # Seconds of replication lag above which a replica is skipped
+        self.max_lag = max_lag
+        # Seconds between lag measurements of a replica, measured on the connection about to be used
+        self.check_interval = check_interval
+        # Seconds a replica that failed is skipped
+        self.retry_after = retry_after
+
+        self.__lock = threading.Lock()
+        self.__next = 0
+        self.__state = [{"lag": None, "checked_at": None, "down_until": 0.0} for _ in self.pools]
+        self.__stats = {"reads": 0, "fallbacks": 0, "lagging": 0, "failures": 0}
+
+    # Private methods
+    # Measure the lag of a replica on one of its connections, None when unknown
+    def __measure(self, connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(REPLICA_LAG_SQL)
+            lag = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+        return None if lag is None else float(lag)
+
+    # Count an event
+    def __count(self, key: str):
+        with self.__lock:
+            self.__stats[key] += 1
+
+    # Public methods
+    # Borrow a connection from the next usable replica, returning (replica index, connection) or (None, None)
+    def getconn(self):
+        with self.__lock:
+            start = self.__next
+            self.__next = (self.__next + 1) % len(self.pools)
+
+        for offset in range(len(self.pools)):
+            index = (start + offset) % len(self.pools)
+            state = self.__state[index]
+            now = time.monotonic()
+            if state["down_until"] > now:
+                continue
+            due = state["checked_at"] is None or now - state["checked_at"] >= self.check_interval
+            if not due and (state["lag"] is None or state["lag"] > self.max_lag):
+                continue
+
+            pool = self.pools[index]
+            try:
+                connection = pool.getconn()
+            except PoolTimeout:
+                # Busy, not broken
+                continue
+            except Exception:
+                self.mark_down(index)
+                continue
+
+            if due:
+                try:
+                    lag = self.__measure(connection)
+                except Exception:
+                    pool.putconn(connection, discard=True)
+                    self.mark_down(index)
+                    continue
+                with self.__lock:
+                    state["lag"] = lag
+                    state["checked_at"] = now
+                if lag is None or lag > self.max_lag:
+                    pool.putconn(connection)
+                    self.__count("lagging")
+                    continue
+
+            self.__count("reads")
+            return index, connection
+
+        self.__count("fallbacks")
+        return None, None
+
+    # Return a connection borrowed with getconn
+    def putconn(self, index: int, connection, discard: bool = False):
+        self.pools[index].putconn(connection, discard=discard)
+
+    # Skip a replica for retry_after seconds
+    def mark_down(self, index: int):
+        logger.warning("Replica %d is unavailable, reading from the primary for %ss", index, self.retry_after)
+        with self.__lock:
+            self.__state[index]["down_until"] = time.monotonic() + self.retry_after
+            self.__stats["failures"] += 1
+
+    # Close every replica connection
+    def closeall(self):
+        for pool in self.pools:
+            pool.closeall()
+
+    # Read, fallback, lag and failure counters, and the last measured lag and pool counters of each replica
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["replicas"] = [
+                {"lag": state["lag"], "down": state["down_until"] > now, "pool": pool.stats()}
+                for state, pool in zip(self.__state, self.pools)
+            ]
+        return stats
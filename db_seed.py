@@ -0,0 +1,30 @@
+# Reference data written to the database on startup
+
+# Version of the reference data below, increase it with every change. Startup seeds only when it is newer than the
+# stored version, so processes of an older release never write back their data during a rolling deploy.
+SEED_VERSION = 1
+
+# Subscription prices per category, for each entry of SUBSCRIPTION_MONTHS
+SUBSCRIPTION_MONTHS = (1, 3, 6)
+SUBSCRIPTION_PRICES = {
+    "G": (234, 594, 972),
+    "ST": (164, 416, 680),
+    "E": (117, 297, 486),
+    "AE": (234, 594, 972),
+    "FM": (140, 356, 583),
+    "FC": (117, 297, 483),
+    "DI": (164, 416, 680),
+    "DM": (164, 416, 680),
+}
+
+# User categories
+USER_CATEGORIES = (
+    "general",
+    "student",
+    "elev",
+    "agent economic",
+    "familie monoparentala",
+    "familie cu multi copii",
+    "personal didactic",
+    "personal medical",
+)
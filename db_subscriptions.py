@@ -0,0 +1,57 @@
+from collections import namedtuple
+
+# Subscription of a user, subscription_type is the SubscriptionType of the reference cache
+UserSubscription = namedtuple(
+    "UserSubscription", ["user_id", "subscription_id", "subscription_type", "valid_from", "valid_until"]
+)
+
+# Lock the user so concurrent subscriptions of the same user start one after the other
+LOCK_USER_SQL = "SELECT 1 FROM app_user WHERE id = %(user_id)s FOR NO KEY UPDATE"
+
+# Insert a subscription and link it to the user in one statement. Without valid_from it starts when the active
+# subscriptions of the user end, or now.
+SUBSCRIBE_SQL = (
+    "WITH start AS ("
+    "SELECT COALESCE(%(valid_from)s, GREATEST(%(now)s, ("
+    "SELECT max(subscription.valid_until) FROM user_subscription "
+    "JOIN subscription ON subscription.id = user_subscription.subscription_id "
+    "WHERE user_subscription.user_id = %(user_id)s AND user_subscription.removed_at > %(now)s"
+    "))) AS valid_from"
+    "), new_subscription AS ("
+    "INSERT INTO subscription (subscription_type_id, valid_from, valid_until, created_at) "
+    "SELECT %(subscription_type_id)s, start.valid_from, start.valid_from + make_interval(months => %(months)s), "
+    "%(now)s FROM start "
+    "RETURNING id, valid_from, valid_until"
+    "), new_user_subscription AS ("
+    "INSERT INTO user_subscription (user_id, subscription_id, created_at, removed_at) "
+    "SELECT %(user_id)s, new_subscription.id, %(now)s, '2100-01-01' FROM new_subscription"
+    ") "
+    "SELECT id, valid_from, valid_until FROM new_subscription"
+)
+
+# Subscription in force now of each user, the one ending last when several overlap
+ACTIVE_SUBSCRIPTIONS_SQL = (
+    "SELECT DISTINCT ON (user_subscription.user_id) user_subscription.user_id, subscription.id, "
+    "subscription.subscription_type_id, subscription.valid_from, subscription.valid_until "
+    "FROM user_subscription JOIN subscription ON subscription.id = user_subscription.subscription_id "
+    "WHERE user_subscription.user_id = ANY(%(user_ids)s) AND user_subscription.removed_at > %(now)s "
+    "AND subscription.valid_from <= %(now)s AND subscription.valid_until > %(now)s "
+    "ORDER BY user_subscription.user_id, subscription.valid_until DESC"
+)
+
+# Actively linked subscriptions ending in [start, end) that no later subscription of their user extends, in
+# order of their end
+EXPIRING_SUBSCRIPTIONS_SQL = (
+    "SELECT user_subscription.user_id, subscription.id, subscription.subscription_type_id, "
+    "subscription.valid_from, subscription.valid_until "
+    "FROM subscription JOIN user_subscription ON user_subscription.subscription_id = subscription.id "
+    "WHERE subscription.valid_until >= %(start)s AND subscription.valid_until < %(end)s "
+    "AND user_subscription.removed_at > %(now)s "
+    "AND NOT EXISTS ("
+    "SELECT 1 FROM user_subscription AS later_link "
+    "JOIN subscription AS later ON later.id = later_link.subscription_id "
+    "WHERE later_link.user_id = user_subscription.user_id AND later_link.removed_at > %(now)s "
+    "AND later.valid_until > subscription.valid_until"
+    ") "
+    "ORDER BY subscription.valid_until, subscription.id"
+)
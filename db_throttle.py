@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from datetime import timedelta
+import hashlib
+import threading
+import time
+
+# Token buckets kept as the time each bucket is full again (generic cell rate algorithm). An attempt is allowed while
+# that time is less than burst - 1 intervals ahead, and moves it one interval later, so a key gets burst attempts at
+# once and then one per interval. An attempt takes a token from every bucket only when each has one, so rejected
+# attempts change nothing.
+
+
+# Lock the buckets of an attempt, creating missing ones full, and return how many seconds each is full ahead of now.
+# The no-op update locks existing rows and reads their latest version, keys are sorted so attempts lock in one order.
+LOCK_LOGIN_THROTTLE_SQL = (
+    "INSERT INTO login_throttle AS throttle (key, refilled_at) "
+    "SELECT key, now() FROM unnest(%(keys)s::text[]) AS key ORDER BY key "
+    "ON CONFLICT (key) DO UPDATE SET refilled_at = throttle.refilled_at "
+    "RETURNING key, EXTRACT(EPOCH FROM refilled_at - now())::float8"
+)
+
+# Take one token from each locked bucket of an allowed attempt
+TAKE_LOGIN_THROTTLE_SQL = (
+    "UPDATE login_throttle AS throttle SET refilled_at = GREATEST(throttle.refilled_at, now()) + take.step "
+    "FROM unnest(%(keys)s::text[], %(intervals)s::interval[]) AS take (key, step) WHERE throttle.key = take.key"
+)
+
+# Buckets that are full again hold no information
+PURGE_LOGIN_THROTTLE_SQL = "DELETE FROM login_throttle WHERE refilled_at < now()"
+
+
+# Login attempt limits per credential and per caller supplied client key (e.g. an IP address)
+class Throttle:
+    def __init__(
+            self,
+            per_minute: float = 10.0,
+            burst: int = 5,
+            client_per_minute: float = 300.0,
+            client_burst: int = 60,
+            max_keys: int = 100000
+    ):
+        self.interval = 60.0 / per_minute
+        self.tolerance = (burst - 1) * self.interval
+        self.client_interval = 60.0 / client_per_minute
+        self.client_tolerance = (client_burst - 1) * self.client_interval
+        # Least recently used keys are forgotten above max_keys, bounding memory under attacks rotating keys
+        self.max_keys = max_keys
+
+        self.__buckets = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__stats = {"allowed": 0, "rejected": 0, "evicted": 0}
+
+    # Limits of the buckets an attempt takes a token from
+    def __checks(self, key: str, client_key):
+        checks = [("credential:" + key, self.interval, self.tolerance)]
+        if client_key is not None:
+            checks.append(("client:" + str(client_key), self.client_interval, self.client_tolerance))
+        return checks
+
+    # Take a token for an attempt in memory, returning 0 when allowed or the seconds until it would be
+    def acquire(self, key: str, client_key=None) -> float:
+        checks = self.__checks(key, client_key)
+        now = time.monotonic()
+        with self.__lock:
+            wait = 0.0
+            for bucket, _, tolerance in checks:
+                refilled_at = self.__buckets.get(bucket)
+                if refilled_at is not None:
+                    wait = max(wait, refilled_at - tolerance - now)
+            if wait > 0:
+                self.__stats["rejected"] += 1
+                return wait
+
+            for bucket, interval, _ in checks:
+                self.__buckets[bucket] = max(self.__buckets.get(bucket, now), now) + interval
+                self.__buckets.move_to_end(bucket)
+            while len(self.__buckets) > self.max_keys:
+                self.__buckets.popitem(last=False)
+                self.__stats["evicted"] += 1
+            self.__stats["allowed"] += 1
+            return 0.0
+
+    # Buckets of an attempt in the shared table as (key, interval, tolerance), sorted by key. Keys are hashed so no
+    # credential is stored.
+    def shared_checks(self, key: str, client_key=None) -> list:
+        return sorted(
+            (hashlib.sha256(bucket.encode()).hexdigest(), timedelta(seconds=interval), tolerance)
+            for bucket, interval, tolerance in self.__checks(key, client_key)
+        )
+
+    # Seconds until an attempt is allowed given how far ahead of now each of its shared buckets is full, 0 if it is
+    def shared_wait(self, checks: list, ahead: dict) -> float:
+        return max([0.0] + [ahead[key] - tolerance for key, _, tolerance in checks])
+
+    # Count an attempt decided by the shared buckets
+    def count(self, allowed: bool):
+        with self.__lock:
+            self.__stats["allowed" if allowed else "rejected"] += 1
+
+    # Allowed, rejected and evicted counters and the number of tracked keys
+    def stats(self) -> dict:
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["keys"] = len(self.__buckets)
+        return stats
@@ -0,0 +1,70 @@
+from datetime import date, datetime
+import re
+
+# Input checks run before any database work or hashing, patterns are compiled once at import
+
+# Longest value of the varchar(50) name, email address and phone number columns
+MAX_LENGTH = 50
+
+# Shortest accepted password, and the longest bcrypt can use (it ignores bytes beyond 72)
+MIN_PASSWORD_LENGTH = 8
+MAX_PASSWORD_BYTES = 72
+
+EMAIL = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,7}")
+
+# Moldovan mobile numbers: 6xxxxxxx or 7xxxxxxx, optionally prefixed with 0 or +373
+PHONE = re.compile(r"(?:\+373|0)?[67]\d{7}")
+
+DEVICE_SN = re.compile(r"[A-Za-z0-9]{11}")
+
+# Letters, with single spaces, hyphens or apostrophes between them (e.g. "Anne-Marie", "O'Neil")
+NAME = re.compile(r"[^\W\d_]+(?:[ '-][^\W\d_]+)*")
+
+
+def is_email(value) -> bool:
+    return isinstance(value, str) and len(value) <= MAX_LENGTH and EMAIL.fullmatch(value) is not None
+
+
+def is_phone(value) -> bool:
+    return isinstance(value, str) and PHONE.fullmatch(value) is not None
+
+
+def is_device_sn(value) -> bool:
+    return isinstance(value, str) and DEVICE_SN.fullmatch(value) is not None
+
+
+def is_name(value) -> bool:
+    return isinstance(value, str) and len(value) <= MAX_LENGTH and NAME.fullmatch(value) is not None
+
+
+# Device name of the NOT NULL varchar(50) column, not blank
+def is_device_name(value) -> bool:
+    return isinstance(value, str) and bool(value.strip()) and len(value) <= MAX_LENGTH
+
+
+# Birth date as a date or an ISO 8601 string (YYYY-MM-DD), not in the future
+def is_birth_date(value) -> bool:
+    if isinstance(value, str):
+        try:
+            value = date.fromisoformat(value)
+        except ValueError:
+            return False
+    return isinstance(value, date) and not isinstance(value, datetime) and value <= date.today()
+
+
+# Password error message, or None when it is valid
+def password_error(value):
+    if not isinstance(value, str) or len(value) < MIN_PASSWORD_LENGTH:
+        return "Invalid password, must be at least %d characters long" % MIN_PASSWORD_LENGTH
+    if len(value.encode()) > MAX_PASSWORD_BYTES:
+        return "Invalid password, must be at most %d bytes long" % MAX_PASSWORD_BYTES
+    return None
+
+
+# "email" or "phone" for a login credential, or None if it is neither
+def credential_kind(value):
+    if is_email(value):
+        return "email"
+    if is_phone(value):
+        return "phone"
+    return None
@@ -1,3 +1,8 @@
+DROP TABLE IF EXISTS user_category_history;
+DROP TABLE IF EXISTS user_device_history;
+DROP TABLE IF EXISTS user_email_history;
+DROP TABLE IF EXISTS user_phone_history;
+DROP TABLE IF EXISTS user_subscription_history;
 DROP TABLE IF EXISTS user_category;
 DROP SEQUENCE IF EXISTS user_category_id_seq;
 DROP TABLE IF EXISTS user_device;
@@ -22,4 +27,7 @@ DROP TABLE IF EXISTS phone_number;
 DROP SEQUENCE IF EXISTS phone_number_id_seq;
 DROP TABLE IF EXISTS subscription_type;
 DROP SEQUENCE IF EXISTS subscription_type_id_seq;
+DROP TABLE IF EXISTS seed_state;
+DROP TABLE IF EXISTS login_throttle;
+DROP FUNCTION IF EXISTS notify_reference_data_changed();
 DROP TABLE IF EXISTS alembic_version;
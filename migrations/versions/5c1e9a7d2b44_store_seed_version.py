@@ -0,0 +1,32 @@
+"""store seed version
+
+Revision ID: 5c1e9a7d2b44
+Revises: ab36b46f23e6
+Create Date: 2026-10-18 21:05:12.481377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e9a7d2b44'
+down_revision = 'ab36b46f23e6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows get version 0, so the reference data is seeded once more and its version stored
+    with op.batch_alter_table('seed_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.alter_column('version', server_default=None)
+        batch_op.drop_column('fingerprint')
+
+
+def downgrade():
+    # An empty fingerprint never matches, so the reference data is seeded again
+    with op.batch_alter_table('seed_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('fingerprint', sa.String(length=64), nullable=False, server_default=''))
+        batch_op.alter_column('fingerprint', server_default=None)
+        batch_op.drop_column('version')
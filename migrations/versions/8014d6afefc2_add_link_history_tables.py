@@ -0,0 +1,79 @@
+"""add link history tables
+
+Revision ID: 8014d6afefc2
+Revises: b79b242c5ff2
+Create Date: 2026-10-18 12:31:52.140377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8014d6afefc2'
+down_revision = 'b79b242c5ff2'
+branch_labels = None
+depends_on = None
+
+
+# Link table, its foreign key column and referenced table, and whether it has a confirmed column
+links = [
+    ('user_email', 'email_id', 'email_address', True),
+    ('user_phone', 'phone_id', 'phone_number', True),
+    ('user_device', 'device_id', 'device', False),
+    ('user_category', 'category_id', 'category', False),
+    ('user_subscription', 'subscription_id', 'subscription', False),
+]
+
+
+def upgrade():
+    for table, column, referenced, confirmed in links:
+        op.create_table(table + '_history',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column(column, sa.Integer(), nullable=False),
+        *([sa.Column('confirmed', sa.Boolean(), nullable=False)] if confirmed else []),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('removed_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['app_user.id'], ),
+        sa.ForeignKeyConstraint([column], [referenced + '.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index('ix_%s_history_user_id' % table, table + '_history', ['user_id'], unique=False)
+        if table != 'user_category':
+            op.create_index(
+                'ix_%s_history_%s' % (table, column), table + '_history', [column], unique=False
+            )
+
+        # Move links removed so far out of the active table
+        columns = ', '.join(['id', 'user_id', column] + (['confirmed'] if confirmed else []) + ['created_at'])
+        op.execute(
+            "WITH moved AS (DELETE FROM %s WHERE removed_at <= now() RETURNING %s, removed_at) "
+            "INSERT INTO %s_history (%s, removed_at) SELECT %s, removed_at FROM moved"
+            % (table, columns, table, columns, columns)
+        )
+
+    # Links scheduled for removal, found by the archival job without scanning the active links
+    with op.get_context().autocommit_block():
+        for table, column, referenced, confirmed in links:
+            op.create_index(
+                'ix_%s_removed_at_scheduled' % table, table, ['removed_at'], unique=False,
+                postgresql_where=sa.text("removed_at < '2100-01-01'"), if_not_exists=True,
+                postgresql_concurrently=True
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, column, referenced, confirmed in reversed(links):
+            op.drop_index(
+                'ix_%s_removed_at_scheduled' % table, table_name=table, if_exists=True, postgresql_concurrently=True
+            )
+
+    for table, column, referenced, confirmed in reversed(links):
+        columns = ', '.join(['id', 'user_id', column] + (['confirmed'] if confirmed else []) + ['created_at'])
+        op.execute(
+            "INSERT INTO %s (%s, removed_at) SELECT %s, removed_at FROM %s_history"
+            % (table, columns, columns, table)
+        )
+        op.drop_table(table + '_history')
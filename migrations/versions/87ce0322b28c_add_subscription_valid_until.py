@@ -0,0 +1,46 @@
+"""add subscription valid_until
+
+Revision ID: 87ce0322b28c
+Revises: cc4231d27d16
+Create Date: 2026-10-18 14:52:09.663120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '87ce0322b28c'
+down_revision = 'cc4231d27d16'
+branch_labels = None
+depends_on = None
+
+
+# Indexes serving active subscription lookups by user and expiry range scans joined back to their users
+indexes = [
+    ('ix_subscription_valid_until', 'subscription', ['valid_until']),
+    ('ix_user_subscription_subscription_id_removed_at', 'user_subscription', ['subscription_id', 'removed_at']),
+]
+
+
+def upgrade():
+    op.add_column('subscription', sa.Column('valid_until', sa.DateTime(), nullable=True))
+    op.execute(
+        "UPDATE subscription "
+        "SET valid_until = subscription.valid_from + make_interval(months => subscription_type.months) "
+        "FROM subscription_type WHERE subscription_type.id = subscription.subscription_type_id"
+    )
+    op.alter_column('subscription', 'valid_until', nullable=False)
+
+    # CREATE INDEX CONCURRENTLY does not lock out writes, but cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in indexes:
+            op.create_index(name, table, columns, unique=False, if_not_exists=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(indexes):
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
+
+    op.drop_column('subscription', 'valid_until')
@@ -0,0 +1,43 @@
+"""add user listing indexes
+
+Revision ID: ab36b46f23e6
+Revises: 87ce0322b28c
+Create Date: 2026-10-18 15:31:44.205871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ab36b46f23e6'
+down_revision = '87ce0322b28c'
+branch_labels = None
+depends_on = None
+
+
+# Indexes serving the keyset order of list_users, its category filter and its LIKE 'prefix%' filters, which the
+# unique constraints cannot serve outside the C collation
+indexes = [
+    ('ix_app_user_created_at_id', 'app_user', ['created_at', 'id'], {}),
+    ('ix_user_category_category_id_removed_at', 'user_category', ['category_id', 'removed_at'], {}),
+    ('ix_email_address_email_address_pattern', 'email_address', ['email_address'],
+     {'email_address': 'text_pattern_ops'}),
+    ('ix_phone_number_phone_number_pattern', 'phone_number', ['phone_number'], {'phone_number': 'text_pattern_ops'}),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY does not lock out writes, but cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns, ops in indexes:
+            op.create_index(
+                name, table, columns, unique=False, if_not_exists=True, postgresql_concurrently=True,
+                postgresql_ops=ops
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, ops in reversed(indexes):
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
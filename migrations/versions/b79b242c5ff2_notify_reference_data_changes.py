@@ -0,0 +1,39 @@
+"""notify reference data changes
+
+Revision ID: b79b242c5ff2
+Revises: 1ab0f44cdec5
+Create Date: 2026-10-18 11:47:05.913862
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b79b242c5ff2'
+down_revision = '1ab0f44cdec5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Send the table name on the reference_data_changed channel after every write, caches reload on it
+    op.execute(
+        "CREATE OR REPLACE FUNCTION notify_reference_data_changed() RETURNS trigger AS $$ "
+        "BEGIN "
+        "PERFORM pg_notify('reference_data_changed', TG_TABLE_NAME); "
+        "RETURN NULL; "
+        "END; "
+        "$$ LANGUAGE plpgsql"
+    )
+    for table in ('subscription_type', 'category'):
+        op.execute(
+            "CREATE TRIGGER %s_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s "
+            "FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_changed()" % (table, table)
+        )
+
+
+def downgrade():
+    for table in ('category', 'subscription_type'):
+        op.execute("DROP TRIGGER %s_changed ON %s" % (table, table))
+    op.execute("DROP FUNCTION notify_reference_data_changed()")
@@ -0,0 +1,42 @@
+"""add link table indexes
+
+Revision ID: b7a84f7c3a51
+Revises: 4bcd996c239f
+Create Date: 2026-10-18 10:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7a84f7c3a51'
+down_revision = '4bcd996c239f'
+branch_labels = None
+depends_on = None
+
+
+# Indexes serving "<foreign key> = %s AND removed_at > %s" lookups of active links
+indexes = [
+    ('ix_user_email_email_id_removed_at', 'user_email', ['email_id', 'removed_at']),
+    ('ix_user_email_user_id_removed_at', 'user_email', ['user_id', 'removed_at']),
+    ('ix_user_phone_phone_id_removed_at', 'user_phone', ['phone_id', 'removed_at']),
+    ('ix_user_phone_user_id_removed_at', 'user_phone', ['user_id', 'removed_at']),
+    ('ix_user_device_device_id_removed_at', 'user_device', ['device_id', 'removed_at']),
+    ('ix_user_device_user_id_removed_at', 'user_device', ['user_id', 'removed_at']),
+    ('ix_user_category_user_id_removed_at', 'user_category', ['user_id', 'removed_at']),
+    ('ix_user_subscription_user_id_removed_at', 'user_subscription', ['user_id', 'removed_at']),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY does not lock out writes, but cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in indexes:
+            op.create_index(name, table, columns, unique=False, if_not_exists=True, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(indexes):
+            op.drop_index(name, table_name=table, if_exists=True, postgresql_concurrently=True)
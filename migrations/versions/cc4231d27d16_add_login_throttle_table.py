@@ -0,0 +1,29 @@
+"""add login throttle table
+
+Revision ID: cc4231d27d16
+Revises: 8014d6afefc2
+Create Date: 2026-10-18 14:05:27.418903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cc4231d27d16'
+down_revision = '8014d6afefc2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('login_throttle',
+    sa.Column('key', sa.String(length=64), nullable=False),
+    sa.Column('refilled_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key'),
+    prefixes=['UNLOGGED']
+    )
+
+
+def downgrade():
+    op.drop_table('login_throttle')
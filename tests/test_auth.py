@@ -0,0 +1,99 @@
+from datetime import date
+
+from db_auth import check_registration, incorrect_password, logged_in, not_registered, registered
+
+
+def new_response():
+    return {"type": "", "data": {}}
+
+
+def test_check_registration_reports_every_credential_available():
+    response = new_response()
+    check_registration(response, ([], [], []))
+    assert response["type"] == ""
+    assert response["data"]["email_error"] == 0
+    assert response["data"]["phone_error"] == 0
+    assert response["data"]["device_error"] == 0
+
+
+def test_check_registration_reports_credentials_in_use():
+    response = new_response()
+    check_registration(response, ([7], [], [7]))
+    assert response["type"] == "error"
+    assert response["data"]["email_error"] == 1
+    assert response["data"]["email_message"] == "Email already in use"
+    assert response["data"]["phone_error"] == 0
+    assert response["data"]["device_error"] == 1
+
+
+def test_registered_fills_ids_and_profile():
+    response = new_response()
+    registered(response, (1, 2, 3, 4), "Ion", "Popescu", "ion@example.com", "Pixel 7", "ABCDEF12345", "069123456",
+               "1990-01-31")
+    assert response["type"] == "success"
+    assert response["data"]["user_id"] == 1
+    assert response["data"]["email_id"] == 2
+    assert response["data"]["phone_id"] == 3
+    assert response["data"]["device_id"] == 4
+    assert response["data"]["email_address"] == "ion@example.com"
+    assert response["data"]["birth_date"] == "1990-01-31"
+
+
+def test_registered_without_ids_asks_to_try_again():
+    response = new_response()
+    registered(response, None, "Ion", "Popescu", "ion@example.com", "Pixel 7", "ABCDEF12345", "069123456",
+               "1990-01-31")
+    assert response["type"] == "error"
+    assert "try again" in response["data"]["message"]
+    assert "user_id" not in response["data"]
+
+
+# Row shaped like the login profile queries: id, names, password hash, birth date, then the active credentials
+LOGIN_ROW = (
+    1, "Ion", "Popescu", "$2b$12$hash", date(1990, 1, 31), "ion@example.com", 2, "069123456", 3,
+    "Pixel 7", "ABCDEF12345", 4, 2,
+)
+
+
+def test_logged_in_fills_profile_without_password_hash():
+    response = new_response()
+    logged_in(response, LOGIN_ROW)
+    assert response["type"] == "success"
+    assert response["data"] == {
+        "message": "User logged in successfully",
+        "user_id": 1,
+        "first_name": "Ion",
+        "last_name": "Popescu",
+        "email_address": "ion@example.com",
+        "email_id": 2,
+        "phone_number": "069123456",
+        "phone_id": 3,
+        "device_name": "Pixel 7",
+        "device_sn": "ABCDEF12345",
+        "device_id": 4,
+        "birth_date": "1990-01-31",
+    }
+
+
+def test_logged_in_keeps_missing_credentials_empty():
+    response = new_response()
+    logged_in(response, LOGIN_ROW[:7] + (None, None, None, None, None, 2))
+    assert response["data"]["phone_number"] is None
+    assert response["data"]["device_id"] is None
+
+
+def test_not_registered_reports_the_credential_kind():
+    email = new_response()
+    not_registered(email, "email")
+    assert email["data"] == {"email_error": 1, "email_message": "Email not registered"}
+
+    phone = new_response()
+    not_registered(phone, "phone")
+    assert phone["data"] == {"phone_error": 1, "phone_message": "Phone number not registered"}
+
+
+def test_incorrect_password():
+    response = new_response()
+    incorrect_password(response)
+    assert response["type"] == "error"
+    assert response["data"]["password_error"] == 2
@@ -0,0 +1,133 @@
+import threading
+
+import db_cache
+from db_cache import LRUCache, ReferenceCache
+
+SUBSCRIPTION_TYPES = [(1, "monthly", 1, 100), (2, "yearly", 12, 1000)]
+CATEGORIES = [(1, "general"), (2, "student")]
+
+
+# Load function counting its calls
+class Loader:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return SUBSCRIPTION_TYPES, CATEGORIES
+
+
+def test_reference_data_is_loaded_once():
+    load = Loader()
+    cache = ReferenceCache(load)
+    data = cache.get()
+    assert cache.get() is data
+    assert load.calls == 1
+    assert data.categories_by_name["student"].id == 2
+    assert data.subscription_types_by_id[2].months == 12
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_invalidate_reloads_on_next_get():
+    load = Loader()
+    cache = ReferenceCache(load)
+    first = cache.get()
+    cache.invalidate("category")
+    assert cache.stats()["loaded"] is False
+    assert cache.get() is not first
+    assert load.calls == 2
+
+
+def test_invalidation_during_load_discards_the_snapshot():
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load():
+        loading.set()
+        release.wait()
+        return SUBSCRIPTION_TYPES, CATEGORIES
+
+    cache = ReferenceCache(load)
+    reader = threading.Thread(target=cache.get)
+    reader.start()
+    loading.wait()
+    cache.invalidate()
+    release.set()
+    reader.join()
+    # The snapshot read before the invalidation is returned to its caller but not kept
+    assert cache.stats()["loaded"] is False
+
+
+# Replace the monotonic clock seen by db_cache with a settable one
+class Clock:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(db_cache.time, "monotonic", lambda: self.now)
+
+
+def test_get_returns_stored_value():
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.set(("email", "ion@example.com"), (1, 2))
+    assert cache.get(("email", "ion@example.com")) == (1, 2)
+    assert cache.get(("email", "ana@example.com")) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.set("key", "value")
+
+    clock.now += 10
+    assert cache.get("key") == "value"
+    clock.now += 0.1
+    assert cache.get("key") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Reading "a" makes "b" the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_setting_an_entry_again_refreshes_its_ttl(monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = LRUCache(max_size=2, ttl=10)
+    cache.set("key", 1)
+    clock.now += 8
+    cache.set("key", 2)
+    clock.now += 8
+    assert cache.get("key") == 2
+
+
+def test_zero_size_disables_the_cache():
+    cache = LRUCache(max_size=0)
+    cache.set("key", "value")
+    assert cache.get("key") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_delete_and_clear_count_invalidations():
+    cache = LRUCache(max_size=3, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("c", 3)
+    cache.delete("a", "missing")
+    assert cache.get("a") is None
+    assert cache.stats()["invalidations"] == 1
+
+    cache.clear()
+    assert cache.stats()["size"] == 0
+    assert cache.stats()["invalidations"] == 3
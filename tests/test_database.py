@@ -0,0 +1,24 @@
+import threading
+import time
+
+from Database import DatabaseMeta
+
+
+def test_concurrent_first_calls_build_one_instance():
+    built = []
+
+    class Singleton(metaclass=DatabaseMeta):
+        def __init__(self):
+            # Slow enough for every thread to reach the check before the first instance is stored
+            time.sleep(0.05)
+            built.append(self)
+
+    instances = []
+    threads = [threading.Thread(target=lambda: instances.append(Singleton())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(built) == 1
+    assert all(instance is built[0] for instance in instances)
@@ -0,0 +1,49 @@
+from datetime import date, datetime
+import csv
+import io
+import json
+
+import pytest
+
+from db_export import EXPORT_COLUMNS, json_default, write_csv, write_jsonl
+
+ROW = (
+    1, "Ion", "Popescu", date(1990, 1, 31), True, True, datetime(2024, 5, 1, 12, 30),
+    "ion@example.com", True, "069123456", False, "Pixel 7", "ABCDEF12345", "ST-3", date(2024, 5, 1),
+)
+
+
+def test_write_csv_adds_header_and_counts_rows():
+    file = io.StringIO()
+    assert write_csv(iter([ROW, ROW]), file) == 2
+    lines = list(csv.reader(io.StringIO(file.getvalue())))
+    assert lines[0] == list(EXPORT_COLUMNS)
+    assert lines[1][:4] == ["1", "Ion", "Popescu", "1990-01-31"]
+    assert len(lines) == 3
+
+
+def test_write_csv_without_rows_writes_only_the_header():
+    file = io.StringIO()
+    assert write_csv([], file) == 0
+    assert file.getvalue().strip() == ",".join(EXPORT_COLUMNS)
+
+
+def test_write_jsonl_writes_one_object_per_line():
+    file = io.StringIO()
+    assert write_jsonl([ROW, ROW[:7] + (None,) * 8], file) == 2
+    first, second = [json.loads(line) for line in file.getvalue().splitlines()]
+    assert list(first) == list(EXPORT_COLUMNS)
+    assert first["birth_date"] == "1990-01-31"
+    assert first["created_at"] == "2024-05-01T12:30:00"
+    assert second["email_address"] is None
+
+
+def test_write_jsonl_keeps_non_ascii_text():
+    file = io.StringIO()
+    write_jsonl([(1, "Ștefan")], file, columns=("id", "first_name"))
+    assert file.getvalue() == '{"id": 1, "first_name": "Ștefan"}\n'
+
+
+def test_json_default_rejects_other_types():
+    with pytest.raises(TypeError):
+        json_default(object())
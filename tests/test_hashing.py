@@ -0,0 +1,80 @@
+import asyncio
+import threading
+
+import pytest
+
+from db_hashing import PasswordHasher
+
+
+@pytest.fixture(params=["inline", "thread", "process"])
+def hasher(request):
+    hasher = PasswordHasher(executor=request.param, workers=2, max_pending=2, rounds=4)
+    yield hasher
+    hasher.shutdown()
+
+
+def test_unknown_executor_is_rejected():
+    with pytest.raises(ValueError):
+        PasswordHasher(executor="gpu")
+
+
+def test_hash_and_verify(hasher):
+    password_hash = hasher.hash("correct horse")
+    assert password_hash.startswith("$2b$04$")
+    assert hasher.verify("correct horse", password_hash)
+    assert not hasher.verify("wrong horse", password_hash)
+
+    stats = hasher.stats()
+    assert stats["hashed"] == 1
+    assert stats["verified"] == 2
+    assert stats["pending"] == 0
+
+
+def test_hash_many_keeps_order(hasher):
+    passwords = ["password%d" % number for number in range(5)]
+    hashes = hasher.hash_many(passwords)
+    assert len(set(hashes)) == 5
+    assert all(hasher.verify(password, password_hash) for password, password_hash in zip(passwords, hashes))
+    assert hasher.stats()["peak_pending"] <= 2
+
+
+def test_async_hash_and_verify(hasher):
+    async def run():
+        hashes = await asyncio.gather(*[hasher.hash_async("password%d" % number) for number in range(4)])
+        return await asyncio.gather(*[
+            hasher.verify_async("password%d" % number, password_hash) for number, password_hash in enumerate(hashes)
+        ])
+
+    assert asyncio.run(run()) == [True] * 4
+    assert hasher.stats()["hashed"] == 4
+    assert hasher.stats()["pending"] == 0
+
+
+def test_invalid_hash_is_counted_as_failed():
+    hasher = PasswordHasher(executor="thread", workers=1, rounds=4)
+    with pytest.raises(ValueError):
+        hasher.verify("password", "not a bcrypt hash")
+    assert hasher.stats()["failed"] == 1
+    assert hasher.stats()["pending"] == 0
+    hasher.shutdown()
+
+
+def test_callers_beyond_max_pending_wait_for_a_slot():
+    hasher = PasswordHasher(executor="thread", workers=1, max_pending=1, rounds=4)
+    threads = [threading.Thread(target=hasher.hash, args=("password",)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert hasher.stats()["peak_pending"] == 1
+    assert hasher.stats()["hashed"] == 4
+    hasher.shutdown()
+
+
+def test_shut_down_executor_gives_the_slot_back():
+    hasher = PasswordHasher(executor="thread", workers=1, max_pending=1, rounds=4)
+    hasher.shutdown()
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            hasher.hash("password")
+    assert hasher.stats()["pending"] == 0
@@ -0,0 +1,78 @@
+from datetime import date, datetime
+import csv
+import io
+
+import pytest
+
+from db_import import CopyStream, check_record, parse_bool, read_jsonl
+
+NOW = datetime(2024, 5, 1, 12, 0)
+
+RECORD = {
+    "first_name": "Ion",
+    "last_name": "Popescu",
+    "password_hash": "$2b$12$" + "a" * 53,
+    "birth_date": "1990-01-31",
+    "email_address": "ion@example.com",
+}
+
+
+def test_copy_stream_returns_all_rows_as_csv():
+    rows = [(1, "Ion", None), (2, 'Ana "A", B', True)]
+    assert CopyStream(rows).read() == '1,Ion,\n2,"Ana ""A"", B",True\n'
+
+
+def test_copy_stream_chunks_join_to_the_whole_input():
+    rows = [(line, "name %d" % line, "x" * (line % 7)) for line in range(200)]
+    stream = CopyStream(rows)
+    chunks = []
+    while True:
+        chunk = stream.read(64)
+        if not chunk:
+            break
+        assert len(chunk) <= 64
+        chunks.append(chunk)
+
+    parsed = list(csv.reader(io.StringIO("".join(chunks))))
+    assert parsed == [[str(line), name, padding] for line, name, padding in rows]
+
+
+def test_check_record_fills_defaults():
+    row, reason = check_record(dict(RECORD), True, NOW)
+    assert reason is None
+    assert row == (
+        "Ion", "Popescu", RECORD["password_hash"], date(1990, 1, 31), "ion@example.com",
+        None, None, None, True, NOW,
+    )
+
+
+@pytest.mark.parametrize("changes, reason", [
+    ({"email_address": ""}, "missing email_address"),
+    ({"email_address": "ion@example"}, "invalid email_address"),
+    ({"phone_number": "12345"}, "invalid phone_number"),
+    ({"device_sn": "ABC"}, "invalid device_sn"),
+    ({"device_name": "Pixel"}, "device_name without device_sn"),
+    ({"device_sn": "ABCDEF12345"}, "device_sn without device_name"),
+    ({"password_hash": "secret"}, "invalid password_hash"),
+    ({"birth_date": "2999-01-01"}, "invalid birth_date"),
+    ({"created_at": "yesterday"}, "invalid created_at"),
+    ({"confirmed": "maybe"}, "invalid confirmed"),
+])
+def test_check_record_rejects_with_reason(changes, reason):
+    assert check_record(dict(RECORD, **changes), True, NOW) == (None, reason)
+
+
+def test_check_record_rejects_non_objects():
+    assert check_record(None, True, NOW) == (None, "invalid record")
+
+
+def test_parse_bool():
+    assert parse_bool("Yes") is True
+    assert parse_bool(0) is False
+    with pytest.raises(ValueError):
+        parse_bool("maybe")
+
+
+def test_read_jsonl_skips_blank_lines_and_flags_invalid_ones():
+    lines = io.StringIO('{"first_name": "Ion"}\n\n[1, 2]\nnot json\n')
+    assert list(read_jsonl(lines)) == [(1, {"first_name": "Ion"}), (3, None), (4, None)]
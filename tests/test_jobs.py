@@ -0,0 +1,56 @@
+import threading
+
+from db_jobs import PeriodicJob
+
+
+def test_job_runs_until_stopped():
+    runs = threading.Semaphore(0)
+
+    def function():
+        runs.release()
+        return {"users": 3}
+
+    job = PeriodicJob("remove_unconfirmed", interval=0.01, function=function, delay=0)
+    job.start()
+    for _ in range(3):
+        assert runs.acquire(timeout=5)
+    job.stop()
+    job.join(timeout=5)
+
+    assert not job.is_alive()
+    assert job.name == "job-remove_unconfirmed"
+    assert job.stats()["runs"] >= 3
+    assert job.stats()["last_result"] == {"users": 3}
+
+
+def test_first_run_waits_one_interval_by_default():
+    called = threading.Event()
+    job = PeriodicJob("sweep_orphans", interval=60, function=called.set)
+    assert job.delay == 60
+    job.start()
+    job.stop()
+    job.join(timeout=5)
+    assert not called.is_set()
+    assert job.stats()["runs"] == 0
+
+
+def test_failures_are_counted_and_the_job_keeps_running():
+    calls = []
+    done = threading.Event()
+
+    def function():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("database unavailable")
+        done.set()
+        return len(calls)
+
+    job = PeriodicJob("remove_unconfirmed", interval=0.01, function=function, delay=0)
+    job.start()
+    assert done.wait(timeout=5)
+    job.stop()
+    job.join(timeout=5)
+
+    stats = job.stats()
+    assert stats["failures"] == 1
+    assert stats["runs"] >= 1
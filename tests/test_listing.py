@@ -0,0 +1,36 @@
+from datetime import datetime
+import base64
+
+import pytest
+
+from db_listing import decode_cursor, encode_cursor, like_prefix, list_users_sql
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2024, 5, 1, 12, 30, 15, 123456)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    base64.urlsafe_b64encode(b"[1, 2, 3]").decode(),
+    base64.urlsafe_b64encode(b'["2024-05-01T12:30:15", "42"]').decode(),
+    base64.urlsafe_b64encode(b'["2024-05-01T12:30:15", true]').decode(),
+    base64.urlsafe_b64encode(b'["yesterday", 42]').decode(),
+    None,
+])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_like_prefix_escapes_wildcards():
+    assert like_prefix("ion_") == "ion\\_%"
+    assert like_prefix("100%") == "100\\%%"
+    assert like_prefix("a\\b") == "a\\\\b%"
+
+
+def test_list_users_sql_adds_one_condition_per_filter():
+    assert "WHERE TRUE" in list_users_sql([])
+    query = list_users_sql(["active", "after"])
+    assert "app_user.active = %(active)s AND (app_user.created_at, app_user.id) <" in query
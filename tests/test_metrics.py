@@ -0,0 +1,92 @@
+import pytest
+
+from db_metrics import BUCKETS, Metrics, instrumented, redact, redact_statement
+
+
+# Object exposing a metrics attribute, like Database
+class Service:
+    def __init__(self):
+        self.metrics = Metrics(slow_query_seconds=0.5)
+
+    @instrumented
+    def login(self):
+        self.metrics.query("SELECT 1", None, 0.001)
+        self.lookup()
+        self.metrics.commit()
+
+    @instrumented
+    def lookup(self):
+        self.metrics.query("SELECT 2", None, 0.001)
+
+    @instrumented
+    def fail(self):
+        raise RuntimeError("boom")
+
+
+def test_round_trips_count_for_every_running_operation():
+    service = Service()
+    service.login()
+    data = service.metrics.as_dict()
+    assert data["queries"] == 2
+    assert data["commits"] == 1
+    assert data["operations"]["login"]["round_trips"] == 2
+    assert data["operations"]["login"]["commits"] == 1
+    assert data["operations"]["lookup"]["round_trips"] == 1
+    assert data["operations"]["lookup"]["commits"] == 0
+
+
+def test_errors_are_counted_and_raised():
+    service = Service()
+    with pytest.raises(RuntimeError):
+        service.fail()
+    operation = service.metrics.as_dict()["operations"]["fail"]
+    assert operation["calls"] == 1
+    assert operation["errors"] == 1
+
+
+def test_histogram_buckets_are_cumulative():
+    service = Service()
+    service.login()
+    service.login()
+    buckets = service.metrics.as_dict()["operations"]["login"]["buckets"]
+    assert list(buckets) == list(BUCKETS) + ["+Inf"]
+    counts = list(buckets.values())
+    assert counts == sorted(counts)
+    assert counts[-1] == 2
+
+
+def test_slow_queries_are_logged_without_values():
+    metrics = Metrics(slow_query_seconds=0.1, slow_query_log_size=1)
+    metrics.query("SELECT 1", None, 0.05)
+    metrics.query("SELECT * FROM app_user WHERE id = %(id)s AND first_name = 'Ion'", {"id": 7}, 0.2)
+    metrics.query("SELECT 3", None, 0.3)
+    data = metrics.as_dict()
+    assert data["slow_query_count"] == 2
+    # Only the last slow_query_log_size entries are kept
+    assert [entry["statement"] for entry in data["slow_queries"]] == ["SELECT ?"]
+
+
+def test_prometheus_exposition():
+    service = Service()
+    service.login()
+    text = service.metrics.prometheus(prefix="db")
+    assert "# TYPE db_calls_total counter" in text
+    assert 'db_calls_total{operation="login"} 1' in text
+    assert 'db_round_trips_total{operation="login"} 2' in text
+    assert 'db_operation_seconds_bucket{operation="login",le="+Inf"} 1' in text
+    assert "db_queries_total 2" in text
+    assert text.endswith("\n")
+
+
+def test_redact_statement_replaces_literals():
+    statement = "INSERT INTO device (device_name, device_sn) VALUES ('Ion''s phone', 'ABC'), ('x', 'y') LIMIT 10"
+    assert redact_statement(statement) == "INSERT INTO device (device_name, device_sn) VALUES (?, ?), (?, ?) LIMIT ?"
+    assert redact_statement(b"SELECT 'a'") == "SELECT ?"
+    assert redact_statement("SELECT $1 FROM t1") == "SELECT $1 FROM t1"
+    assert redact_statement("x" * 2000).endswith("...")
+
+
+def test_redact_keeps_only_types():
+    assert redact({"email_address": "ion@example.com", "id": 7}) == {"email_address": "str", "id": "int"}
+    assert redact(("ion@example.com", None)) == ["str", "NoneType"]
+    assert redact(None) is None
@@ -0,0 +1,168 @@
+import threading
+import time
+
+import pytest
+
+from db_pool import ConnectionPool, PoolError, PoolTimeout
+
+
+# Stand-in connection recording rollbacks and pings
+class FakeConnection:
+    def __init__(self, healthy: bool = True):
+        self.closed = False
+        self.healthy = healthy
+        self.rollbacks = 0
+        self.pings = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query):
+        self.connection.pings += 1
+        if not self.connection.healthy:
+            raise RuntimeError("connection lost")
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def opened():
+    return []
+
+
+@pytest.fixture
+def connect(opened):
+    def connect():
+        connection = FakeConnection()
+        opened.append(connection)
+        return connection
+    return connect
+
+
+def test_invalid_sizes_are_rejected(connect):
+    with pytest.raises(ValueError):
+        ConnectionPool(connect, min_size=3, max_size=2)
+    with pytest.raises(ValueError):
+        ConnectionPool(connect, min_size=0, max_size=0)
+
+
+def test_min_size_connections_are_opened_up_front(connect, opened):
+    pool = ConnectionPool(connect, min_size=2, max_size=4)
+    assert len(opened) == 2
+    assert pool.stats()["size"] == 2
+    assert pool.stats()["idle"] == 2
+
+
+def test_returned_connection_is_reused_and_rolled_back(connect, opened):
+    pool = ConnectionPool(connect, min_size=0, max_size=2)
+    connection = pool.getconn()
+    pool.putconn(connection)
+    assert connection.rollbacks == 1
+    assert pool.getconn() is connection
+    assert len(opened) == 1
+
+
+def test_checkout_times_out_when_exhausted(connect):
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=0.05)
+    pool.getconn()
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+    assert time.monotonic() - started >= 0.05
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_waiting_checkout_gets_returned_connection(connect):
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=5)
+    connection = pool.getconn()
+    timer = threading.Timer(0.05, pool.putconn, (connection,))
+    timer.start()
+    assert pool.getconn() is connection
+    timer.join()
+
+
+def test_discarded_connection_is_closed_and_replaced(connect, opened):
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=0.05)
+    connection = pool.getconn()
+    pool.putconn(connection, discard=True)
+    assert connection.closed
+    assert pool.stats()["size"] == 0
+
+    replacement = pool.getconn()
+    assert replacement is not connection
+    assert len(opened) == 2
+
+
+def test_failed_rollback_discards_connection(connect):
+    pool = ConnectionPool(connect, min_size=0, max_size=1)
+    connection = pool.getconn()
+
+    def rollback():
+        raise RuntimeError("connection lost")
+
+    connection.rollback = rollback
+    pool.putconn(connection)
+    assert connection.closed
+    assert pool.stats()["size"] == 0
+
+
+def test_idle_connections_above_min_size_are_recycled(connect):
+    pool = ConnectionPool(connect, min_size=1, max_size=3, max_idle=0.01)
+    connections = [pool.getconn() for _ in range(3)]
+    for connection in connections:
+        pool.putconn(connection)
+    time.sleep(0.02)
+
+    kept = pool.getconn()
+    stats = pool.stats()
+    assert stats["recycled"] == 2
+    assert stats["size"] == 1
+    assert kept is connections[2]
+    assert connections[0].closed and connections[1].closed
+
+
+def test_unhealthy_idle_connection_is_replaced(connect, opened):
+    pool = ConnectionPool(connect, min_size=0, max_size=1, check_idle=0)
+    connection = pool.getconn()
+    connection.healthy = False
+    pool.putconn(connection)
+
+    replacement = pool.getconn()
+    assert replacement is not connection
+    assert connection.closed
+    assert pool.stats()["failed_checks"] == 1
+
+
+def test_failed_connect_frees_the_slot():
+    attempts = []
+
+    def connect():
+        attempts.append(None)
+        if len(attempts) == 1:
+            raise RuntimeError("server unavailable")
+        return FakeConnection()
+
+    pool = ConnectionPool(connect, min_size=0, max_size=1, timeout=0.05)
+    with pytest.raises(RuntimeError):
+        pool.getconn()
+    assert pool.getconn() is not None
+
+
+def test_closed_pool_refuses_checkouts(connect, opened):
+    pool = ConnectionPool(connect, min_size=2, max_size=2)
+    pool.closeall()
+    assert all(connection.closed for connection in opened)
+    with pytest.raises(PoolError):
+        pool.getconn()
@@ -0,0 +1,19 @@
+from Database import prepared_form
+
+
+def test_named_placeholders_are_numbered_once():
+    query, names = prepared_form(
+        "SELECT * FROM user_email WHERE email_id = %(email_id)s AND removed_at > %(now)s AND created_at < %(now)s"
+    )
+    assert query == "SELECT * FROM user_email WHERE email_id = $1 AND removed_at > $2 AND created_at < $2"
+    assert names == ("email_id", "now")
+
+
+def test_positional_placeholders_are_numbered_in_order():
+    query, names = prepared_form("UPDATE user_email SET confirmed = TRUE WHERE email_id = %s AND removed_at > %s")
+    assert query == "UPDATE user_email SET confirmed = TRUE WHERE email_id = $1 AND removed_at > $2"
+    assert names == (None, None)
+
+
+def test_query_without_placeholders_is_unchanged():
+    assert prepared_form("SELECT 1") == ("SELECT 1", ())
@@ -0,0 +1,125 @@
+import pytest
+
+from db_pool import PoolTimeout
+from db_replicas import REPLICA_LAG_SQL, ReplicaSet
+
+
+# Connection answering the lag query with the lag of its replica
+class FakeConnection:
+    def __init__(self, replica):
+        self.replica = replica
+
+    def cursor(self):
+        return FakeCursor(self.replica)
+
+
+class FakeCursor:
+    def __init__(self, replica):
+        self.replica = replica
+
+    def execute(self, query):
+        assert query == REPLICA_LAG_SQL
+        self.replica.checks += 1
+        if self.replica.broken:
+            raise RuntimeError("connection lost")
+
+    def fetchone(self):
+        return (self.replica.lag,)
+
+    def close(self):
+        pass
+
+
+# Pool of one replica, recording checkouts and returns
+class FakePool:
+    def __init__(self, lag=0.0):
+        self.lag = lag
+        self.broken = False
+        self.busy = False
+        self.checks = 0
+        self.borrowed = 0
+        self.returned = []
+
+    def getconn(self):
+        if self.busy:
+            raise PoolTimeout("busy")
+        self.borrowed += 1
+        return FakeConnection(self)
+
+    def putconn(self, connection, discard=False):
+        self.returned.append(discard)
+
+    def closeall(self):
+        pass
+
+    def stats(self):
+        return {"borrowed": self.borrowed}
+
+
+def test_at_least_one_pool_is_required():
+    with pytest.raises(ValueError):
+        ReplicaSet([])
+
+
+def test_replicas_are_used_round_robin():
+    pools = [FakePool(), FakePool(), FakePool()]
+    replicas = ReplicaSet(pools)
+    assert [replicas.getconn()[0] for _ in range(6)] == [0, 1, 2, 0, 1, 2]
+    assert replicas.stats()["reads"] == 6
+
+
+def test_lag_is_measured_once_per_check_interval():
+    pool = FakePool()
+    replicas = ReplicaSet([pool], check_interval=60)
+    for _ in range(3):
+        index, connection = replicas.getconn()
+        replicas.putconn(index, connection)
+    assert pool.checks == 1
+
+
+def test_lagging_replica_is_skipped():
+    lagging, current = FakePool(lag=10.0), FakePool(lag=0.5)
+    replicas = ReplicaSet([lagging, current], max_lag=5.0, check_interval=60)
+    assert [replicas.getconn()[0] for _ in range(4)] == [1, 1, 1, 1]
+    # The lagging replica was measured once, its connection returned, and then skipped until the next check
+    assert lagging.checks == 1
+    assert lagging.returned == [False]
+    assert replicas.stats()["lagging"] == 1
+
+
+def test_unknown_lag_counts_as_lagging():
+    pool = FakePool(lag=None)
+    replicas = ReplicaSet([pool])
+    assert replicas.getconn() == (None, None)
+    assert replicas.stats()["fallbacks"] == 1
+
+
+def test_every_replica_lagging_falls_back_to_the_primary():
+    replicas = ReplicaSet([FakePool(lag=30.0), FakePool(lag=40.0)], max_lag=5.0)
+    assert replicas.getconn() == (None, None)
+    stats = replicas.stats()
+    assert stats["fallbacks"] == 1
+    assert stats["lagging"] == 2
+    assert [replica["lag"] for replica in stats["replicas"]] == [30.0, 40.0]
+
+
+def test_failed_replica_is_skipped_until_retry_after():
+    broken, healthy = FakePool(), FakePool()
+    broken.broken = True
+    replicas = ReplicaSet([broken, healthy], retry_after=60)
+    assert replicas.getconn()[0] == 1
+    assert broken.returned == [True]
+    assert replicas.stats()["failures"] == 1
+    assert replicas.stats()["replicas"][0]["down"] is True
+
+    broken.broken = False
+    assert [replicas.getconn()[0] for _ in range(3)] == [1, 1, 1]
+
+
+def test_busy_replica_is_skipped_without_marking_it_down():
+    busy, idle = FakePool(), FakePool()
+    busy.busy = True
+    replicas = ReplicaSet([busy, idle])
+    assert replicas.getconn()[0] == 1
+    assert replicas.stats()["failures"] == 0
+    assert replicas.stats()["replicas"][0]["down"] is False
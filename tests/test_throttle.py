@@ -0,0 +1,83 @@
+from datetime import timedelta
+
+import pytest
+
+import db_throttle
+from db_throttle import Throttle
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = {"now": 1000.0}
+    monkeypatch.setattr(db_throttle.time, "monotonic", lambda: clock["now"])
+    return clock
+
+
+def test_burst_is_allowed_then_rejected(clock):
+    throttle = Throttle(per_minute=60, burst=3)
+    assert [throttle.acquire("email:ion@example.com") for _ in range(3)] == [0.0, 0.0, 0.0]
+
+    wait = throttle.acquire("email:ion@example.com")
+    assert wait == pytest.approx(1.0)
+    assert throttle.stats()["allowed"] == 3
+    assert throttle.stats()["rejected"] == 1
+
+
+def test_tokens_refill_one_per_interval(clock):
+    throttle = Throttle(per_minute=60, burst=2)
+    throttle.acquire("key")
+    throttle.acquire("key")
+    assert throttle.acquire("key") > 0
+
+    clock["now"] += 1.0
+    assert throttle.acquire("key") == 0.0
+    assert throttle.acquire("key") > 0
+
+    # A long pause refills the whole burst and no more
+    clock["now"] += 60.0
+    assert [throttle.acquire("key") for _ in range(2)] == [0.0, 0.0]
+    assert throttle.acquire("key") > 0
+
+
+def test_keys_have_separate_buckets(clock):
+    throttle = Throttle(per_minute=60, burst=1)
+    assert throttle.acquire("email:ion@example.com") == 0.0
+    assert throttle.acquire("email:ion@example.com") > 0
+    assert throttle.acquire("email:ana@example.com") == 0.0
+
+
+def test_rejected_attempt_takes_no_token_from_other_bucket(clock):
+    throttle = Throttle(per_minute=60, burst=1, client_per_minute=60, client_burst=2)
+    assert throttle.acquire("a", client_key="10.0.0.1") == 0.0
+    # The credential bucket is empty, so the client bucket must keep its second token
+    assert throttle.acquire("a", client_key="10.0.0.1") > 0
+    assert throttle.acquire("b", client_key="10.0.0.1") == 0.0
+    assert throttle.acquire("c", client_key="10.0.0.1") > 0
+
+
+def test_least_recently_used_keys_are_forgotten(clock):
+    throttle = Throttle(per_minute=60, burst=1, max_keys=2)
+    throttle.acquire("a")
+    throttle.acquire("b")
+    throttle.acquire("c")
+    assert throttle.stats()["keys"] == 2
+    assert throttle.stats()["evicted"] == 1
+    # "a" was evicted, so it starts again with a full bucket
+    assert throttle.acquire("a") == 0.0
+
+
+def test_shared_checks_are_hashed_and_sorted():
+    throttle = Throttle(per_minute=60, burst=3, client_per_minute=120, client_burst=2)
+    checks = throttle.shared_checks("email:ion@example.com", "10.0.0.1")
+    assert [key for key, _, _ in checks] == sorted(key for key, _, _ in checks)
+    assert all(len(key) == 64 and "ion@example.com" not in key for key, _, _ in checks)
+    assert sorted((interval, tolerance) for _, interval, tolerance in checks) == [
+        (timedelta(seconds=0.5), 0.5), (timedelta(seconds=1), 2.0)
+    ]
+
+
+def test_shared_wait_is_the_longest_bucket_wait():
+    throttle = Throttle(per_minute=60, burst=3)
+    checks = [("a", timedelta(seconds=1), 2.0), ("b", timedelta(seconds=1), 0.0)]
+    assert throttle.shared_wait(checks, {"a": 1.0, "b": -5.0}) == 0.0
+    assert throttle.shared_wait(checks, {"a": 3.5, "b": 0.5}) == pytest.approx(1.5)
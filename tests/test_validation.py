@@ -0,0 +1,90 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from db_validation import (
+    credential_kind, is_birth_date, is_device_name, is_device_sn, is_email, is_name, is_phone, password_error
+)
+
+
+@pytest.mark.parametrize("value, valid", [
+    ("ion.popescu@example.com", True),
+    ("a+b@mail.example.md", True),
+    ("ion@example", False),
+    ("ion example@example.com", False),
+    ("a" * 40 + "@example.com", False),
+    (None, False),
+])
+def test_is_email(value, valid):
+    assert is_email(value) is valid
+
+
+@pytest.mark.parametrize("value, valid", [
+    ("69123456", True),
+    ("079123456", True),
+    ("+37369123456", True),
+    ("59123456", False),
+    ("6912345", False),
+    ("+40691234567", False),
+    (69123456, False),
+])
+def test_is_phone(value, valid):
+    assert is_phone(value) is valid
+
+
+@pytest.mark.parametrize("value, valid", [
+    ("ABCDEF12345", True),
+    ("ABCDEF1234", False),
+    ("ABCDEF-12345", False),
+    (None, False),
+])
+def test_is_device_sn(value, valid):
+    assert is_device_sn(value) is valid
+
+
+@pytest.mark.parametrize("value, valid", [
+    ("Ion", True),
+    ("Anne-Marie", True),
+    ("O'Neil", True),
+    ("Ștefan cel Mare", True),
+    ("Ion2", False),
+    ("Ion  Pop", False),
+    ("-Ion", False),
+    ("I" * 51, False),
+])
+def test_is_name(value, valid):
+    assert is_name(value) is valid
+
+
+@pytest.mark.parametrize("value, valid", [
+    ("Pixel 7", True),
+    ("x" * 50, True),
+    ("x" * 51, False),
+    ("   ", False),
+    (None, False),
+])
+def test_is_device_name(value, valid):
+    assert is_device_name(value) is valid
+
+
+def test_is_birth_date():
+    assert is_birth_date("1990-01-31")
+    assert is_birth_date(date(1990, 1, 31))
+    assert is_birth_date(date.today())
+    assert not is_birth_date(date.today() + timedelta(days=1))
+    assert not is_birth_date("31.01.1990")
+    assert not is_birth_date(datetime(1990, 1, 31))
+    assert not is_birth_date(None)
+
+
+def test_password_error():
+    assert password_error("correct horse") is None
+    assert "at least" in password_error("short")
+    assert "at most" in password_error("ă" * 40)
+    assert password_error(None) is not None
+
+
+def test_credential_kind():
+    assert credential_kind("ion@example.com") == "email"
+    assert credential_kind("069123456") == "phone"
+    assert credential_kind("ion") is None